@@ -0,0 +1,146 @@
+"""登録済みのサービスを JSON の HTTP API として公開する ASGI アプリ
+
+使い方:
+    uvicorn api_server:app --host 0.0.0.0 --port 8000
+    
+    POST /services/{name}   本文の JSON を AIService.run() の入力として処理し、結果を返す
+                            （name はサービス名か SERVICE_SLUGS の別名）
+    GET  /services          呼び出せるサービスの一覧
+    GET  /healthz           死活監視
+    GET  /metrics           Prometheus 形式のメトリクス
+
+Streamlit の UI と OpenAI クライアント・キャッシュ・レート制限を共有する場合は、
+SYNAPSE_API_PORT を設定して UI を起動する（最初にページが開かれたときに、同じプロセス内でこの API も起動される）。
+"""
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+
+import anyio
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, PlainTextResponse
+from starlette.routing import Route
+
+from rate_limit import bind_session
+from service_inputs import InvalidInputError
+from tracing import get_tracer, span
+
+# 同時に処理するリクエストの上限（超えた分はワーカースレッドの空きを待つ）
+MAX_CONCURRENCY = int(os.environ.get("SYNAPSE_API_MAX_CONCURRENCY", 64))
+
+# URL で使う英語の別名
+SERVICE_SLUGS = {
+    "text-generation": "AI文章生成",
+    "image-caption": "画像説明生成",
+    "sentiment": "テキスト感情分析",
+}
+
+
+
+# ServiceManager の各サービスを HTTP から呼び出すための ASGI アプリ
+# （上流の呼び出しは同期 API のため、イベントループを止めないようワーカースレッドで実行する）
+class ServiceAPI:
+    def __init__(self, manager_factory: Callable[[], Any], max_concurrency: int = MAX_CONCURRENCY):
+        self.max_concurrency = max_concurrency
+        self._manager_factory = manager_factory
+        self._manager = None
+        self._manager_lock = threading.Lock()
+        self._capacity: Optional[anyio.CapacityLimiter] = None
+        self.app = Starlette(routes=[
+            Route("/services", self.list_services, methods=["GET"]),
+            Route("/services/{name}", self.call_service, methods=["POST"]),
+            Route("/healthz", self.health, methods=["GET"]),
+            Route("/metrics", self.metrics, methods=["GET"]),
+        ])
+    
+    @property
+    def manager(self):
+        """サービス一覧（初回のリクエストで読み込む）"""
+        with self._manager_lock:
+            if self._manager is None:
+                self._manager = self._manager_factory()
+            return self._manager
+    
+    async def list_services(self, request: Request) -> JSONResponse:
+        slugs = {name: slug for slug, name in SERVICE_SLUGS.items()}
+        return JSONResponse([
+            {
+                "name": entry.name,
+                "slug": slugs.get(entry.name),
+                "icon": entry.icon,
+                "description": entry.description,
+            }
+            for entry in self.manager.get_entries()
+        ])
+    
+    async def call_service(self, request: Request) -> JSONResponse:
+        name = request.path_params["name"]
+        service = self.manager.get_service_by_name(SERVICE_SLUGS.get(name, name))
+        if service is None:
+            return self._error(404, f"サービスが見つかりません: {name}")
+        try:
+            inputs = await request.json()
+        except ValueError:
+            return self._error(400, "本文は JSON で指定してください")
+        if not isinstance(inputs, dict):
+            return self._error(400, "本文は JSON オブジェクトで指定してください")
+        
+        # 呼び出し元ごとに共有レートリミッタの順番待ちに並べる（UI のセッションと公平に発行される）
+        client = request.headers.get("x-session-id") or (request.client.host if request.client else "unknown")
+        started_at = time.perf_counter()
+        try:
+            result = await anyio.to_thread.run_sync(
+                self._run, service, inputs, f"api:{client}",
+                limiter=self._capacity_limiter()
+            )
+        except NotImplementedError as e:
+            return self._error(501, str(e))
+        except InvalidInputError as e:
+            return self._error(400, str(e))
+        except TimeoutError as e:
+            return self._error(503, str(e))
+        except Exception as e:
+            # 上流の失敗や応答の形式の誤り（StructuredOutputError など）、サービス内部の誤り
+            return self._error(502, f"{type(e).__name__}: {e}")
+        return JSONResponse({"result": result, "elapsed_seconds": round(time.perf_counter() - started_at, 3)})
+    
+    async def health(self, request: Request) -> JSONResponse:
+        return JSONResponse({"status": "ok"})
+    
+    async def metrics(self, request: Request) -> PlainTextResponse:
+        return PlainTextResponse(get_tracer().prometheus_text(), media_type="text/plain; version=0.0.4")
+    
+    @staticmethod
+    def _run(service, inputs: Dict[str, Any], session_id: str) -> Dict[str, Any]:
+        with bind_session(session_id), span(service.name, "api"):
+            return service.run(inputs)
+    
+    def _capacity_limiter(self) -> anyio.CapacityLimiter:
+        # イベントループ上で作る必要があるため、最初のリクエストで作る
+        if self._capacity is None:
+            self._capacity = anyio.CapacityLimiter(self.max_concurrency)
+        return self._capacity
+    
+    @staticmethod
+    def _error(status: int, message: str) -> JSONResponse:
+        return JSONResponse({"error": message}, status_code=status)
+
+
+def _default_manager():
+    # uvicorn から直接起動した場合は main のサービス一覧を使う
+    from main import get_service_manager
+    return get_service_manager()
+
+
+app = ServiceAPI(_default_manager).app
+
+
+def start_api_server(port: int, manager=None, host: str = "0.0.0.0") -> uvicorn.Server:
+    """API をバックグラウンドのスレッドで起動する（manager を渡すとそのサービス一覧を公開する）"""
+    application = ServiceAPI(lambda: manager).app if manager is not None else app
+    server = uvicorn.Server(uvicorn.Config(application, host=host, port=port, log_level="warning"))
+    threading.Thread(target=server.run, name="api-server", daemon=True).start()
+    return server
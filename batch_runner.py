@@ -0,0 +1,185 @@
+"""JSONL のレコードを AIService.run() で一括処理するコマンドラインツール
+
+使い方:
+    python batch_runner.py --list
+    python batch_runner.py --service テキスト感情分析 --map text=body requests.jsonl results.jsonl
+    python batch_runner.py --service AI文章生成 --map prompt=body --param max_tokens=300 -j 8 in.jsonl out.jsonl
+
+出力先の JSONL は途中経過の記録も兼ねる。中断後に同じコマンドを実行すると、
+成功済みのレコードは飛ばして続きから処理する（失敗したレコードは再実行する）。
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from typing import Any, Dict, Iterator, Optional, Set, Tuple
+
+from main import AIService, get_service_manager
+from rate_limit import bind_session
+from tracing import span
+from worker_pool import run_bounded
+
+# レコードの ID として使うフィールド（--id-field を省略した場合に順に探す）
+ID_FIELDS = ("id", "request_id")
+
+
+def parse_assignments(values: Optional[list], parse_json: bool = False) -> Dict[str, Any]:
+    """KEY=VALUE 形式の指定を辞書にする（parse_json なら値を JSON として解釈し、失敗したら文字列のまま）"""
+    result = {}
+    for value in values or []:
+        key, separator, raw = value.partition("=")
+        if not separator:
+            raise ValueError(f"KEY=VALUE の形式で指定してください: {value}")
+        if parse_json:
+            try:
+                result[key] = json.loads(raw)
+            except ValueError:
+                result[key] = raw
+        else:
+            result[key] = raw
+    return result
+
+
+def read_records(path: str, id_field: Optional[str] = None) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    """入力の JSONL から (レコードID, レコード) を順に返す（ID がなければ行番号を使う）"""
+    with open(path, encoding="utf-8") as f:
+        for line_number, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if id_field is not None:
+                record_id = record[id_field]
+            else:
+                record_id = next((record[key] for key in ID_FIELDS if record.get(key) is not None), f"line-{line_number}")
+            yield str(record_id), record
+
+
+def load_checkpoint(path: str) -> Set[str]:
+    """出力済みの JSONL から、成功したレコードの ID を集める
+    
+    中断で最後の行が途中までしか書かれていない場合は、その行を無視して改行を補う。
+    """
+    completed: Set[str] = set()
+    if not os.path.exists(path):
+        return completed
+    with open(path, "rb+") as f:
+        data = f.read()
+        if data and not data.endswith(b"\n"):
+            f.write(b"\n")
+    for line in data.decode("utf-8", errors="replace").splitlines():
+        try:
+            result = json.loads(line)
+        except ValueError:
+            continue
+        if result.get("ok"):
+            completed.add(str(result["id"]))
+    return completed
+
+
+def build_inputs(record: Dict[str, Any], mapping: Dict[str, str], params: Dict[str, Any]) -> Dict[str, Any]:
+    """レコードからサービスへの入力を作る（mapping がなければレコードをそのまま使い、params は既定値として足す）"""
+    inputs = dict(params)
+    if mapping:
+        for key, field in mapping.items():
+            if field not in record:
+                raise KeyError(f"レコードに {field} がありません")
+            inputs[key] = record[field]
+    else:
+        inputs.update(record)
+    return inputs
+
+
+def run_batch(
+    service: AIService,
+    input_path: str,
+    output_path: str,
+    mapping: Dict[str, str],
+    params: Dict[str, Any],
+    max_workers: int = 4,
+    id_field: Optional[str] = None,
+    progress_interval: float = 5.0,
+) -> Dict[str, int]:
+    """未処理のレコードを並列に処理し、完了した順に出力先へ追記する。件数の集計を返す"""
+    completed = load_checkpoint(output_path)
+    counts = {"skipped": 0, "succeeded": 0, "failed": 0}
+    
+    def pending() -> Iterator[Tuple[str, Dict[str, Any]]]:
+        for record_id, record in read_records(input_path, id_field):
+            if record_id in completed:
+                counts["skipped"] += 1
+                continue
+            yield record_id, record
+    
+    def process(item: Tuple[str, Dict[str, Any]]) -> Dict[str, Any]:
+        # 失敗した場合もレコードの ID を出力できるよう、例外はここで結果に変換する
+        record_id, record = item
+        started_at = time.perf_counter()
+        try:
+            with span(service.name, "batch", record_id=record_id):
+                result = service.run(build_inputs(record, mapping, params), allow_local_files=True)
+        except Exception as e:
+            return {"id": record_id, "ok": False, "error": f"{type(e).__name__}: {e}"}
+        return {"id": record_id, "ok": True, "result": result, "elapsed_seconds": round(time.perf_counter() - started_at, 3)}
+    
+    started_at = last_report = time.perf_counter()
+    # 全レコードを1つのセッションとして共有レートリミッタに並べる
+    with bind_session("batch"), open(output_path, "a", encoding="utf-8") as out:
+        for _, line, _ in run_bounded(process, pending(), max_workers=max_workers):
+            counts["succeeded" if line["ok"] else "failed"] += 1
+            # 1件ごとにディスクへ書き出し、中断しても完了分が失われないようにする
+            out.write(json.dumps(line, ensure_ascii=False, default=str) + "\n")
+            out.flush()
+            os.fsync(out.fileno())
+            
+            now = time.perf_counter()
+            if now - last_report >= progress_interval:
+                done = counts["succeeded"] + counts["failed"]
+                print(f"{done} 件完了（{done / (now - started_at):.1f} 件/秒, 失敗 {counts['failed']} 件）", file=sys.stderr)
+                last_report = now
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="JSONL のレコードを AI サービスで一括処理する")
+    parser.add_argument("input", nargs="?", help="入力の JSONL")
+    parser.add_argument("output", nargs="?", help="結果の JSONL（既存なら成功済みのレコードを飛ばして追記する）")
+    parser.add_argument("--service", help="サービス名（--list で一覧を表示）")
+    parser.add_argument("--list", action="store_true", help="バッチ実行できるサービスを表示する")
+    parser.add_argument("--map", action="append", metavar="INPUT=FIELD", help="レコードのフィールドをサービスの入力に割り当てる")
+    parser.add_argument("--param", action="append", metavar="INPUT=VALUE", help="全レコード共通の入力（値は JSON として解釈）")
+    parser.add_argument("--id-field", help="レコードの ID のフィールド（既定: id, request_id, 行番号の順）")
+    parser.add_argument("-j", "--max-workers", type=int, default=4, help="同時に処理するレコード数")
+    args = parser.parse_args()
+    
+    manager = get_service_manager()
+    if args.list:
+        for entry in manager.get_entries():
+            supported = type(entry.instance).run is not AIService.run
+            print(f"{entry.icon} {entry.name}{'' if supported else '（バッチ実行非対応）'}")
+        return
+    if not (args.service and args.input and args.output):
+        parser.error("--service・入力・出力を指定してください")
+    service = manager.get_service_by_name(args.service)
+    if service is None:
+        parser.error(f"サービスが見つかりません: {args.service}")
+    
+    counts = run_batch(
+        service,
+        args.input,
+        args.output,
+        mapping=parse_assignments(args.map),
+        params=parse_assignments(args.param, parse_json=True),
+        max_workers=args.max_workers,
+        id_field=args.id_field,
+    )
+    print(
+        f"成功 {counts['succeeded']} 件 / 失敗 {counts['failed']} 件 / 処理済みのため省略 {counts['skipped']} 件",
+        file=sys.stderr,
+    )
+    if counts["failed"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""bench.run の結果を2つ比較し、性能の悪化を検出する
+
+使い方:
+    python -m bench.compare bench/results/base.json bench/results/current.json --threshold 0.15
+
+いずれかのシナリオで悪化がしきい値を超えた場合は終了コード 1 を返す。
+"""
+import argparse
+import json
+import sys
+from typing import Any, Dict, List, Optional, Tuple
+
+# 比較する指標（結果JSON内のパス）
+METRICS = (
+    ("latency_ms", "p50"),
+    ("latency_ms", "p95"),
+    ("rerun_ms", "p50"),
+    ("peak_memory_kb", None),
+)
+
+# 計測のぶれで誤検知しないよう、この値未満の差は無視する（ms / KB）
+MIN_ABSOLUTE_DELTA = 20.0
+
+
+def _value(result: Dict[str, Any], metric: Tuple[str, Optional[str]]) -> Optional[float]:
+    key, sub = metric
+    value = result.get(key)
+    if sub is not None:
+        value = (value or {}).get(sub)
+    return value
+
+
+def compare(base: Dict[str, Any], current: Dict[str, Any], threshold: float) -> Tuple[List[Dict[str, Any]], List[str]]:
+    """指標ごとの比較結果と、しきい値を超えて悪化した項目の一覧を返す"""
+    rows, regressions = [], []
+    for name, result in current["scenarios"].items():
+        base_result = base["scenarios"].get(name)
+        if base_result is None:
+            continue
+        if result["errors"] and not base_result["errors"]:
+            regressions.append(f"{name}: エラーが発生しています（{result['errors'][0]}）")
+        
+        for metric in METRICS:
+            before, after = _value(base_result, metric), _value(result, metric)
+            if not before or after is None:
+                continue
+            change = (after - before) / before
+            label = ".".join(part for part in metric if part)
+            rows.append({"scenario": name, "metric": label, "base": before, "current": after, "change": change})
+            if change > threshold and after - before >= MIN_ABSOLUTE_DELTA:
+                regressions.append(f"{name} {label}: {before:.1f} → {after:.1f} (+{change:.0%})")
+    return rows, regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ベンチマーク結果を比較する")
+    parser.add_argument("base")
+    parser.add_argument("current")
+    parser.add_argument("--threshold", type=float, default=0.15, help="悪化とみなす変化率（既定: 15%%）")
+    args = parser.parse_args()
+    
+    with open(args.base, encoding="utf-8") as f:
+        base = json.load(f)
+    with open(args.current, encoding="utf-8") as f:
+        current = json.load(f)
+    
+    rows, regressions = compare(base, current, args.threshold)
+    print(f"{base.get('commit')} → {current.get('commit')}")
+    for row in rows:
+        print(f"{row['scenario']:<28} {row['metric']:<16} {row['base']:>10.1f} {row['current']:>10.1f} {row['change']:>+8.1%}")
+    
+    if regressions:
+        print("\n性能の悪化を検出しました:")
+        for regression in regressions:
+            print(f"  - {regression}")
+        sys.exit(1)
+    print("\n悪化はありません")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+"""HTTP API（api_server）に並列でリクエストを送り、スループットと p99 レイテンシを測る
+
+使い方:
+    python -m bench.load_test --service sentiment --requests 1000 --concurrency 64
+    python -m bench.load_test --service text-generation --distinct 20
+    python -m bench.load_test --url http://127.0.0.1:8000 --service sentiment
+
+--url を省略すると、ローカルスタブを上流にした API をこのプロセス内で起動する。
+"""
+import argparse
+import json
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Tuple
+
+import requests
+
+from bench.stubs import OpenAIStubHandler, StubConfig, parse_model_latency, serve
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def payload(service: str, index: int) -> Dict[str, Any]:
+    """index 番目のリクエストの本文（キャッシュを使わず、毎回上流を呼ぶ入力にする）"""
+    if service == "sentiment":
+        return {"text": f"負荷試験用のレビュー {index} の本文です", "local_threshold": 1.0, "use_cache": False}
+    if service == "text-generation":
+        return {"prompt": f"負荷試験用のプロンプト {index}", "max_tokens": 50, "use_cache": False}
+    raise ValueError(f"未対応のサービスです: {service}")
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_local_api(config: StubConfig, requests_per_minute: float, tokens_per_minute: float) -> str:
+    """スタブと API を起動し、API のベース URL を返す"""
+    _, openai_url = serve(OpenAIStubHandler, config)
+    os.environ["OPENAI_BASE_URL"] = f"{openai_url}/v1"
+    os.environ.setdefault("OPENAI_API_KEY", "stub")
+    os.environ["SYNAPSE_CACHE_DIR"] = tempfile.mkdtemp(prefix="synapse-load-")
+    # 共有レートリミッタの上限（アプリのモジュールを読み込む前に設定する）
+    os.environ["OPENAI_REQUESTS_PER_MINUTE"] = str(requests_per_minute)
+    os.environ["OPENAI_TOKENS_PER_MINUTE"] = str(tokens_per_minute)
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+    from api_server import start_api_server
+    
+    port = _free_port()
+    server = start_api_server(port, host="127.0.0.1")
+    deadline = time.monotonic() + 30
+    while not server.started:
+        if time.monotonic() > deadline:
+            raise RuntimeError("API が起動しませんでした")
+        time.sleep(0.05)
+    return f"http://127.0.0.1:{port}"
+
+
+def run_load(
+    url: str,
+    service: str,
+    total: int,
+    concurrency: int,
+    distinct: int,
+    timeout: float = 120.0,
+) -> Tuple[List[float], Counter, float]:
+    """total 件のリクエストを concurrency 並列で送り、(成功したリクエストのレイテンシ, ステータス別の件数, 所要秒数) を返す"""
+    local = threading.local()
+    endpoint = f"{url}/services/{service}"
+    
+    def send(index: int) -> Tuple[Any, float]:
+        session = getattr(local, "session", None)
+        if session is None:
+            session = local.session = requests.Session()
+        started_at = time.perf_counter()
+        try:
+            response = session.post(endpoint, json=payload(service, index % distinct), timeout=timeout)
+            status = response.status_code
+        except requests.RequestException as e:
+            status = type(e).__name__
+        return status, time.perf_counter() - started_at
+    
+    latencies: List[float] = []
+    statuses: Counter = Counter()
+    started_at = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for status, latency in executor.map(send, range(total)):
+            statuses[status] += 1
+            if status == 200:
+                latencies.append(latency * 1000)
+    return latencies, statuses, time.perf_counter() - started_at
+
+
+def main():
+    parser = argparse.ArgumentParser(description="HTTP API の負荷試験")
+    parser.add_argument("--url", help="起動済みの API のベース URL（省略時はスタブと API をこのプロセスで起動）")
+    parser.add_argument("--service", default="sentiment", choices=["sentiment", "text-generation"])
+    parser.add_argument("--requests", type=int, default=500, help="送信するリクエスト数")
+    parser.add_argument("--concurrency", type=int, default=32, help="同時に送信するリクエスト数")
+    parser.add_argument("--distinct", type=int, help="異なる本文の数（少なくすると同じリクエストの相乗りを確認できる）")
+    parser.add_argument("--warmup", type=int, default=10, help="計測前に送るリクエスト数")
+    parser.add_argument("--latency", type=float, default=0.2, help="スタブが最初に応答するまでの秒数")
+    parser.add_argument("--tokens-per-second", type=float, default=200.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--model-latency", action="append", metavar="MODEL=SECONDS", help="モデルごとの最初の応答までの秒数")
+    parser.add_argument("--rpm", type=float, default=100000, help="共有レートリミッタのリクエスト数/分（API をこのプロセスで起動する場合）")
+    parser.add_argument("--tpm", type=float, default=100000000, help="共有レートリミッタのトークン数/分（同上）")
+    parser.add_argument("--output", help="結果の JSON の保存先")
+    args = parser.parse_args()
+    
+    config = None
+    url = args.url
+    if url is None:
+        config = StubConfig(
+            args.latency,
+            args.tokens_per_second,
+            args.error_rate,
+            model_latency=parse_model_latency(args.model_latency),
+        )
+        url = start_local_api(config, args.rpm, args.tpm)
+    distinct = args.distinct or args.requests
+    
+    if args.warmup:
+        # 計測用とは別の本文で、接続・モジュールの読み込み・スレッドの起動を済ませておく
+        run_load(url, args.service, args.warmup, min(args.warmup, args.concurrency), args.warmup)
+    upstream_before = config.requests if config is not None else None
+    
+    # アプリのモジュールは SYNAPSE_CACHE_DIR を設定した後に読み込む
+    from metrics import percentile
+    
+    latencies, statuses, elapsed = run_load(url, args.service, args.requests, args.concurrency, distinct)
+    result = {
+        "service": args.service,
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        "distinct": distinct,
+        "elapsed_seconds": elapsed,
+        "rps": args.requests / elapsed,
+        "succeeded": len(latencies),
+        "statuses": {str(status): count for status, count in statuses.items()},
+        "latency_ms": {
+            "p50": percentile(latencies, 0.5),
+            "p95": percentile(latencies, 0.95),
+            "p99": percentile(latencies, 0.99),
+            "max": max(latencies) if latencies else 0.0,
+        },
+        "upstream_calls": config.requests - upstream_before if config is not None else None,
+    }
+    
+    print(
+        f"{args.service}: {result['rps']:.1f} req/s / p50={result['latency_ms']['p50']:.1f}ms "
+        f"p99={result['latency_ms']['p99']:.1f}ms / 成功 {result['succeeded']}/{args.requests}"
+        + (f" / 上流の呼び出し {result['upstream_calls']} 回" if config is not None else "")
+    )
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,372 @@
+"""ローカルスタブに対して各サービスとデモスクリプトを Streamlit の AppTest で実行し、性能を記録する
+
+使い方:
+    python -m bench.run --repeat 5 --output bench/results/current.json
+    python -m bench.compare bench/results/base.json bench/results/current.json
+
+AppTest は Streamlit 1.28 以降が必要。
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List, Optional
+
+from bench.stubs import OpenAIStubHandler, StubConfig, WebhookStubHandler, parse_model_latency, redirect_webhooks, serve
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MAIN_SCRIPT = os.path.join(ROOT, "main.py")
+
+# Webhook スタブの URL（main() で起動したときに設定する）
+webhook_stub_url = ""
+
+
+def _run_with_uploads(script_path, uploads):
+    # AppTest は file_uploader の操作に対応していないため、アップロード済みのファイルを差し込んで実行する
+    # （AppTest.from_function はこの関数のソースだけを実行するので、import は関数内で行う）
+    import io
+    import runpy
+    import streamlit as st
+    
+    class UploadedFile(io.BytesIO):
+        def __init__(self, name, data):
+            super().__init__(data)
+            self.name = name
+    
+    files = [UploadedFile(name, data) for name, data in uploads]
+    original = st.file_uploader
+    
+    def file_uploader(label, *args, accept_multiple_files=False, **kwargs):
+        for f in files:
+            f.seek(0)
+        return files if accept_multiple_files else (files[0] if files else None)
+    
+    st.file_uploader = file_uploader
+    try:
+        runpy.run_path(script_path, run_name="__main__")
+    finally:
+        st.file_uploader = original
+
+
+def _app(script_path: str = MAIN_SCRIPT, uploads: List[tuple] = None):
+    from streamlit.testing.v1 import AppTest
+    
+    if uploads is None:
+        at = AppTest.from_file(script_path, default_timeout=120)
+    else:
+        at = AppTest.from_function(_run_with_uploads, args=(script_path, uploads), default_timeout=120)
+    at.secrets["OPENAI_API_KEY"] = "sk-bench"
+    at.secrets["WEBHOOK_URL"] = webhook_stub_url
+    return at
+
+
+def _widget(widgets, label: str):
+    # 表示順に依存しないよう、ラベルの前方一致でウィジェットを探す
+    for widget in widgets:
+        if widget.label.startswith(label):
+            return widget
+    raise LookupError(f"ウィジェットが見つかりません: {label}")
+
+
+def _click(at, label: str):
+    _widget(at.button, label).click()
+
+
+def _check(at):
+    if at.exception:
+        raise RuntimeError(at.exception[0].message)
+
+
+def _open_service(at, name: str):
+    at.run()
+    at.session_state["current_service"] = name
+    at.run()
+    _check(at)
+
+
+def _image_bytes(seed: int, size=(1600, 1200)) -> bytes:
+    Image = __import__("PIL.Image", fromlist=["Image"])
+    import random
+    rng = random.Random(seed)
+    image = Image.new("RGB", size, tuple(rng.randrange(256) for _ in range(3)))
+    for _ in range(30):
+        x, y = rng.randrange(size[0]), rng.randrange(size[1])
+        image.paste(tuple(rng.randrange(256) for _ in range(3)), (x, y, min(size[0], x + 200), min(size[1], y + 200)))
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=95)
+    return buffer.getvalue()
+
+
+# --- シナリオ定義（準備した AppTest と、計測対象の操作を返す） ---
+
+def scenario_home(i: int):
+    at = _app()
+    return at, lambda: at.run()
+
+
+def _text_generation(i: int, stream: bool, bypass_cache: bool, prompt: Optional[str] = None):
+    at = _app()
+    _open_service(at, "AI文章生成")
+    at.text_area[0].input(prompt or "ベンチマーク用のプロンプト" + ("" if not bypass_cache else f" {i}"))
+    _widget(at.checkbox, "生成中の文章を逐次表示する").set_value(stream)
+    _widget(at.checkbox, "キャッシュを使わずに").set_value(bypass_cache)
+    return at, lambda: (_click(at, "文章を生成"), at.run())
+
+
+def scenario_text_generation_stream(i: int):
+    return _text_generation(i, stream=True, bypass_cache=True)
+
+
+def scenario_text_generation_blocking(i: int):
+    return _text_generation(i, stream=False, bypass_cache=True)
+
+
+def scenario_text_generation_cached(i: int):
+    return _text_generation(i, stream=False, bypass_cache=False)
+
+
+def scenario_text_generation_near_duplicate(i: int):
+    # 空白・句読点だけが異なるプロンプト（2回目以降は類似プロンプトのキャッシュにヒットする）
+    prompt = "来期の 売上計画について、" + " " * (i % 3) + "要点を箇条書きで まとめてください" + "。！"[i % 2]
+    return _text_generation(i, stream=False, bypass_cache=False, prompt=prompt)
+
+
+def scenario_text_generation_map_reduce(i: int):
+    # 長文モードで、6つ程度に分割される文書を要約する
+    document = "\n\n".join(f"第{n}章 ベンチマーク {i} の文書です。" + "本文の内容が続きます。" * 20 for n in range(12))
+    at, action = _text_generation(i, stream=False, bypass_cache=True, prompt=document)
+    _widget(at.checkbox, "長文モード").check()
+    at.run()
+    _widget(at.slider, "1回に送る文書の長さ").set_value(500)
+    return at, action
+
+
+def scenario_text_generation_chat(i: int):
+    # 数ターン会話した後の1ターンを計測する（送信する履歴が長くなった状態）
+    at = _app()
+    _open_service(at, "AI文章生成")
+    _widget(at.radio, "モード").set_value("チャット")
+    at.run()
+    for n in range(3):
+        at.chat_input[0].set_value(f"ベンチマークの会話 {i}-{n}").run()
+    _check(at)
+    return at, lambda: at.chat_input[0].set_value(f"ベンチマークの質問 {i}").run()
+
+
+def _sentiment(text: str, threshold: float):
+    at = _app()
+    _open_service(at, "テキスト感情分析")
+    _widget(at.slider, "ローカル判定の信頼度").set_value(threshold)
+    at.text_area[0].input(text)
+    return at, lambda: (_click(at, "感情を分析"), at.run())
+
+
+def scenario_sentiment_local(i: int):
+    return _sentiment("最高です！とても嬉しい", 0.5)
+
+
+def scenario_sentiment_llm(i: int):
+    return _sentiment(f"今日の会議の議事録です {i}", 1.0)
+
+
+def scenario_sentiment_bulk(i: int):
+    rows = "\n".join(f"レビュー {i}-{n} の本文です" for n in range(50))
+    at = _app(uploads=[("reviews.csv", ("text\n" + rows).encode("utf-8"))])
+    _open_service(at, "テキスト感情分析")
+    _widget(at.slider, "ローカル判定の信頼度").set_value(1.0)
+    _widget(at.radio, "分析モード").set_value("ファイル一括分析（CSV/JSONL）")
+    at.run()
+    _widget(at.number_input, "1分あたりの最大リクエスト数").set_value(10000)
+    return at, lambda: (_click(at, "一括分析を開始"), at.run())
+
+
+def scenario_image_caption(i: int):
+    at = _app(uploads=[("photo.jpg", _image_bytes(1000 + i))])
+    _open_service(at, "画像説明生成")
+    return at, lambda: (_click(at, "画像の説明を生成"), at.run())
+
+
+def scenario_image_caption_batch(i: int):
+    uploads = [(f"item_{n}.jpg", _image_bytes(i * 100 + n, size=(800, 600))) for n in range(10)]
+    at = _app(uploads=uploads)
+    _open_service(at, "画像説明生成")
+    _widget(at.radio, "処理モード").set_value("一括（複数ファイル・ZIP）")
+    at.run()
+    return at, lambda: (_click(at, "一括で説明文を生成"), at.run())
+
+
+def scenario_sns_demo(i: int):
+    at = _app(os.path.join(ROOT, "sns_demo.py"))
+    at.run()
+    _widget(at.text_input, "キーワード").input(f"ベンチマーク {i}")
+    return at, lambda: (_click(at, "送信"), at.run())
+
+
+def scenario_zoom_demo(i: int):
+    at = _app(os.path.join(ROOT, "demo_zoom.py"))
+    at.run()
+    _widget(at.text_input, "タイトル").input(f"ベンチマーク会議 {i}")
+    return at, lambda: (_click(at, "送信"), at.run())
+
+
+def scenario_youtube_demo(i: int):
+    at = _app(os.path.join(ROOT, "youtubeSum_demo.py"))
+    at.run()
+    _widget(at.text_input, "YouTube URL").input(f"https://www.youtube.com/watch?v=bench{i:06d}")
+    
+    def action():
+        _click(at, "送信")
+        at.run()
+        # 要約ジョブが完了するまで再実行を続ける
+        deadline = time.time() + 60
+        while not at.success and time.time() < deadline:
+            at.run()
+    return at, action
+
+
+def scenario_test2_text_generation(i: int):
+    at = _app(os.path.join(ROOT, "test2.py"))
+    _open_service(at, "AI文章生成")
+    at.text_area[0].input(f"ベンチマーク用のプロンプト {i}")
+    return at, lambda: (_click(at, "文章を生成"), at.run())
+
+
+SCENARIOS: Dict[str, Callable[[int], Any]] = {
+    "home": scenario_home,
+    "text_generation_stream": scenario_text_generation_stream,
+    "text_generation_blocking": scenario_text_generation_blocking,
+    "text_generation_cached": scenario_text_generation_cached,
+    "text_generation_near_duplicate": scenario_text_generation_near_duplicate,
+    "text_generation_map_reduce": scenario_text_generation_map_reduce,
+    "text_generation_chat": scenario_text_generation_chat,
+    "sentiment_local": scenario_sentiment_local,
+    "sentiment_llm": scenario_sentiment_llm,
+    "sentiment_bulk_50": scenario_sentiment_bulk,
+    "image_caption": scenario_image_caption,
+    "image_caption_batch_10": scenario_image_caption_batch,
+    "sns_demo": scenario_sns_demo,
+    "zoom_demo": scenario_zoom_demo,
+    "youtube_demo": scenario_youtube_demo,
+    "test2_text_generation": scenario_test2_text_generation,
+}
+
+
+def _summary(values: List[float]) -> Dict[str, float]:
+    # アプリのモジュールは SYNAPSE_CACHE_DIR を設定した後に読み込む
+    from metrics import percentile
+    
+    if not values:
+        return {}
+    return {
+        "mean": sum(values) / len(values),
+        "p50": percentile(values, 0.5),
+        "p95": percentile(values, 0.95),
+        "min": min(values),
+        "max": max(values),
+    }
+
+
+def run_scenario(name: str, repeat: int) -> Dict[str, Any]:
+    """シナリオを repeat 回実行し、操作のレイテンシ・直後の再実行時間・メモリを集計する"""
+    latencies, reruns, peaks, errors = [], [], [], []
+    for i in range(repeat):
+        try:
+            at, action = SCENARIOS[name](i)
+            
+            tracemalloc.reset_peak()
+            started_at = time.perf_counter()
+            action()
+            latencies.append((time.perf_counter() - started_at) * 1000)
+            peaks.append(tracemalloc.get_traced_memory()[1] / 1024)
+            _check(at)
+            
+            # 操作後に何も入力せず再実行したときの時間（Streamlit の再実行コスト）
+            started_at = time.perf_counter()
+            at.run()
+            reruns.append((time.perf_counter() - started_at) * 1000)
+        except Exception as e:
+            errors.append(f"{type(e).__name__}: {e}")
+    return {
+        "latency_ms": _summary(latencies),
+        "rerun_ms": _summary(reruns),
+        "peak_memory_kb": max(peaks) if peaks else None,
+        "runs": len(latencies),
+        "errors": errors,
+    }
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ローカルスタブを使ったベンチマークを実行する")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", help="結果のJSONの保存先（既定: bench/results/<commit>.json）")
+    parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS), help="実行するシナリオ（複数指定可）")
+    parser.add_argument("--latency", type=float, default=0.2, help="スタブが最初に応答するまでの秒数")
+    parser.add_argument("--tokens-per-second", type=float, default=200.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--model-latency", action="append", metavar="MODEL=SECONDS", help="モデルごとの最初の応答までの秒数")
+    args = parser.parse_args()
+    
+    model_latency = parse_model_latency(args.model_latency)
+    config = StubConfig(args.latency, args.tokens_per_second, args.error_rate, model_latency=model_latency)
+    _, openai_url = serve(OpenAIStubHandler, config)
+    _, webhook_url = serve(WebhookStubHandler, config)
+    os.environ["OPENAI_BASE_URL"] = f"{openai_url}/v1"
+    # キャッシュ・キュー・メトリクスは毎回空の状態から計測する
+    os.environ["SYNAPSE_CACHE_DIR"] = tempfile.mkdtemp(prefix="synapse-bench-")
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+    global webhook_stub_url
+    webhook_stub_url = f"{webhook_url}/hook"
+    redirect_webhooks(webhook_stub_url)
+    
+    commit = _git_commit()
+    results = {
+        "commit": commit,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "config": {
+            "repeat": args.repeat,
+            "latency": args.latency,
+            "tokens_per_second": args.tokens_per_second,
+            "error_rate": args.error_rate,
+            "model_latency": model_latency,
+        },
+        "scenarios": {},
+    }
+    
+    tracemalloc.start()
+    for name in args.scenario or SCENARIOS:
+        result = run_scenario(name, args.repeat)
+        results["scenarios"][name] = result
+        latency = result["latency_ms"].get("p50")
+        status = f"p50={latency:.1f}ms" if latency is not None else "失敗"
+        print(f"{name:<28} {status}  errors={len(result['errors'])}", flush=True)
+    tracemalloc.stop()
+    # Linux では KB、macOS では bytes 単位
+    results["max_rss"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    
+    output = args.output or os.path.join(ROOT, "bench", "results", f"{commit}.json")
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    print(f"結果を保存しました: {output}")
+
+
+if __name__ == "__main__":
+    main()
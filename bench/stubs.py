@@ -0,0 +1,263 @@
+"""OpenAI 互換 API と Make.com Webhook のローカルスタブ
+
+使い方:
+    python -m bench.stubs --openai-port 8901 --webhook-port 8902 --latency 0.3 --tokens-per-second 80
+    
+    python -m bench.stubs --app main.py
+
+--app を指定すると、OpenAI の送信先と Webhook の送信先をスタブに差し替え、同じプロセスで Streamlit アプリを起動する。
+外部サービスなしで動作を確認できる。省略した場合はスタブだけを起動する。その場合は表示される OPENAI_BASE_URL を設定してアプリを起動する。
+"""
+import argparse
+import json
+import os
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+
+# 応答として返す文章（1語 = 1トークンとして扱う）
+REPLY_WORDS = (
+    "これは ローカル スタブ による 応答 です 。 ベンチマーク 用 に 一定 の 速度 で "
+    "トークン を 返し ます 。"
+).split()
+
+
+# スタブの動作設定（レイテンシ・トークン生成速度・エラー率）
+class StubConfig:
+    def __init__(
+        self,
+        latency: float = 0.2,
+        tokens_per_second: float = 100.0,
+        error_rate: float = 0.0,
+        max_reply_tokens: int = 200,
+        seed: int = 0,
+        model_latency: Optional[Dict[str, float]] = None,
+    ):
+        self.latency = latency
+        # モデルごとに最初の応答までの秒数を変える（ルーターのヘッジの確認用）
+        self.model_latency = model_latency or {}
+        self.tokens_per_second = tokens_per_second
+        self.error_rate = error_rate
+        self.max_reply_tokens = max_reply_tokens
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+    
+    def latency_for(self, model: Optional[str]) -> float:
+        return self.model_latency.get(model, self.latency)
+    
+    def should_fail(self) -> bool:
+        with self.lock:
+            self.requests += 1
+            return self.random.random() < self.error_rate
+
+
+# スタブ共通の HTTP ハンドラ
+class _StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    
+    def log_message(self, format, *args):
+        pass
+    
+    @property
+    def config(self) -> StubConfig:
+        return self.server.config
+    
+    def _read_json(self) -> Dict[str, Any]:
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length) if length else b""
+        try:
+            return json.loads(raw or b"{}")
+        except ValueError:
+            return {}
+    
+    def _send(self, status: int, body: bytes, content_type: str = "application/json"):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def _send_json(self, status: int, payload: Any):
+        self._send(status, json.dumps(payload, ensure_ascii=False).encode("utf-8"))
+
+
+# Chat Completions API（ストリーミング・JSONモードを含む）のスタブ
+class OpenAIStubHandler(_StubHandler):
+    def do_POST(self):
+        body = self._read_json()
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self._send_json(404, {"error": {"message": "not found", "type": "invalid_request_error"}})
+            return
+        
+        model = body.get("model", "stub")
+        time.sleep(self.config.latency_for(model))
+        if self.config.should_fail():
+            self._send_json(500, {"error": {"message": "stub error", "type": "server_error"}})
+            return
+        
+        words = self._reply_words(body)
+        usage = {"prompt_tokens": self._prompt_tokens(body), "completion_tokens": len(words)}
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        if body.get("stream"):
+            self._stream(model, words, usage, body.get("stream_options") or {})
+        else:
+            time.sleep(len(words) / self.config.tokens_per_second)
+            self._send_json(200, {
+                "id": "chatcmpl-stub",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": "".join(words)},
+                    "finish_reason": "stop",
+                }],
+                "usage": usage,
+            })
+    
+    def _reply_words(self, body: Dict[str, Any]):
+        # JSONモード / Structured Outputs の場合は感情分析の形式で返す
+        if body.get("response_format"):
+            return [json.dumps({"score": 7, "sentiment": "positive", "explanation": "スタブによる判定です"}, ensure_ascii=False)]
+        count = min(body.get("max_tokens") or self.config.max_reply_tokens, self.config.max_reply_tokens)
+        return [REPLY_WORDS[i % len(REPLY_WORDS)] for i in range(count)]
+    
+    @staticmethod
+    def _prompt_tokens(body: Dict[str, Any]) -> int:
+        total = 0
+        for message in body.get("messages", []):
+            content = message.get("content")
+            if isinstance(content, str):
+                total += len(content)
+            elif isinstance(content, list):
+                total += sum(len(part.get("text", "")) for part in content if isinstance(part, dict))
+        return total
+    
+    def _stream(self, model: str, words, usage: Dict[str, int], stream_options: Dict[str, Any]):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        
+        def send_event(payload):
+            data = f"data: {payload}\n\n".encode("utf-8")
+            self.wfile.write(f"{len(data):X}\r\n".encode("ascii") + data + b"\r\n")
+            self.wfile.flush()
+        
+        interval = 1.0 / self.config.tokens_per_second
+        try:
+            for word in words:
+                time.sleep(interval)
+                send_event(json.dumps({
+                    "id": "chatcmpl-stub",
+                    "object": "chat.completion.chunk",
+                    "created": int(time.time()),
+                    "model": model,
+                    "choices": [{"index": 0, "delta": {"content": word}, "finish_reason": None}],
+                }, ensure_ascii=False))
+            if stream_options.get("include_usage"):
+                send_event(json.dumps({
+                    "id": "chatcmpl-stub",
+                    "object": "chat.completion.chunk",
+                    "created": int(time.time()),
+                    "model": model,
+                    "choices": [],
+                    "usage": usage,
+                }))
+            send_event("[DONE]")
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            # クライアント側で中止された
+            pass
+
+
+# Make.com Webhook のスタブ
+class WebhookStubHandler(_StubHandler):
+    def do_POST(self):
+        body = self._read_json()
+        time.sleep(self.config.latency)
+        if self.config.should_fail():
+            self._send_json(503, {"error": "stub error"})
+            return
+        
+        # YouTube要約のシナリオは HTML を返す
+        if "youtubeURL" in body:
+            html = f"<!DOCTYPE html><html><body><h1>要約</h1><p>{body['youtubeURL']} の要約です。</p></body></html>"
+            self._send(200, html.encode("utf-8"), "text/html; charset=utf-8")
+            return
+        self._send_json(200, {"ok": True, "join_url": "https://zoom.example.com/j/000000", "received": body})
+
+
+def serve(handler_cls, config: StubConfig, port: int = 0) -> Tuple[ThreadingHTTPServer, str]:
+    """スタブをバックグラウンドスレッドで起動し、(サーバー, ベースURL) を返す"""
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler_cls)
+    server.daemon_threads = True
+    server.config = config
+    threading.Thread(target=server.serve_forever, name=handler_cls.__name__, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def redirect_webhooks(url: str):
+    """WebhookClient の送信をすべて url へ送るように差し替える（アプリのコードは変えずにスタブへ送るため）
+    
+    webhook_client を読み込むため、SYNAPSE_CACHE_DIR などの環境変数を設定した後に呼ぶ。
+    """
+    from webhook_client import WebhookClient
+    
+    post_json = WebhookClient.post_json
+    
+    def post_to_stub(self, _url, data, *args, **kwargs):
+        return post_json(self, url, data, *args, **kwargs)
+    
+    WebhookClient.post_json = post_to_stub
+
+
+def parse_model_latency(values: Optional[List[str]]) -> Dict[str, float]:
+    """--model-latency gpt-4=2.0 の形式の指定を辞書にする"""
+    result = {}
+    for value in values or []:
+        model, _, seconds = value.partition("=")
+        result[model] = float(seconds)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="OpenAI / Webhook のローカルスタブを起動する")
+    parser.add_argument("--openai-port", type=int, default=8901)
+    parser.add_argument("--webhook-port", type=int, default=8902)
+    parser.add_argument("--latency", type=float, default=0.2, help="最初の応答までの秒数")
+    parser.add_argument("--tokens-per-second", type=float, default=100.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--model-latency", action="append", metavar="MODEL=SECONDS", help="モデルごとの最初の応答までの秒数")
+    parser.add_argument("--app", help="スタブに送るよう差し替えて同じプロセスで起動する Streamlit アプリのスクリプト")
+    args = parser.parse_args()
+    
+    config = StubConfig(
+        args.latency,
+        args.tokens_per_second,
+        args.error_rate,
+        model_latency=parse_model_latency(args.model_latency),
+    )
+    _, openai_url = serve(OpenAIStubHandler, config, args.openai_port)
+    _, webhook_url = serve(WebhookStubHandler, config, args.webhook_port)
+    print(f"OPENAI_BASE_URL={openai_url}/v1")
+    print(f"Webhook: {webhook_url}/hook")
+    if args.app:
+        from streamlit.web import bootstrap
+        
+        os.environ["OPENAI_BASE_URL"] = f"{openai_url}/v1"
+        redirect_webhooks(f"{webhook_url}/hook")
+        bootstrap.run(args.app, False, [], {})
+        return
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+from typing import Any, Callable, Dict, List, Tuple
+
+from rate_limit import estimate_text_tokens
+
+# 会話の1ターン（role, 本文, 推定トークン数）。セッションごとに溜まるため辞書ではなくタプルで持つ
+Turn = Tuple[str, str, int]
+
+
+# 1セッション分の会話の履歴と、古いターンをまとめた要約
+# （送信する履歴は「要約 + 要約していない直近のターン」だけなので、会話が長くなってもトークン数は一定に収まる）
+class ChatMemory:
+    def __init__(self, summarize_threshold: int = 1500, keep_recent: int = 4, max_bytes: int = 256 * 1024):
+        self.summarize_threshold = summarize_threshold
+        self.keep_recent = keep_recent
+        self.max_bytes = max_bytes
+        self.summary = ""
+        self.turns: List[Turn] = []
+        self.evicted = 0
+        # turns[:_folded] は要約済み（表示のためだけに残している）
+        self._folded = 0
+        self._context_tokens = 0
+        self._bytes = 0
+    
+    def add(self, role: str, text: str):
+        """ターンを追加する（保持量が上限を超えたら、要約済みのターンから古い順に捨てる）"""
+        # メッセージごとの区切りの分を足す
+        tokens = estimate_text_tokens(text) + 4
+        self.turns.append((role, text, tokens))
+        self._context_tokens += tokens
+        self._bytes += len(text.encode("utf-8"))
+        self._evict()
+    
+    def history(self) -> List[Tuple[str, str]]:
+        """表示用に、保持しているターンを (role, 本文) で返す"""
+        return [(role, text) for role, text, _ in self.turns]
+    
+    def context_messages(self, system_prompt: str) -> List[Dict[str, str]]:
+        """API に送る履歴（システムプロンプト・要約・要約していないターン）を返す"""
+        messages = [{"role": "system", "content": system_prompt}]
+        if self.summary:
+            messages.append({"role": "system", "content": f"これまでの会話の要約:\n{self.summary}"})
+        messages.extend({"role": role, "content": text} for role, text, _ in self.turns[self._folded:])
+        return messages
+    
+    def needs_fold(self) -> bool:
+        """要約していないターンが閾値を超え、直近のターン以外に要約できるものがあるか"""
+        return self._context_tokens > self.summarize_threshold and len(self.turns) - self._folded > self.keep_recent
+    
+    def fold(self, summarize: Callable[[str, List[Tuple[str, str]]], str]):
+        """直近 keep_recent 件より前のターンを、summarize(これまでの要約, ターン) が返す新しい要約にまとめる
+        
+        summarize が例外を送出した場合は何も変更しない（次のターンの後に再試行できる）。
+        """
+        end = len(self.turns) - self.keep_recent
+        if end <= self._folded:
+            return
+        old = self.turns[self._folded:end]
+        self.summary = summarize(self.summary, [(role, text) for role, text, _ in old])
+        self._context_tokens -= sum(tokens for _, _, tokens in old)
+        self._folded = end
+        self._evict()
+    
+    def stats(self) -> Dict[str, Any]:
+        """次に送る履歴の推定トークン数・要約済み（捨てた分を含む）と要約していないターン数・保持しているバイト数を返す"""
+        summary_tokens = estimate_text_tokens(self.summary) + 4 if self.summary else 0
+        return {
+            "context_tokens": self._context_tokens + summary_tokens,
+            "folded": self._folded + self.evicted,
+            "unfolded": len(self.turns) - self._folded,
+            "bytes": self._bytes + len(self.summary.encode("utf-8")),
+            "evicted": self.evicted,
+        }
+    
+    def _evict(self):
+        # 要約前のターンは文脈として必要なため、上限を超えていても捨てない
+        drop = 0
+        while self._bytes > self.max_bytes and drop < self._folded:
+            self._bytes -= len(self.turns[drop][1].encode("utf-8"))
+            drop += 1
+        if drop:
+            del self.turns[:drop]
+            self._folded -= drop
+            self.evicted += drop
@@ -1,9 +1,9 @@
 import streamlit as st
-import requests
-import json
 from datetime import datetime, timedelta
 import time
 
+from outbox import get_outbox, render_outbox_status
+
 def main():
     st.title("ZOOM予約Demo by Synapse Works")
     
@@ -46,21 +46,16 @@ def main():
             if email:
                 data["email"] = email
             
-            # Webhookに送信
+            # 送信キューに積み、Webhookへの送信はバックグラウンドで行う
             try:
                 webhook_url = "https://hook.us2.make.com/bygwi3rthep6sv5tla5jqgqu7xuoyqhe"
-                headers = {"Content-Type": "application/json"}
-                response = requests.post(webhook_url, data=json.dumps(data), headers=headers)
-                
-                if response.status_code == 200:
-                    st.success("予約情報が正常に送信されました。")
-                    # 成功メッセージを表示するのみ
-                    # 古い実験的APIは削除
-                else:
-                    st.error(f"エラーが発生しました。ステータスコード: {response.status_code}")
-                    st.error(f"レスポンス: {response.text}")
+                item_id = get_outbox().enqueue(webhook_url, data)
+                st.success(f"予約情報を受け付けました（受付番号: {item_id}）。まもなく送信されます。")
             except Exception as e:
                 st.error(f"送信中にエラーが発生しました: {str(e)}")
+    
+    # 送信キューの状態
+    render_outbox_status(get_outbox())
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,105 @@
+import threading
+from collections import OrderedDict
+from io import BytesIO
+from typing import Any, Dict, Optional, Tuple
+
+from providers import lazy_import
+
+
+def _grayscale(image_data: bytes, size: Tuple[int, int]):
+    Image = lazy_import("PIL.Image")
+    ImageOps = lazy_import("PIL.ImageOps")
+    image = ImageOps.exif_transpose(Image.open(BytesIO(image_data)))
+    return image.convert("L").resize(size, Image.LANCZOS)
+
+
+def dhash(image_data: bytes, hash_size: int = 8) -> int:
+    """差分ハッシュ（隣り合う画素の明暗の大小関係）を返す"""
+    image = _grayscale(image_data, (hash_size + 1, hash_size))
+    pixels = list(image.getdata())
+    value = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            left = pixels[row * (hash_size + 1) + col]
+            right = pixels[row * (hash_size + 1) + col + 1]
+            value = (value << 1) | int(left > right)
+    return value
+
+
+def ahash(image_data: bytes, hash_size: int = 8) -> int:
+    """平均ハッシュ（各画素が平均より明るいか）を返す"""
+    pixels = list(_grayscale(image_data, (hash_size, hash_size)).getdata())
+    average = sum(pixels) / len(pixels)
+    value = 0
+    for pixel in pixels:
+        value = (value << 1) | int(pixel > average)
+    return value
+
+
+def fingerprint(image_data: bytes) -> Tuple[int, int]:
+    """画像の知覚ハッシュ (dHash, aHash) を返す"""
+    return dhash(image_data), ahash(image_data)
+
+
+def hamming_distance(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+# 知覚ハッシュをキーにした画像説明文のキャッシュ（ほぼ同じ画像にもヒットする）
+class PerceptualHashCache:
+    def __init__(self, max_entries: int = 512, max_distance: int = 5):
+        self.max_entries = max_entries
+        self.max_distance = max_distance
+        # (dHash, aHash) -> 説明文
+        self._entries: "OrderedDict[Tuple[int, int], str]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"exact_hits": 0, "near_hits": 0, "misses": 0, "evictions": 0}
+    
+    def lookup(self, key: Tuple[int, int], max_distance: Optional[int] = None) -> Optional[Tuple[str, int]]:
+        """ハミング距離が max_distance 以内の画像があれば (説明文, 距離) を返す
+        
+        dHash と aHash の両方が距離内にある場合のみ一致とみなし、誤ヒットを抑える。
+        距離は dHash と aHash の距離の大きい方（両方とも一致した場合だけ 0）。
+        """
+        if max_distance is None:
+            max_distance = self.max_distance
+        d_key, a_key = key
+        with self._lock:
+            caption = self._entries.get(key)
+            if caption is not None:
+                self._entries.move_to_end(key)
+                self._stats["exact_hits"] += 1
+                return caption, 0
+            
+            best = None
+            for (d_hash, a_hash), caption in self._entries.items():
+                distance = max(hamming_distance(d_hash, d_key), hamming_distance(a_hash, a_key))
+                if distance > max_distance:
+                    continue
+                if best is None or distance < best[2]:
+                    best = ((d_hash, a_hash), caption, distance)
+            if best is None:
+                self._stats["misses"] += 1
+                return None
+            self._entries.move_to_end(best[0])
+            self._stats["near_hits"] += 1
+            return best[1], best[2]
+    
+    def store(self, key: Tuple[int, int], caption: str):
+        """説明文を保存（上限を超えたら最も使われていないものから削除）"""
+        with self._lock:
+            self._entries[key] = caption
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._stats["evictions"] += 1
+    
+    def stats(self) -> Dict[str, Any]:
+        """ヒット数（完全一致・類似）・ミス数・ヒット率・保存件数を返す"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._entries)
+        hits = stats["exact_hits"] + stats["near_hits"]
+        total = hits + stats["misses"]
+        stats["hit_rate"] = hits / total if total else 0.0
+        return stats
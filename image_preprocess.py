@@ -0,0 +1,94 @@
+import base64
+from io import BytesIO
+from typing import Any, Dict
+
+from providers import lazy_import
+
+# Vision API（detail=high）は長辺2048px・短辺768pxに収まるよう縮小してから処理するため、
+# それを超える解像度は送信しても結果が変わらず、アップロード時間と画像トークンが増えるだけになる
+MAX_LONG_SIDE = 2048
+MAX_SHORT_SIDE = 768
+
+# 再エンコード後の目標サイズ
+DEFAULT_BYTE_BUDGET = 300 * 1024
+
+MIME_TYPES = {"JPEG": "image/jpeg", "WEBP": "image/webp"}
+
+
+def prepare_image(data: bytes, byte_budget: int = DEFAULT_BYTE_BUDGET, image_format: str = "JPEG") -> Dict[str, Any]:
+    """画像を Vision API に送る前に縮小・再エンコードし、EXIF を取り除く
+    
+    返り値の data が送信用のバイト列。元のサイズや解像度も合わせて返す。
+    """
+    Image = lazy_import("PIL.Image")
+    ImageOps = lazy_import("PIL.ImageOps")
+    
+    image = Image.open(BytesIO(data))
+    original_width, original_height = image.size
+    # EXIF の回転情報を画素に反映してから、メタデータなしで保存する
+    image = ImageOps.exif_transpose(image)
+    
+    # 透過画像は白背景に合成して RGB にする
+    if image.mode in ("RGBA", "LA", "P"):
+        image = image.convert("RGBA")
+        background = Image.new("RGB", image.size, (255, 255, 255))
+        background.paste(image, mask=image.split()[-1])
+        image = background
+    elif image.mode != "RGB":
+        image = image.convert("RGB")
+    
+    long_side, short_side = max(image.size), min(image.size)
+    scale = min(1.0, MAX_LONG_SIDE / long_side, MAX_SHORT_SIDE / short_side)
+    
+    # 目標サイズに収まるまで品質を下げ、それでも大きければ解像度も下げる
+    for _ in range(4):
+        if scale < 1.0:
+            size = (max(1, int(image.width * scale)), max(1, int(image.height * scale)))
+            resized = image.resize(size, Image.LANCZOS)
+        else:
+            resized = image
+        for quality in (85, 75, 65, 55, 45):
+            buffer = BytesIO()
+            resized.save(buffer, format=image_format, quality=quality, optimize=True)
+            if buffer.tell() <= byte_budget:
+                break
+        if buffer.tell() <= byte_budget:
+            break
+        scale *= 0.75
+    
+    return {
+        "data": buffer.getvalue(),
+        "mime": MIME_TYPES[image_format],
+        "width": resized.width,
+        "height": resized.height,
+        "quality": quality,
+        "original_bytes": len(data),
+        "original_width": original_width,
+        "original_height": original_height,
+    }
+
+
+def decode_image(encoded: str, image_format: str = "JPEG") -> bytes:
+    """base64 の画像を復号し、画像として読み込めて image_format で再エンコードできることを確かめる
+    
+    どれかに失敗した場合は ValueError を送出する。
+    """
+    Image = lazy_import("PIL.Image")
+    
+    if image_format not in MIME_TYPES:
+        raise ValueError(f"image_format は {', '.join(MIME_TYPES)} のいずれかで指定してください")
+    try:
+        data = base64.b64decode(encoded, validate=True)
+    except (TypeError, ValueError):
+        raise ValueError("image_base64 を base64 として復号できません") from None
+    try:
+        Image.open(BytesIO(data)).verify()
+    except (OSError, SyntaxError) as e:
+        raise ValueError(f"画像として読み込めません: {e}") from None
+    return data
+
+
+def to_data_url(prepared: Dict[str, Any]) -> str:
+    """prepare_image の結果を data URL に変換"""
+    encoded = base64.b64encode(prepared["data"]).decode("ascii")
+    return f"data:{prepared['mime']};base64,{encoded}"
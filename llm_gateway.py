@@ -0,0 +1,422 @@
+import contextvars
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from model_router import AUTO_MODEL, get_router
+from outbound import CallAbandoned, raise_if_abandoned
+from providers import get_openai_client, lazy_import
+from rate_limit import estimate_prompt_tokens, estimate_tokens, get_rate_limiter
+from single_flight import Flight, FlightCancelled, get_single_flight, request_key
+from structured_output import adapt_response_format
+from tracing import request_bytes, response_bytes, span
+
+# 429 や一時的な障害の場合に順番を待ち直して再試行する回数
+MAX_ATTEMPTS = 3
+
+# 5xx や接続エラーの場合に再試行するまでの秒数（試行ごとに倍にする）
+TRANSIENT_BACKOFF = 0.5
+
+# Retry-After がない 429 の場合に全セッションの発行を止める秒数
+DEFAULT_RETRY_AFTER = 5.0
+
+WaitCallback = Callable[[float], None]
+
+# ヘッジした呼び出しを並行して実行するスレッド（少ないと空き待ちの間に主モデルが遅れたとみなされ、
+# 不要なヘッジが起きるため多めにする。スレッドは必要な分だけ作られる）
+_hedge_executor = ThreadPoolExecutor(max_workers=256, thread_name_prefix="llm-hedge")
+
+
+def _retry_after_seconds(error: Exception) -> float:
+    response = getattr(error, "response", None)
+    value = response.headers.get("retry-after") if response is not None else None
+    try:
+        return float(value) if value else DEFAULT_RETRY_AFTER
+    except ValueError:
+        return DEFAULT_RETRY_AFTER
+
+
+def _is_transient(error: Exception) -> bool:
+    """5xx や接続エラーなど、時間をおけば成功する可能性のあるエラーか"""
+    status_code = getattr(error, "status_code", None)
+    if status_code is not None:
+        return status_code >= 500
+    return isinstance(error, lazy_import("openai").APIConnectionError)
+
+
+def _create_with_backoff(kwargs: Dict[str, Any], estimated: int, on_wait: Optional[WaitCallback]):
+    """API を呼び出し、429 や一時的な障害の場合は順番を待ち直して再試行する
+    
+    クライアント側の再試行は無効にしてあるため、再試行はすべてここでレートリミッタを通して行う。
+    429 の場合は全セッションの発行も止める。
+    """
+    limiter = get_rate_limiter()
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        # 順番を待つ間に呼び出し元が結果を待たなくなっていれば、API を呼ばずにやめる
+        raise_if_abandoned()
+        try:
+            return get_openai_client().chat.completions.create(**kwargs)
+        except Exception as e:
+            throttled = getattr(e, "status_code", None) == 429
+            if not (throttled or _is_transient(e)) or attempt == MAX_ATTEMPTS:
+                raise
+            if throttled:
+                limiter.pause(_retry_after_seconds(e))
+            else:
+                time.sleep(TRANSIENT_BACKOFF * 2 ** (attempt - 1))
+            limiter.acquire(estimated, on_wait=on_wait)
+            if on_wait is not None:
+                on_wait(0.0)
+
+
+def route(kwargs: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """model="auto" の場合はモデルを選び、(主モデル, 予備モデル) の順に呼び出し内容を返す
+    
+    モデルが指定されている場合はそのモデルだけを返す。
+    """
+    if kwargs.get("model") != AUTO_MODEL:
+        return [kwargs]
+    max_tokens = kwargs.get("max_tokens") or 256
+    prompt_tokens = estimate_prompt_tokens(kwargs.get("messages", []))
+    ranked = get_router().rank(prompt_tokens, max_tokens, require_json="response_format" in kwargs)
+    if not ranked:
+        raise ValueError("入力が長すぎるため、利用できるモデルがありません")
+    routed = []
+    for model in ranked[:2]:
+        candidate = dict(kwargs, model=model)
+        if "response_format" in kwargs:
+            candidate["response_format"] = adapt_response_format(kwargs["response_format"], model)
+        routed.append(candidate)
+    return routed
+
+
+def _acquire(kwargs: Dict[str, Any], on_wait: Optional[WaitCallback]) -> Tuple[int, float]:
+    """共有レートリミッタで順番を待ち、(見積もりトークン数, 待った秒数) を返す"""
+    estimated = estimate_tokens(kwargs.get("messages", []), kwargs.get("max_tokens"))
+    waited = get_rate_limiter().acquire(estimated, on_wait=on_wait)
+    if waited > 0.01 and on_wait is not None:
+        on_wait(0.0)
+    return estimated, waited
+
+
+@contextmanager
+def _upstream_call(kwargs: Dict[str, Any], estimated: int, waited: float, on_wait: Optional[WaitCallback] = None):
+    with span(kwargs["model"], "openai", bytes_out=request_bytes(kwargs)) as current:
+        if kwargs.get("stream"):
+            current.set(stream=True)
+        if waited > 0.01:
+            current.set(queued_seconds=round(waited, 3))
+        failed = True
+        try:
+            yield _create_with_backoff(kwargs, estimated, on_wait), current
+            failed = False
+        finally:
+            used = current.prompt_tokens + current.completion_tokens
+            get_rate_limiter().settle(estimated, used or None)
+            # 実測レイテンシをモデル選択に反映する（途中で打ち切った呼び出しは除く）
+            elapsed = time.time() - current.started_at
+            first_token_seconds = current.attributes.get("first_token_seconds")
+            if current.status != "cancelled":
+                get_router().observe(
+                    kwargs["model"],
+                    elapsed,
+                    current.completion_tokens,
+                    first_token_seconds,
+                    ok=not failed and current.status == "ok",
+                )
+            elif current.attributes.get("hedge_lost") and first_token_seconds is None:
+                # ヘッジで負けた側は、少なくとも打ち切るまでの時間がかかったものとして記録する
+                get_router().observe(kwargs["model"], elapsed, 0, elapsed)
+
+
+@contextmanager
+def llm_call(kwargs: Dict[str, Any], on_wait: Optional[WaitCallback] = None):
+    """共有レートリミッタで順番を待ってから API を呼び出し、(レスポンス, スパン) を返す
+    
+    待ちが発生した場合は on_wait に推定待ち時間（秒）を渡し、順番が来たら 0 を渡す。
+    実際の使用トークン数は span.record_usage() で記録すれば、見積もりとの差がリミッタに反映される。
+    """
+    estimated, waited = _acquire(kwargs, on_wait)
+    with _upstream_call(kwargs, estimated, waited, on_wait) as call:
+        yield call
+
+
+def chat_completion(on_wait: Optional[WaitCallback] = None, **kwargs):
+    """Chat Completions API を呼び出し、所要時間・送受信バイト数・トークン数をスパンとして記録する
+    
+    同じリクエストが他のセッションで実行中の場合は、API を呼ばずにその結果を共有する。
+    model="auto" の場合は予測レイテンシの短いモデルを選び、p95 を過ぎても応答がなければ
+    予備のモデルも呼び出して先に返った方を使う（ヘッジ）。
+    """
+    def call():
+        routed = route(kwargs)
+        estimated, waited = _acquire(routed[0], on_wait)
+        if len(routed) == 1:
+            return _blocking_call(routed[0], estimated, waited)
+        return _hedged_call(routed[0], routed[1], estimated, waited)
+    
+    response, _ = get_single_flight().do(request_key(kwargs), call)
+    return response
+
+
+def _blocking_call(kwargs: Dict[str, Any], estimated: int, waited: float, **attributes):
+    with _upstream_call(kwargs, estimated, waited) as (response, current):
+        current.set(bytes_in=response_bytes(response), **attributes)
+        current.record_usage(response.usage)
+        return response
+
+
+def _backup_call(kwargs: Dict[str, Any]):
+    estimated, waited = _acquire(kwargs, None)
+    return _blocking_call(kwargs, estimated, waited, hedge="backup")
+
+
+def _hedged_call(primary: Dict[str, Any], backup: Dict[str, Any], estimated: int, waited: float):
+    """主モデルが p95 の時間内に返らない（または失敗した）場合に予備モデルも呼び、先に返った方を使う
+    
+    同期 API の呼び出しは途中で止められないため、遅れた方の結果は捨てられる。
+    """
+    router = get_router()
+    delay = router.hedge_delay(primary["model"], primary.get("max_tokens") or 256, stream=False)
+    futures = [_hedge_executor.submit(contextvars.copy_context().run, _blocking_call, primary, estimated, waited)]
+    done, _ = wait(futures, timeout=delay)
+    if not done or futures[0].exception() is not None:
+        futures.append(_hedge_executor.submit(contextvars.copy_context().run, _backup_call, backup))
+    
+    errors = []
+    for future in as_completed(futures):
+        try:
+            response = future.result()
+        except Exception as e:
+            errors.append(e)
+            continue
+        if len(futures) > 1:
+            router.record_hedge(backup["model"], won=future is futures[1])
+        return response
+    raise errors[0]
+
+
+# stream_chat_completion の戻り値（受信したテキストを順に返し、受信後に使用トークン数を参照できる）
+class ChatStream:
+    def __init__(self, kwargs: Dict[str, Any], on_wait: Optional[WaitCallback]):
+        self._kwargs = kwargs
+        self._on_wait = on_wait
+        self._closed = False
+        self.flight, self.shared = _start_stream(kwargs, on_wait)
+    
+    def __iter__(self) -> Iterator[str]:
+        try:
+            while True:
+                received = 0
+                try:
+                    for chunk in self.flight.iter_chunks():
+                        received += 1
+                        yield chunk
+                    return
+                except FlightCancelled:
+                    if received:
+                        raise
+                # 実行するはずだった側が開始前に中断したため、改めて実行（または相乗り）する
+                get_single_flight().leave(self.flight)
+                self.flight, self.shared = _start_stream(self._kwargs, self._on_wait)
+        finally:
+            self.close()
+    
+    @property
+    def total_tokens(self) -> int:
+        return (self.flight.result or {}).get("total_tokens", 0)
+    
+    @property
+    def model(self) -> Optional[str]:
+        """実際に応答したモデル（受信を終えるまでは None）"""
+        return (self.flight.result or {}).get("model")
+    
+    def close(self):
+        """受信をやめる（誰も受信していなければ上流の接続も閉じられる）"""
+        if not self._closed:
+            self._closed = True
+            get_single_flight().leave(self.flight)
+
+
+def stream_chat_completion(on_wait: Optional[WaitCallback] = None, **kwargs) -> ChatStream:
+    """ストリーミングで呼び出し、受信したテキストを順に返す ChatStream を返す
+    
+    同じリクエストを他のセッションが受信中の場合は、API を呼ばずに同じストリームを受け取る。
+    上流の受信はバックグラウンドのスレッドで行い、全員が受信をやめた時点で接続を閉じる。
+    """
+    return ChatStream(dict(kwargs, stream=True, stream_options={"include_usage": True}), on_wait)
+
+
+def _start_stream(kwargs: Dict[str, Any], on_wait: Optional[WaitCallback]) -> Tuple[Flight, bool]:
+    """受信中の同じストリームに相乗りするか、新しく受信を始めて (呼び出し, 相乗りしたか) を返す"""
+    single_flight = get_single_flight()
+    flight, leader = single_flight.join(request_key(kwargs))
+    if not leader:
+        return flight, True
+    try:
+        routed = route(kwargs)
+        estimated, waited = _acquire(routed[0], on_wait)
+    except CallAbandoned:
+        single_flight.finish(flight, error=FlightCancelled())
+        single_flight.leave(flight)
+        raise
+    except Exception as e:
+        single_flight.finish(flight, error=e)
+        single_flight.leave(flight)
+        raise
+    except BaseException:
+        # 順番待ちの間に中断された（相乗りしていた側は改めて実行する）
+        single_flight.finish(flight, error=FlightCancelled())
+        single_flight.leave(flight)
+        raise
+    
+    race = _StreamRace(flight, routed[1] if len(routed) > 1 else None)
+    race.start(routed[0], estimated, waited, "primary")
+    if race.backup is not None:
+        primary = routed[0]
+        race.schedule_backup(get_router().hedge_delay(primary["model"], primary.get("max_tokens") or 256, stream=True))
+    return flight, False
+
+
+# ヘッジしたストリームのうち、先に最初のトークンを返した方を採用するための調停
+class _StreamRace:
+    def __init__(self, flight: Flight, backup: Optional[Dict[str, Any]]):
+        self.flight = flight
+        self.backup = backup
+        self.winner: Optional[str] = None
+        self._lock = threading.Lock()
+        self._responses: Dict[str, Any] = {}
+        self._running = 0
+        self._backup_started = False
+        self._timer: Optional[threading.Timer] = None
+    
+    def start(self, kwargs: Dict[str, Any], estimated: int, waited: float, role: str):
+        """受信スレッドを起動する（セッションやトレースの情報も引き継ぐ）"""
+        with self._lock:
+            self._running += 1
+        context = contextvars.copy_context()
+        threading.Thread(
+            target=context.run,
+            args=(_pump, self, kwargs, estimated, waited, role),
+            name=f"llm-stream-{role}",
+            daemon=True,
+        ).start()
+    
+    def schedule_backup(self, delay: float):
+        """delay 秒以内に主モデルの最初のトークンが届かなければ予備モデルを呼ぶ"""
+        self._timer = threading.Timer(delay, self.start_backup)
+        self._timer.daemon = True
+        self._timer.start()
+    
+    def start_backup(self):
+        with self._lock:
+            if self.backup is None or self._backup_started or self.winner is not None or self.flight.done:
+                return
+            self._backup_started = True
+        try:
+            estimated, waited = _acquire(self.backup, None)
+        except Exception as e:
+            self.failed("backup", e, started=False)
+            return
+        self.start(self.backup, estimated, waited, "backup")
+    
+    def opened(self, role: str, response: Any) -> bool:
+        """接続を登録する（すでに相手が採用されていれば False）"""
+        with self._lock:
+            if self.winner is not None and self.winner != role:
+                return False
+            self._responses[role] = response
+            return True
+    
+    def claim(self, role: str) -> bool:
+        """最初のトークンを受け取った側が採用される。採用されなかった側は False"""
+        with self._lock:
+            if self.winner is None:
+                self.winner = role
+                losers = [response for other, response in self._responses.items() if other != role]
+                hedged = self._backup_started
+            else:
+                return self.winner == role
+        if self._timer is not None:
+            self._timer.cancel()
+        # 遅れた方の接続を閉じてトークンの受信を止める
+        for response in losers:
+            try:
+                response.close()
+            except Exception:
+                pass
+        if hedged:
+            get_router().record_hedge(self.backup["model"], won=role == "backup")
+        return True
+    
+    def lost(self, role: str) -> bool:
+        with self._lock:
+            return self.winner is not None and self.winner != role
+    
+    def failed(self, role: str, error: Exception, started: bool = True):
+        """受信に失敗した。主モデルが失敗した場合は予備モデルに切り替え、全て失敗したらエラーを渡す"""
+        with self._lock:
+            if started:
+                self._running -= 1
+            fallback = role == "primary" and self.backup is not None and not self._backup_started and self.winner is None
+            give_up = not fallback and self._running == 0 and self.winner in (None, role)
+        if fallback:
+            if self._timer is not None:
+                self._timer.cancel()
+            self.start_backup()
+        elif give_up or self.winner == role:
+            get_single_flight().finish(self.flight, error=error)
+
+
+def _pump(race: _StreamRace, kwargs: Dict[str, Any], estimated: int, waited: float, role: str):
+    """上流のストリームを受信し、受信したテキストを待ち手全員に配る"""
+    single_flight = get_single_flight()
+    flight = race.flight
+    try:
+        with _upstream_call(kwargs, estimated, waited) as (response, current):
+            if race.backup is not None:
+                current.set(hedge=role)
+            if not race.opened(role, response):
+                response.close()
+                current.set(status="cancelled", hedge_lost=True)
+                return
+            tokens = 0
+            received = False
+            try:
+                for chunk in response:
+                    # 使用量は最後のチャンク（choicesが空）で返される
+                    if chunk.usage:
+                        tokens = chunk.usage.total_tokens
+                        current.record_usage(chunk.usage)
+                    if not chunk.choices or not chunk.choices[0].delta.content:
+                        continue
+                    delta = chunk.choices[0].delta.content
+                    if not received:
+                        if not race.claim(role):
+                            current.set(status="cancelled", hedge_lost=True)
+                            return
+                        received = True
+                        current.set(first_token_seconds=round(time.time() - current.started_at, 3))
+                    current.bytes_in += len(delta.encode("utf-8"))
+                    flight.publish(delta)
+                    if single_flight.abandon_if_unused(flight):
+                        # 全員が受信をやめたのでトークンの受信を止める
+                        current.set(status="cancelled")
+                        return
+            except Exception:
+                if race.lost(role):
+                    # 相手が採用されたため接続を閉じられた
+                    current.set(status="cancelled", hedge_lost=True)
+                    return
+                raise
+            finally:
+                response.close()
+            if not race.claim(role):
+                current.set(status="cancelled")
+                return
+    except Exception as e:
+        race.failed(role, e)
+        return
+    single_flight.finish(flight, result={"total_tokens": tokens, "model": kwargs["model"]})
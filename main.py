@@ -1,121 +1,680 @@
 import streamlit as st
-from openai import OpenAI
+import functools
+import hmac
 import os
+import shutil
+import tempfile
+import threading
+import time
+import zipfile
 from abc import ABC, abstractmethod
-from typing import List, Dict, Any, Optional
-import pandas as pd
-import plotly.express as px
+from contextlib import ExitStack
+from typing import Callable, List, Dict, Any, Optional, Tuple, Type
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+from chat_memory import ChatMemory
+from image_hash_cache import PerceptualHashCache, fingerprint
+from image_preprocess import DEFAULT_BYTE_BUDGET, decode_image, prepare_image, to_data_url
+from llm_gateway import chat_completion, stream_chat_completion
+from metrics import get_metrics
+from model_router import AUTO_MODEL, get_router
+from outbound import bind_outbound_session, call_outbound, current_session_id, get_outbound
+from providers import get_secret, import_timings, lazy_import, profile_imports
+from rate_limit import bind_session, estimate_text_tokens, get_rate_limiter
+from response_cache import ResponseCache
+from sentiment_lexicon import LexiconSentimentScorer
+from service_inputs import InvalidInputError, prepare_inputs
+from single_flight import get_single_flight
+from structured_output import (
+    SENTIMENT_SCHEMA,
+    StructuredOutputError,
+    extract_json_object,
+    response_format_for,
+    strict_response_format,
+    validate_sentiment,
+)
+from text_chunker import chunk_text, pack
+from text_similarity_cache import NearDuplicateCache
+from tracing import get_tracer, span
+from worker_pool import RateLimiter, run_bounded
 
 #test
-# OpenAI クライアントの初期化
-client = OpenAI(api_key=st.secrets["OPENAI_API_KEY"])
+# OpenAI クライアントや pandas / plotly などの重い依存は providers 経由で初回利用時に読み込む
+
+def wait_notice() -> Optional[Callable[[float], None]]:
+    """レート制限の順番待ちの間、推定待ち時間を表示するコールバックを返す（ワーカースレッドでは表示しない）"""
+    if get_script_run_ctx(suppress_warning=True) is None:
+        return None
+    placeholder = None
+    
+    def show(seconds: float):
+        nonlocal placeholder
+        if placeholder is None:
+            placeholder = st.empty()
+        if seconds <= 0:
+            placeholder.empty()
+        else:
+            placeholder.info(f"⏳ 混み合っているため順番待ちです（推定待ち時間: 約{max(1, round(seconds))}秒）")
+    return show
+
+def model_label(model: str) -> str:
+    """モデル選択の表示名"""
+    return "自動（レイテンシ優先）" if model == AUTO_MODEL else model
+
+def render_prompt_cache_stats(prompt_cache: NearDuplicateCache):
+    """類似プロンプトのキャッシュのヒット数と節約量を表示（感情分析と共用のため全体の値）"""
+    stats = prompt_cache.stats()
+    st.caption(
+        f"類似プロンプトのキャッシュ（感情分析と共用）: 表記ゆれのみ {stats['exact_hits']} / "
+        f"類似 {stats['near_hits']} / ミス {stats['misses']} / 保存件数 {stats['entries']} / "
+        f"削除 {stats['evictions']} / 節約 {stats['saved_seconds']:.1f}秒・{stats['saved_tokens']} トークン"
+    )
+
+def create_chat_completion(**kwargs):
+    """共有レートリミッタを通して Chat Completions API を呼び出す（順番待ちの間は推定待ち時間を表示）"""
+    return call_outbound(lambda on_wait: chat_completion(on_wait=on_wait, **kwargs), notice=wait_notice())
+
+# 全セッションで共有する応答キャッシュ
+@st.cache_resource
+def get_response_cache() -> ResponseCache:
+    return ResponseCache()
+
+# 全セッションで共有する画像説明文のキャッシュ（知覚ハッシュで類似画像にもヒット）
+@st.cache_resource
+def get_caption_cache() -> PerceptualHashCache:
+    return PerceptualHashCache()
+
+# 全セッションで共有する類似プロンプトのキャッシュ（文章生成と感情分析で共用し、scope で区別する）
+@st.cache_resource
+def get_prompt_cache() -> NearDuplicateCache:
+    return NearDuplicateCache()
+
+# SYNAPSE_API_PORT が設定されていれば、同じプロセス内で HTTP API も起動する
+# （OpenAI クライアント・キャッシュ・レート制限を UI と共有する。起動はプロセスごとに1回）
+@st.cache_resource
+def start_api_server() -> Optional[int]:
+    port = os.environ.get("SYNAPSE_API_PORT")
+    if not port:
+        return None
+    api_server = lazy_import("api_server")
+    api_server.start_api_server(int(port), get_service_manager())
+    return int(port)
 
 # サービスの基本クラス（抽象クラス）
 class AIService(ABC):
-    @property
-    @abstractmethod
-    def name(self) -> str:
-        """サービス名を返す"""
-        pass
-    
-    @property
-    @abstractmethod
-    def description(self) -> str:
-        """サービスの説明を返す"""
-        pass
-    
-    @property
-    @abstractmethod
-    def icon(self) -> str:
-        """サービスのアイコン（Emojis）を返す"""
-        pass
+    # サービス名・説明・アイコン（Emojis）。インスタンスを生成せずに一覧を表示できるよう、クラス属性で定義する
+    name: str
+    description: str
+    icon: str
     
     @abstractmethod
     def render(self):
         """Streamlitでサービスの内容をレンダリングする"""
         pass
+    
+    def run(self, inputs: Dict[str, Any], allow_local_files: bool = False) -> Dict[str, Any]:
+        """UIを使わずに入力（JSONで表せる辞書）を処理し、結果の辞書を返す（バッチ実行用）
+        
+        allow_local_files は呼び出し元が信頼できる場合（手元のバッチ実行など）だけ True にし、
+        入力で指定されたローカルファイルの読み込みを許可する（HTTP API からは常に False）。
+        """
+        raise NotImplementedError(f"{self.name} はバッチ実行に対応していません")
 
 # テキスト生成サービス
 class TextGenerationService(AIService):
-    @property
-    def name(self) -> str:
-        return "AI文章生成"
+    SYSTEM_PROMPT = "あなたは役立つアシスタントです。"
     
-    @property
-    def description(self) -> str:
-        return "OpenAI GPTモデルを使用して、プロンプトに基づいた文章を生成します。"
+    # 長文モード: 文書を分割して部分ごとに要約（map）し、部分要約を統合（reduce）する
+    MAP_SYSTEM_PROMPT = "あなたは長い文書の一部を読み、指示に関係する要点を漏れなく簡潔にまとめるアシスタントです。"
+    REDUCE_SYSTEM_PROMPT = "あなたは文書の部分ごとの要約を統合し、指示に沿って1つのまとまった回答を作るアシスタントです。"
+    DEFAULT_INSTRUCTION = "この文書を要約してください。"
+    # 1回に送る文書の長さの目安と、部分要約の最大トークン数
+    DEFAULT_CHUNK_TOKENS = 1500
+    MAP_MAX_TOKENS = 400
+    # 統合に渡す部分要約の合計の上限（超える場合は部分要約をさらに要約してから統合する）
+    REDUCE_INPUT_TOKENS = 4000
+    # 部分ごとの要約を同時に実行する数
+    MAP_WORKERS = 4
+    # この長さを超える入力では長文モードを勧める
+    LONG_INPUT_TOKENS = 3000
     
-    @property
-    def icon(self) -> str:
-        return "✍️"
+    # チャットモード: 要約していない履歴がこのトークン数を超えたら、直近のターンを残して古いターンを要約にまとめる
+    CHAT_SUMMARY_THRESHOLD = 1500
+    CHAT_KEEP_RECENT = 4
+    CHAT_SUMMARY_MAX_TOKENS = 300
+    # セッションごとに保持する会話の上限（バイト数。超えた分は要約済みのターンから捨てる）
+    CHAT_MAX_BYTES = 256 * 1024
+    CHAT_SUMMARY_PROMPT = (
+        "あなたは会話の記録係です。これまでの要約と追加の会話から、事実・決定事項・ユーザーの希望や前提を"
+        "漏れなく残した簡潔な要約を作り直してください。"
+    )
+    
+    # 既定のモデル（画面の初期選択と run() の既定値をそろえる）
+    MODEL = "gpt-3.5-turbo"
+    MODEL_OPTIONS = [AUTO_MODEL, "gpt-4", MODEL]
+    
+    # run() で省略した入力の既定値
+    DEFAULT_INPUTS = {
+        "model": MODEL,
+        "max_tokens": 500,
+        "use_cache": True,
+        "similarity_threshold": 0.9,
+        "map_reduce": False,
+        "instruction": DEFAULT_INSTRUCTION,
+        "chunk_tokens": DEFAULT_CHUNK_TOKENS,
+    }
+    
+    name = "AI文章生成"
+    description = "OpenAI GPTモデルを使用して、プロンプトに基づいた文章を生成します。"
+    icon = "✍️"
     
     def render(self):
         st.subheader("AI文章生成")
         
-        # モデル選択
+        # モデル選択（auto はプロンプトの長さと実測レイテンシから選び、遅い場合は予備モデルも呼ぶ）
         model = st.selectbox(
             "モデルを選択",
-            ["gpt-4", "gpt-3.5-turbo"],
-            index=1
+            self.MODEL_OPTIONS,
+            index=self.MODEL_OPTIONS.index(self.MODEL),
+            format_func=model_label
         )
         
+        # チャットモードでは会話の履歴を保持し、古いターンは要約して送る
+        mode = st.radio("モード", ["単発の生成", "チャット"], horizontal=True)
+        if mode == "チャット":
+            max_tokens = st.slider("最大トークン数", 50, 2000, 500)
+            self._render_chat(model, max_tokens)
+            return
+        
         # プロンプト入力
         prompt = st.text_area("プロンプトを入力してください", height=150)
         
         # 文章の長さ設定
         max_tokens = st.slider("最大トークン数", 50, 2000, 500)
         
+        # ストリーミング表示の切り替え
+        stream = st.checkbox("生成中の文章を逐次表示する（ストリーミング）", value=True)
+        
+        # キャッシュの利用設定（チェックすると完全一致・類似のどちらのキャッシュも使わない）
+        bypass_cache = st.checkbox("キャッシュを使わずに生成する", value=False)
+        # 1.0 では空白・全角半角・大文字小文字の違いのみ、値を下げるほど言い回しの違うプロンプトにもヒットする（数値・演算子が違うものは対象外）
+        similarity_threshold = st.slider("キャッシュを使う類似度（1.0 で表記ゆれのみ）", 0.7, 1.0, 0.9, 0.01)
+        self._render_cache_stats(get_response_cache(), get_prompt_cache())
+        
+        # 長文モード（段落・文の区切りで分割して部分ごとに並列で要約し、最後に統合する）
+        long_mode = st.checkbox("長文モード（分割して並列に要約し、最後に統合する）", value=False)
+        if long_mode:
+            instruction = st.text_input("文書に対する指示", self.DEFAULT_INSTRUCTION)
+            chunk_tokens = st.slider("1回に送る文書の長さ（トークン数の目安）", 500, 4000, self.DEFAULT_CHUNK_TOKENS, 100)
+        elif prompt and estimate_text_tokens(prompt) > self.LONG_INPUT_TOKENS:
+            st.info("入力が長いため、長文モードを使うと分割して並列に処理できます")
+        
+        # 前回のストリーミングが途中で中止されていれば、その時点までの文章を表示
+        previous = st.session_state.pop("text_generation_stream", None)
+        if previous and not previous["done"] and previous["text"]:
+            st.warning("文章の生成を中止しました。途中までの文章を表示します。")
+            self._render_result(previous["text"])
+        
         # 生成ボタン
         if st.button("文章を生成"):
             if not prompt:
                 st.error("プロンプトを入力してください")
                 return
             
-            with st.spinner("文章を生成中..."):
+            inputs = {
+                "prompt": prompt,
+                "model": model,
+                "max_tokens": max_tokens,
+                "use_cache": not bypass_cache,
+                "similarity_threshold": similarity_threshold,
+            }
+            if long_mode:
+                inputs.update(map_reduce=True, instruction=instruction or self.DEFAULT_INSTRUCTION, chunk_tokens=chunk_tokens)
+                self._render_map_reduce(inputs, stream)
+                return
+            
+            # 同じ（または類似した）リクエストの結果がキャッシュにあれば、APIを呼ばずに表示
+            result = self._lookup_cache(inputs) if not bypass_cache else None
+            if result is None and stream:
+                self._render_streaming(inputs)
+                return
+            
+            if result is None:
+                with st.spinner("文章を生成中..."):
+                    try:
+                        # キャッシュはここまでに探してあるため、run() では探し直さない（ミスを二重に数えない）
+                        result = self.run(dict(inputs, use_cache=False))
+                    except Exception as e:
+                        st.error(f"エラーが発生しました: {str(e)}")
+                        return
+            
+            # 結果表示
+            if result["cache"] == "exact":
+                st.success("文章が生成されました！（キャッシュから表示）")
+            elif result["cache"] == "similar":
+                st.success("文章が生成されました！（類似したプロンプトのキャッシュから表示）")
+                st.caption(f"類似度: {result['similarity']:.2f}")
+            else:
+                st.success("文章が生成されました！")
+                if model == AUTO_MODEL:
+                    st.caption(f"使用したモデル: {result['model']}")
+            self._render_result(result["text"])
+    
+    def run(self, inputs: Dict[str, Any], allow_local_files: bool = False) -> Dict[str, Any]:
+        """プロンプトから文章を生成し、{text, model, tokens, cache, similarity} を返す
+        
+        inputs には prompt（必須）と model / max_tokens / use_cache / similarity_threshold を指定できる。
+        キャッシュから返した場合は cache に "exact"（完全一致）または "similar"（類似プロンプト）が入る。
+        map_reduce を指定すると、prompt を文書として run_map_reduce() で処理する。
+        """
+        inputs = prepare_inputs(self.DEFAULT_INPUTS, inputs)
+        if not inputs.get("prompt"):
+            raise InvalidInputError("prompt を指定してください")
+        if inputs["map_reduce"]:
+            return self.run_map_reduce(inputs)
+        if inputs["use_cache"]:
+            cached = self._lookup_cache(inputs)
+            if cached is not None:
+                return cached
+        
+        started_at = time.perf_counter()
+        response = create_chat_completion(
+            model=inputs["model"],
+            messages=self._messages(inputs["prompt"]),
+            max_tokens=int(inputs["max_tokens"])
+        )
+        generated_text = response.choices[0].message.content
+        tokens = response.usage.total_tokens if response.usage else 0
+        self._store_cache(inputs, generated_text, time.perf_counter() - started_at, tokens)
+        return {"text": generated_text, "model": response.model, "tokens": tokens, "cache": None, "similarity": None}
+    
+    def run_map_reduce(
+        self,
+        inputs: Dict[str, Any],
+        on_chunk: Optional[Callable[[int, int, int, str], None]] = None,
+        generate: Optional[Callable[[List[Dict[str, str]], int], Tuple[str, str, int]]] = None,
+    ) -> Dict[str, Any]:
+        """長い文書を分割して並列に要約し、部分要約を instruction に沿って統合する（run() の形式に chunks を加えて返す）
+        
+        分割しても1つに収まる場合は、統合せずに1回の要約を返す（on_chunk も呼ばれない）。
+        on_chunk(完了数, 全体数, 部分の番号, 部分要約) は部分要約が1つ終わるたびに呼び出し元のスレッドで呼ばれる。
+        generate(messages, max_tokens) -> (文章, モデル, トークン数) を渡すと、統合の呼び出しを差し替えられる。
+        """
+        inputs = prepare_inputs(self.DEFAULT_INPUTS, inputs)
+        if not inputs.get("prompt"):
+            raise InvalidInputError("prompt を指定してください")
+        if inputs["chunk_tokens"] <= 0:
+            raise InvalidInputError("chunk_tokens は正の値で指定してください")
+        max_tokens = int(inputs["max_tokens"])
+        cache_key = ResponseCache.make_key(
+            mode="map_reduce",
+            model=inputs["model"],
+            prompt=inputs["prompt"],
+            instruction=inputs["instruction"],
+            chunk_tokens=int(inputs["chunk_tokens"]),
+            max_tokens=max_tokens,
+            system_prompt=self.REDUCE_SYSTEM_PROMPT
+        )
+        if inputs["use_cache"]:
+            cached_text = get_response_cache().get(cache_key)
+            if cached_text is not None:
+                return {"text": cached_text, "model": inputs["model"], "tokens": 0, "cache": "exact", "similarity": 1.0, "chunks": None}
+        
+        started_at = time.perf_counter()
+        chunks = chunk_text(inputs["prompt"], int(inputs["chunk_tokens"]))
+        if len(chunks) == 1:
+            # 1回で送れる長さなら統合の呼び出しは省き、文書全体を1回で要約した結果を返す
+            messages, tokens = self._map_messages(inputs["instruction"], chunks[0], 0, 1), 0
+        else:
+            summaries, tokens = self._summarize_chunks(chunks, inputs, on_chunk)
+            # 部分要約の合計が長すぎる場合は、いくつかずつまとめて要約し直す
+            while len(summaries) > 1 and sum(estimate_text_tokens(summary) for summary in summaries) > self.REDUCE_INPUT_TOKENS:
+                groups = pack(summaries, self.REDUCE_INPUT_TOKENS)
+                if len(groups) >= len(summaries):
+                    break
+                summaries, more_tokens = self._summarize_chunks(groups, inputs)
+                tokens += more_tokens
+            messages = self._reduce_messages(inputs["instruction"], summaries)
+        
+        if generate is None:
+            response = create_chat_completion(model=inputs["model"], messages=messages, max_tokens=max_tokens)
+            text, model = response.choices[0].message.content, response.model
+            tokens += response.usage.total_tokens if response.usage else 0
+        else:
+            text, model, more_tokens = generate(messages, max_tokens)
+            tokens += more_tokens
+        get_response_cache().set(cache_key, text, latency=time.perf_counter() - started_at, tokens=tokens)
+        return {"text": text, "model": model, "tokens": tokens, "cache": None, "similarity": None, "chunks": len(chunks)}
+    
+    def _summarize_chunks(
+        self,
+        chunks: List[str],
+        inputs: Dict[str, Any],
+        on_chunk: Optional[Callable[[int, int, int, str], None]] = None,
+    ) -> Tuple[List[str], int]:
+        """各部分を並列に要約し、(元の順に並べた部分要約, 使用トークン数) を返す"""
+        total = len(chunks)
+        
+        def summarize(item: Tuple[int, str]):
+            index, chunk = item
+            return create_chat_completion(
+                model=inputs["model"],
+                messages=self._map_messages(inputs["instruction"], chunk, index, total),
+                max_tokens=min(self.MAP_MAX_TOKENS, int(inputs["max_tokens"]))
+            )
+        
+        summaries = [""] * total
+        tokens = 0
+        done = 0
+        for index, response, error in run_bounded(summarize, list(enumerate(chunks)), max_workers=self.MAP_WORKERS):
+            if error is not None:
+                raise error
+            summaries[index] = response.choices[0].message.content
+            tokens += response.usage.total_tokens if response.usage else 0
+            done += 1
+            if on_chunk is not None:
+                on_chunk(done, total, index, summaries[index])
+        return summaries, tokens
+    
+    def _messages(self, prompt: str) -> List[Dict[str, str]]:
+        return [
+            {"role": "system", "content": self.SYSTEM_PROMPT},
+            {"role": "user", "content": prompt}
+        ]
+    
+    def _map_messages(self, instruction: str, chunk: str, index: int, total: int) -> List[Dict[str, str]]:
+        return [
+            {"role": "system", "content": self.MAP_SYSTEM_PROMPT},
+            {"role": "user", "content": f"指示: {instruction}\n\n文書の一部（{index + 1}/{total}）:\n{chunk}"}
+        ]
+    
+    def _reduce_messages(self, instruction: str, summaries: List[str]) -> List[Dict[str, str]]:
+        joined = "\n\n".join(f"[{i + 1}]\n{summary}" for i, summary in enumerate(summaries))
+        return [
+            {"role": "system", "content": self.REDUCE_SYSTEM_PROMPT},
+            {"role": "user", "content": f"指示: {instruction}\n\n以下は文書を先頭から順に分割して要約したものです。\n\n{joined}"}
+        ]
+    
+    def _cache_keys(self, inputs: Dict[str, Any]) -> Tuple[str, str]:
+        """(完全一致のキャッシュキー, 類似プロンプトを探す範囲) を返す"""
+        cache_key = ResponseCache.make_key(
+            model=inputs["model"],
+            prompt=inputs["prompt"],
+            max_tokens=int(inputs["max_tokens"]),
+            system_prompt=self.SYSTEM_PROMPT
+        )
+        # 類似プロンプトは、モデル・最大トークン数・システムプロンプトが同じものだけを対象にする
+        scope = ResponseCache.make_key(
+            model=inputs["model"],
+            max_tokens=int(inputs["max_tokens"]),
+            system_prompt=self.SYSTEM_PROMPT
+        )
+        return cache_key, scope
+    
+    def _lookup_cache(self, inputs: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """完全一致、なければ類似プロンプトのキャッシュを探し、run() と同じ形式で返す"""
+        cache_key, scope = self._cache_keys(inputs)
+        cached_text = get_response_cache().get(cache_key)
+        if cached_text is not None:
+            return {"text": cached_text, "model": inputs["model"], "tokens": 0, "cache": "exact", "similarity": 1.0}
+        similar = get_prompt_cache().lookup(scope, inputs["prompt"], inputs["similarity_threshold"])
+        if similar is not None:
+            return {"text": similar[0], "model": inputs["model"], "tokens": 0, "cache": "similar", "similarity": similar[1]}
+        return None
+    
+    def _store_cache(self, inputs: Dict[str, Any], generated_text: str, latency: float, tokens: int):
+        cache_key, scope = self._cache_keys(inputs)
+        get_response_cache().set(cache_key, generated_text, latency=latency, tokens=tokens)
+        get_prompt_cache().store(scope, inputs["prompt"], generated_text, latency=latency, tokens=tokens)
+    
+    def _render_streaming(self, inputs: Dict[str, Any]):
+        """ストリーミングで生成して表示し、結果をキャッシュに保存する"""
+        started_at = time.perf_counter()
+        try:
+            generated_text, first_token_time, tokens = self._generate_streaming(
+                inputs["model"],
+                self._messages(inputs["prompt"]),
+                inputs["max_tokens"]
+            )
+            self._store_cache(inputs, generated_text, time.perf_counter() - started_at, tokens)
+            if first_token_time is not None:
+                st.caption(f"最初のトークンまで: {first_token_time:.2f}秒")
+            st.success("文章が生成されました！")
+            self._render_download(generated_text)
+        except Exception as e:
+            st.error(f"エラーが発生しました: {str(e)}")
+    
+    def _render_chat(self, model: str, max_tokens: int):
+        """会話の履歴を表示し、入力されたメッセージにストリーミングで応答する"""
+        memory: Optional[ChatMemory] = st.session_state.get("text_generation_chat")
+        if memory is None or st.button("会話をリセット"):
+            memory = st.session_state.text_generation_chat = ChatMemory(
+                self.CHAT_SUMMARY_THRESHOLD, self.CHAT_KEEP_RECENT, self.CHAT_MAX_BYTES
+            )
+        
+        if memory.summary:
+            with st.expander("これまでの会話の要約（送信する履歴に含まれます）"):
+                st.markdown(memory.summary)
+        if memory.evicted:
+            st.caption(f"古いメッセージ {memory.evicted} 件は表示から削除しました（内容は要約に含まれています）")
+        for role, text in memory.history():
+            with st.chat_message(role):
+                st.markdown(text)
+        
+        message = st.chat_input("メッセージを入力してください")
+        if message:
+            with st.chat_message("user"):
+                st.markdown(message)
+            messages = memory.context_messages(self.SYSTEM_PROMPT) + [{"role": "user", "content": message}]
+            with st.chat_message("assistant"):
+                placeholder = st.empty()
+                placeholder.markdown("▌")
+                reply = ""
+                stream = None
                 try:
-                    # 新しいOpenAI APIの形式
-                    response = client.chat.completions.create(
-                        model=model,
-                        messages=[
-                            {"role": "system", "content": "あなたは役立つアシスタントです。"},
-                            {"role": "user", "content": prompt}
-                        ],
-                        max_tokens=max_tokens
-                    )
-                    generated_text = response.choices[0].message.content
-                    
-                    # 結果表示
-                    st.success("文章が生成されました！")
-                    st.markdown("### 生成された文章")
-                    st.markdown(generated_text)
-                    
-                    # ダウンロードボタン
-                    st.download_button(
-                        label="テキストをダウンロード",
-                        data=generated_text,
-                        file_name="generated_text.txt",
-                        mime="text/plain"
-                    )
+                    # 入力が長すぎる場合やレート制限の待ち時間切れは、ストリームの作成時に例外になる
+                    stream = stream_chat_completion(on_wait=wait_notice(), model=model, messages=messages, max_tokens=max_tokens)
+                    for delta in stream:
+                        reply += delta
+                        placeholder.markdown(reply + "▌")
                 except Exception as e:
+                    placeholder.empty()
                     st.error(f"エラーが発生しました: {str(e)}")
+                    return
+                finally:
+                    if stream is not None:
+                        stream.close()
+                placeholder.markdown(reply)
+            # 応答が最後まで届いたターンだけを履歴に残す
+            memory.add("user", message)
+            memory.add("assistant", reply)
+            
+            if memory.needs_fold():
+                with st.spinner("古い会話を要約しています..."):
+                    try:
+                        memory.fold(lambda summary, turns: self._summarize_history(model, summary, turns))
+                    except Exception as e:
+                        st.warning(f"会話の要約に失敗しました（次のメッセージの後に再試行します）: {str(e)}")
+        
+        stats = memory.stats()
+        st.caption(
+            f"次に送る履歴: 約{stats['context_tokens']}トークン / "
+            f"要約済み {stats['folded']} 件・要約していない {stats['unfolded']} 件 / "
+            f"保持量 {stats['bytes'] / 1024:.1f}KB"
+        )
+    
+    def _summarize_history(self, model: str, summary: str, turns: List[Tuple[str, str]]) -> str:
+        """これまでの要約に古いターンを取り込んだ、新しい要約を返す"""
+        transcript = "\n".join(f"{'ユーザー' if role == 'user' else 'アシスタント'}: {text}" for role, text in turns)
+        response = create_chat_completion(
+            model=model,
+            messages=[
+                {"role": "system", "content": self.CHAT_SUMMARY_PROMPT},
+                {"role": "user", "content": f"これまでの要約:\n{summary or '（なし）'}\n\n追加の会話:\n{transcript}"}
+            ],
+            max_tokens=self.CHAT_SUMMARY_MAX_TOKENS
+        )
+        return response.choices[0].message.content
+    
+    def _render_map_reduce(self, inputs: Dict[str, Any], stream: bool):
+        """長文モードで生成し、部分要約を完了した順に表示してから統合した文章を表示する"""
+        progress = st.progress(0.0, text="文書を分割して要約しています...")
+        # 部分要約の表示欄は最初の部分要約が届いたときに作る（分割されなかった場合は表示しない）
+        partial_area = None
+        partials: Dict[int, str] = {}
+        
+        def show_partial(done: int, total: int, index: int, summary: str):
+            nonlocal partial_area
+            if partial_area is None:
+                with st.expander("部分ごとの要約", expanded=True):
+                    partial_area = st.empty()
+            partials[index] = summary
+            text = f"部分ごとの要約: {done}/{total} 件完了" if done < total else "部分ごとの要約が完了しました。統合しています..."
+            progress.progress(done / total, text=text)
+            partial_area.markdown("\n\n".join(f"**{i + 1}.** {partials[i]}" for i in sorted(partials)))
+        
+        def stream_reduce(messages: List[Dict[str, str]], max_tokens: int) -> Tuple[str, str, int]:
+            generated_text, _, tokens = self._generate_streaming(inputs["model"], messages, max_tokens)
+            return generated_text, inputs["model"], tokens
+        
+        try:
+            result = self.run_map_reduce(inputs, on_chunk=show_partial, generate=stream_reduce if stream else None)
+        except Exception as e:
+            st.error(f"エラーが発生しました: {str(e)}")
+            return
+        
+        if result["cache"]:
+            progress.empty()
+            st.success("文章が生成されました！（キャッシュから表示）")
+            self._render_result(result["text"])
+            return
+        if result["chunks"] == 1:
+            progress.empty()
+            st.success("文章が生成されました！（分割せずに要約）")
+        else:
+            st.success(f"文章が生成されました！（{result['chunks']} 個に分割して要約）")
+        if stream:
+            self._render_download(result["text"])
+            return
+        if inputs["model"] == AUTO_MODEL:
+            st.caption(f"使用したモデル: {result['model']}")
+        self._render_result(result["text"])
+    
+    def _generate_streaming(self, model: str, messages: List[Dict[str, str]], max_tokens: int):
+        """生成中の文章をトークン単位で表示し、(全文, 最初のトークンまでの秒数, 使用トークン数)を返す"""
+        # 途中で中止された場合に備えて、受信済みの文章をセッションに保持する
+        state = {"text": "", "done": False}
+        st.session_state.text_generation_stream = state
+        
+        # このボタンを押すとスクリプトが再実行され、受信中のストリームは中断される
+        st.button("生成を中止")
+        
+        st.markdown("### 生成された文章")
+        placeholder = st.empty()
+        placeholder.markdown("▌")
+        
+        started_at = time.perf_counter()
+        first_token_time = None
+        # 同じ内容を他のセッションが生成中なら、そのストリームを一緒に受け取る
+        stream = stream_chat_completion(
+            on_wait=wait_notice(),
+            model=model,
+            messages=messages,
+            max_tokens=max_tokens
+        )
+        try:
+            for delta in stream:
+                if first_token_time is None:
+                    first_token_time = time.perf_counter() - started_at
+                state["text"] += delta
+                placeholder.markdown(state["text"] + "▌")
+        finally:
+            # 中止・エラー時も受信をやめる（誰も受信していなければ接続も閉じられる）
+            stream.close()
+        
+        if stream.shared:
+            st.caption("同じ内容の生成が実行中だったため、その結果を共有しました")
+        if model == AUTO_MODEL and stream.model:
+            st.caption(f"使用したモデル: {stream.model}")
+        
+        placeholder.markdown(state["text"])
+        state["done"] = True
+        return state["text"], first_token_time, stream.total_tokens
+    
+    def _render_cache_stats(self, cache: ResponseCache, prompt_cache: NearDuplicateCache):
+        """キャッシュのヒット率と節約できた時間・トークン数を表示"""
+        stats = cache.stats()
+        with st.expander("キャッシュ統計"):
+            col1, col2, col3 = st.columns(3)
+            col1.metric("ヒット率", f"{stats['hit_rate']:.0%}")
+            col2.metric("節約した待ち時間", f"{stats['saved_seconds']:.1f}秒")
+            col3.metric("節約したトークン数", stats["saved_tokens"])
+            st.caption(
+                f"メモリヒット: {stats['memory_hits']} / ディスクヒット: {stats['disk_hits']} / "
+                f"ミス: {stats['misses']} / 保存件数: {stats['disk_entries']}"
+            )
+            render_prompt_cache_stats(prompt_cache)
+    
+    def _render_result(self, generated_text: str):
+        """生成された文章とダウンロードボタンを表示"""
+        st.markdown("### 生成された文章")
+        st.markdown(generated_text)
+        self._render_download(generated_text)
+    
+    def _render_download(self, generated_text: str):
+        """生成された文章のダウンロードボタンを表示"""
+        st.download_button(
+            label="テキストをダウンロード",
+            data=generated_text,
+            file_name="generated_text.txt",
+            mime="text/plain"
+        )
 
 # 画像説明サービス
 class ImageCaptioningService(AIService):
-    @property
-    def name(self) -> str:
-        return "画像説明生成"
+    name = "画像説明生成"
+    description = "アップロードした画像に対して、AIが説明文を生成します。"
+    icon = "🖼️"
     
-    @property
-    def description(self) -> str:
-        return "アップロードした画像に対して、AIが説明文を生成します。"
+    MODEL = "gpt-4o-mini"
+    PROMPT = "この画像について詳しく説明してください。"
     
-    @property
-    def icon(self) -> str:
-        return "🖼️"
+    IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+    
+    # ZIP内の1ファイルあたりの展開後サイズの上限
+    MAX_ZIP_MEMBER_BYTES = 20 * 1024 * 1024
+    
+    # run() で省略した入力の既定値
+    DEFAULT_INPUTS = {"byte_budget": DEFAULT_BYTE_BUDGET, "image_format": "JPEG", "max_distance": 5, "use_cache": True}
     
     def render(self):
         st.subheader("画像説明生成")
         
+        # 送信前の縮小・再エンコードの設定
+        with st.expander("送信設定"):
+            image_format = st.selectbox("送信形式", ["JPEG", "WEBP"])
+            byte_budget_kb = st.slider("送信サイズの上限 (KB)", 50, 1000, DEFAULT_BYTE_BUDGET // 1024, 50)
+            # 0 なら見た目がほぼ同一の画像のみ、値を大きくするほど似た画像もキャッシュから返す
+            max_distance = st.slider("キャッシュを使う類似度（ハミング距離の上限）", 0, 16, 5)
+        
+        cache = get_caption_cache()
+        self._render_cache_stats(cache)
+        options = {
+            "cache": cache,
+            "max_distance": max_distance,
+            "byte_budget": byte_budget_kb * 1024,
+            "image_format": image_format,
+        }
+        
+        # 処理モードの選択
+        mode = st.radio("処理モード", ["1枚ずつ", "一括（複数ファイル・ZIP）"], horizontal=True)
+        if mode == "1枚ずつ":
+            self._render_single(options)
+        else:
+            self._render_batch(options)
+    
+    def _render_single(self, options: Dict[str, Any]):
+        """1枚の画像の説明文を生成して表示"""
         # 画像アップロード
         uploaded_file = st.file_uploader("画像をアップロードしてください", type=["jpg", "jpeg", "png"])
         
@@ -127,54 +686,374 @@ class ImageCaptioningService(AIService):
             if st.button("画像の説明を生成"):
                 with st.spinner("説明文を生成中..."):
                     try:
-                        # ここは実際のAPIに合わせて調整が必要
-                        # この例ではOpenAI Vision APIを想定していますが、実装が異なる場合は調整してください
-                        # 実際のVision APIコードは以下のようになりますが、
-                        # 本コードは概念的な実装例として提供しています
-                        
-                        # 画像のエンコードなどの前処理が必要
-                        # response = client.chat.completions.create(
-                        #     model="gpt-4-vision-preview",
-                        #     messages=[
-                        #         {
-                        #             "role": "user",
-                        #             "content": [
-                        #                 {"type": "text", "text": "この画像について詳しく説明してください。"},
-                        #                 {"type": "image_url", "image_url": {"url": "data:image/jpeg;base64,..."}}
-                        #             ]
-                        #         }
-                        #     ],
-                        #     max_tokens=300
-                        # )
-                        # caption = response.choices[0].message.content
-                        
-                        # デモ用のキャプション例
-                        caption = "これは美しい風景写真です。緑豊かな森と青い空が広がっています。自然の中で撮影されたこの写真は、季節は春または夏と思われます。木々の間から光が差し込んでおり、とても平和な雰囲気が伝わってきます。"
+                        caption, prepared, distance = self.caption_cached(uploaded_file.getvalue(), **options)
                         
                         st.success("説明文が生成されました！")
                         st.markdown("### 生成された説明文")
                         st.markdown(caption)
-                        
+                        if prepared is None:
+                            st.caption(f"類似画像のキャッシュから表示しました（ハミング距離: {distance}）")
+                        else:
+                            st.caption(
+                                f"送信サイズ: {prepared['original_bytes'] / 1024:.0f}KB → {len(prepared['data']) / 1024:.0f}KB / "
+                                f"解像度: {prepared['original_width']}×{prepared['original_height']} → "
+                                f"{prepared['width']}×{prepared['height']}"
+                            )
+                    
                     except Exception as e:
                         st.error(f"エラーが発生しました: {str(e)}")
+    
+    def _render_batch(self, options: Dict[str, Any]):
+        """複数の画像・ZIPファイルの説明文を並列に生成し、CSVでダウンロードできるようにする"""
+        uploaded_files = st.file_uploader(
+            "画像または画像をまとめたZIPファイルをアップロードしてください",
+            type=["jpg", "jpeg", "png", "zip"],
+            accept_multiple_files=True
+        )
+        max_workers = st.slider("同時実行数", 1, 16, 4)
+        if not uploaded_files or not st.button("一括で説明文を生成"):
+            return
+        
+        pd = lazy_import("pandas")
+        with tempfile.TemporaryDirectory() as workdir, ExitStack() as archives:
+            try:
+                names, items = self._iter_batch_images(uploaded_files, workdir, archives)
+            except zipfile.BadZipFile as e:
+                st.error(f"ZIPファイルを読み込めませんでした: {str(e)}")
+                return
+            if not names:
+                st.warning("画像ファイルが見つかりませんでした")
+                return
+            
+            results = pd.DataFrame({"filename": names, "caption": None, "source": None, "error": None})
+            progress = st.progress(0.0, text=f"0 / {len(names)} 件")
+            table = st.empty()
+            last_update = 0.0
+            
+            for completed, (index, result, error) in enumerate(
+                self._caption_batch(items, options, max_workers),
+                start=1
+            ):
+                if error is not None:
+                    results.at[index, "error"] = str(error)
+                else:
+                    caption, prepared, _ = result
+                    results.at[index, "caption"] = caption
+                    results.at[index, "source"] = "cache" if prepared is None else "api"
+                
+                progress.progress(completed / len(names), text=f"{completed} / {len(names)} 件")
+                # 表の再描画は重いため、一定間隔ごとにまとめて更新する
+                now = time.perf_counter()
+                if now - last_update > 0.5 or completed == len(names):
+                    table.dataframe(results, use_container_width=True)
+                    last_update = now
+        
+        failed = int(results["error"].notna().sum())
+        if failed:
+            st.warning(f"{failed} 件の生成に失敗しました。error 列を確認してください。")
+        else:
+            st.success("すべての説明文が生成されました！")
+        
+        st.download_button(
+            label="結果をCSVでダウンロード",
+            data=results[["filename", "caption", "error"]].to_csv(index=False).encode("utf-8-sig"),
+            file_name="image_captions.csv",
+            mime="text/csv"
+        )
+    
+    def _caption_batch(self, readers: List[Callable[[], bytes]], options: Dict[str, Any], max_workers: int):
+        """readers の各画像を読み込んで並列に説明文を生成し、完了順に (index, 結果, 例外) を返す
+        
+        画像の読み込みもワーカー内で行うため、壊れたZIPメンバーなどの読み込みエラーは
+        その画像の例外として返り、残りの画像の処理は続く。
+        """
+        def caption_item(read: Callable[[], bytes]):
+            return self.caption_cached(read(), **options)
+        
+        return run_bounded(caption_item, readers, max_workers=max_workers)
+    
+    def _iter_batch_images(self, uploaded_files, workdir: str, archives: ExitStack):
+        """アップロードされたファイルから (ファイル名の一覧, 画像データを読み込む関数の一覧) を作る
+        
+        ZIPは一時ファイルに書き出し、読み込む関数が呼ばれたときに1ファイルずつ読み出すため、
+        展開後の全画像を同時にメモリに載せることはない。開いたZIPは archives が閉じる。
+        """
+        sources = []
+        for position, uploaded_file in enumerate(uploaded_files):
+            if not uploaded_file.name.lower().endswith(".zip"):
+                sources.append((uploaded_file.name, uploaded_file, None))
+                continue
+            
+            path = os.path.join(workdir, f"upload_{position}.zip")
+            with open(path, "wb") as f:
+                shutil.copyfileobj(uploaded_file, f, 1024 * 1024)
+            archive = archives.enter_context(zipfile.ZipFile(path))
+            for info in archive.infolist():
+                if info.is_dir() or info.filename.startswith("__MACOSX/"):
+                    continue
+                if not info.filename.lower().endswith(self.IMAGE_EXTENSIONS):
+                    continue
+                if info.file_size > self.MAX_ZIP_MEMBER_BYTES:
+                    continue
+                sources.append((f"{uploaded_file.name}/{info.filename}", archive, info))
+        
+        readers = [
+            source.getvalue if info is None else functools.partial(source.read, info)
+            for _, source, info in sources
+        ]
+        return [name for name, _, _ in sources], readers
+    
+    def run(self, inputs: Dict[str, Any], allow_local_files: bool = False) -> Dict[str, Any]:
+        """画像の説明文を生成し、{caption, distance, sent_bytes} を返す
+        
+        画像は image_base64 で指定する（allow_local_files が True の場合は image_path でファイルのパスも指定できる）。
+        byte_budget / image_format / max_distance / use_cache も指定できる。
+        キャッシュから返した場合は distance にハミング距離が入り、sent_bytes は None になる。
+        """
+        inputs = prepare_inputs(self.DEFAULT_INPUTS, inputs)
+        if inputs.get("image_path"):
+            if not allow_local_files:
+                raise InvalidInputError("image_path は指定できません。画像は image_base64 で指定してください")
+            with open(inputs["image_path"], "rb") as f:
+                image_data = f.read()
+        elif inputs.get("image_base64"):
+            try:
+                image_data = decode_image(inputs["image_base64"], inputs["image_format"])
+            except ValueError as e:
+                raise InvalidInputError(str(e)) from None
+        else:
+            raise InvalidInputError("image_path または image_base64 を指定してください")
+        
+        options = {"byte_budget": int(inputs["byte_budget"]), "image_format": inputs["image_format"]}
+        if inputs["use_cache"]:
+            caption, prepared, distance = self.caption_cached(
+                image_data,
+                get_caption_cache(),
+                max_distance=int(inputs["max_distance"]),
+                **options
+            )
+        else:
+            (caption, prepared), distance = self.caption(image_data, **options), None
+        return {
+            "caption": caption,
+            "distance": distance,
+            "sent_bytes": len(prepared["data"]) if prepared is not None else None,
+        }
+    
+    def caption(
+        self,
+        image_data: bytes,
+        byte_budget: int = DEFAULT_BYTE_BUDGET,
+        image_format: str = "JPEG"
+    ) -> Tuple[str, Dict[str, Any]]:
+        """画像を縮小・再エンコードして Vision API に送り、(説明文, 送信した画像の情報) を返す"""
+        prepared = prepare_image(image_data, byte_budget=byte_budget, image_format=image_format)
+        response = create_chat_completion(
+            model=self.MODEL,
+            messages=[
+                {
+                    "role": "user",
+                    "content": [
+                        {"type": "text", "text": self.PROMPT},
+                        {"type": "image_url", "image_url": {"url": to_data_url(prepared)}}
+                    ]
+                }
+            ],
+            max_tokens=300
+        )
+        return response.choices[0].message.content, prepared
+    
+    def caption_cached(
+        self,
+        image_data: bytes,
+        cache: PerceptualHashCache,
+        max_distance: int = 5,
+        **kwargs
+    ) -> Tuple[str, Optional[Dict[str, Any]], Optional[int]]:
+        """類似画像の説明文がキャッシュにあればそれを返し、なければ caption() を呼ぶ
+        
+        返り値は (説明文, 送信した画像の情報, ハミング距離)。キャッシュから返した場合は
+        画像の情報が None、API を呼んだ場合は距離が None になる。
+        """
+        key = fingerprint(image_data)
+        cached = cache.lookup(key, max_distance)
+        if cached is not None:
+            return cached[0], None, cached[1]
+        caption, prepared = self.caption(image_data, **kwargs)
+        cache.store(key, caption)
+        return caption, prepared, None
+    
+    def _render_cache_stats(self, cache: PerceptualHashCache):
+        """画像キャッシュのヒット率と保存件数を表示"""
+        stats = cache.stats()
+        with st.expander("キャッシュ統計"):
+            col1, col2, col3 = st.columns(3)
+            col1.metric("ヒット率", f"{stats['hit_rate']:.0%}")
+            col2.metric("類似画像でのヒット", stats["near_hits"])
+            col3.metric("保存件数", stats["entries"])
+            st.caption(
+                f"完全一致: {stats['exact_hits']} / ミス: {stats['misses']} / 削除: {stats['evictions']}"
+            )
 
 # 感情分析サービス
 class SentimentAnalysisService(AIService):
-    @property
-    def name(self) -> str:
-        return "テキスト感情分析"
+    name = "テキスト感情分析"
+    description = "入力されたテキストの感情（ポジティブ/ネガティブ）を分析します。"
+    icon = "😊"
     
-    @property
-    def description(self) -> str:
-        return "入力されたテキストの感情（ポジティブ/ネガティブ）を分析します。"
+    SYSTEM_PROMPT = (
+        "あなたは感情分析の専門家です。テキストのポジティブさ/ネガティブさを0から10のスケールで評価し、簡単な説明をJSON形式で返してください。" +
+        "例: {\"score\": 7, \"sentiment\": \"positive\", \"explanation\": \"理由の説明\"}"
+    )
     
-    @property
-    def icon(self) -> str:
-        return "😊"
+    MODEL = "gpt-3.5-turbo"
+    
+    # スキーマに合わない応答だった場合の最大試行回数
+    MAX_ATTEMPTS = 2
+    
+    # API を呼ばずに判定するローカルの辞書スコアラー
+    lexicon = LexiconSentimentScorer()
+    
+    # 選択できるモデル（auto はレイテンシを見て自動で選ぶ）
+    MODEL_OPTIONS = [AUTO_MODEL, MODEL, "gpt-4o-mini"]
+    
+    # run() で省略した入力の既定値
+    DEFAULT_INPUTS = {"local_threshold": 0.6, "model": MODEL, "use_cache": True, "similarity_threshold": 0.95}
+    
+    # 判定した経路の表示名
+    SOURCE_LABELS = {
+        "local": "ローカル辞書（API呼び出しなし）",
+        "llm": "LLM",
+        "cache": "類似テキストのキャッシュ（API呼び出しなし）",
+    }
     
     def render(self):
         st.subheader("テキスト感情分析")
         
+        # ローカル判定の信頼度がこの値以上なら LLM を呼ばない
+        local_threshold = st.slider(
+            "ローカル判定の信頼度しきい値（1.0 で常に LLM を使用）",
+            0.0, 1.0, 0.6, 0.05
+        )
+        
+        # LLM で判定する場合のモデル
+        model = st.selectbox(
+            "LLM のモデル", self.MODEL_OPTIONS, index=self.MODEL_OPTIONS.index(self.MODEL), format_func=model_label
+        )
+        
+        # LLM の判定結果を類似テキストに使い回す設定
+        with st.expander("キャッシュ設定"):
+            bypass_cache = st.checkbox("キャッシュを使わずに分析する", value=False)
+            similarity_threshold = st.slider("キャッシュを使う類似度（1.0 で表記ゆれのみ）", 0.7, 1.0, 0.95, 0.01)
+            render_prompt_cache_stats(get_prompt_cache())
+        options = {
+            "local_threshold": local_threshold,
+            "model": model,
+            "use_cache": not bypass_cache,
+            "similarity_threshold": similarity_threshold,
+        }
+        
+        # 分析モードの選択
+        mode = st.radio("分析モード", ["テキスト入力", "ファイル一括分析（CSV/JSONL）"], horizontal=True)
+        if mode == "テキスト入力":
+            self._render_single(options)
+        else:
+            self._render_bulk(options)
+    
+    def run(self, inputs: Dict[str, Any], allow_local_files: bool = False) -> Dict[str, Any]:
+        """inputs の text の感情を分析し、analyze() と同じ辞書を返す
+        
+        local_threshold / model / use_cache / similarity_threshold も指定できる。
+        """
+        inputs = prepare_inputs(self.DEFAULT_INPUTS, inputs)
+        text = inputs.get("text")
+        if text is None or not str(text).strip():
+            raise InvalidInputError("text を指定してください")
+        return self.analyze(str(text), **self._analyze_options(inputs))
+    
+    @staticmethod
+    def _analyze_options(inputs: Dict[str, Any]) -> Dict[str, Any]:
+        """run() の入力を analyze() の引数に変換する"""
+        return {
+            "local_threshold": float(inputs["local_threshold"]),
+            "model": inputs["model"],
+            "cache": get_prompt_cache() if inputs["use_cache"] else None,
+            "similarity_threshold": float(inputs["similarity_threshold"]),
+        }
+    
+    def analyze(
+        self,
+        text: str,
+        local_threshold: float = 0.6,
+        rate_limiter: Optional[RateLimiter] = None,
+        model: str = MODEL,
+        cache: Optional[NearDuplicateCache] = None,
+        similarity_threshold: float = 0.95
+    ) -> Dict[str, Any]:
+        """テキストの感情を分析し、{score, sentiment, explanation} を返す
+        
+        まずローカル辞書で判定し、信頼度が local_threshold 未満の場合のみ LLM に問い合わせる。
+        cache を渡すと、類似度が similarity_threshold 以上のテキストの LLM の判定結果を使い回す。
+        どの経路で判定したかは source（"local" / "llm" / "cache"）に、LLM の場合は応答したモデルを model に入れる。
+        rate_limiter を渡すと LLM を呼ぶ場合のみ発行間隔を調整する。
+        スキーマに合う応答が得られなかった場合は StructuredOutputError を送出する。
+        """
+        analysis, confidence = self.lexicon.analyze(text)
+        if confidence >= local_threshold:
+            analysis["source"] = "local"
+            analysis["confidence"] = confidence
+            return analysis
+        
+        scope = ResponseCache.make_key(model=model, system_prompt=self.SYSTEM_PROMPT)
+        if cache is not None:
+            similar = cache.lookup(scope, text, similarity_threshold)
+            if similar is not None:
+                return dict(similar[0], source="cache", similarity=similar[1])
+        
+        if rate_limiter is not None:
+            rate_limiter.wait()
+        
+        started_at = time.perf_counter()
+        
+        messages = [
+            {"role": "system", "content": self.SYSTEM_PROMPT},
+            {"role": "user", "content": text}
+        ]
+        # auto の場合は厳密なスキーマを渡し、選ばれたモデルが非対応なら JSON モードに切り替わる
+        if model == AUTO_MODEL:
+            response_format = strict_response_format("sentiment_analysis", SENTIMENT_SCHEMA)
+        else:
+            response_format = response_format_for(model, "sentiment_analysis", SENTIMENT_SCHEMA)
+        for attempt in range(1, self.MAX_ATTEMPTS + 1):
+            # JSONモード / Structured Outputs でスキーマに沿った出力を要求
+            response = create_chat_completion(
+                model=model,
+                messages=messages,
+                response_format=response_format
+            )
+            
+            analysis_text = response.choices[0].message.content or ""
+            try:
+                analysis = validate_sentiment(extract_json_object(analysis_text), analysis_text)
+            except StructuredOutputError as e:
+                if attempt == self.MAX_ATTEMPTS:
+                    raise
+                # 誤りの内容を伝えて再出力させる
+                messages = messages + [
+                    {"role": "assistant", "content": analysis_text},
+                    {"role": "user", "content": f"出力が形式に合っていません（{e}）。指定のJSONオブジェクトのみを出力してください。"}
+                ]
+                continue
+            
+            analysis["source"] = "llm"
+            analysis["model"] = response.model
+            if cache is not None:
+                tokens = response.usage.total_tokens if response.usage else 0
+                cache.store(scope, text, dict(analysis), latency=time.perf_counter() - started_at, tokens=tokens)
+            return analysis
+    
+    def _render_single(self, options: Dict[str, Any]):
+        """1件のテキストを分析して結果を表示"""
         # テキスト入力
         text = st.text_area("分析したいテキストを入力してください", height=150)
         
@@ -186,88 +1065,234 @@ class SentimentAnalysisService(AIService):
             
             with st.spinner("感情を分析中..."):
                 try:
-                    # 新しいOpenAI APIの形式
-                    response = client.chat.completions.create(
-                        model="gpt-3.5-turbo",
-                        messages=[
-                            {
-                                "role": "system", 
-                                "content": "あなたは感情分析の専門家です。テキストのポジティブさ/ネガティブさを0から10のスケールで評価し、簡単な説明をJSON形式で返してください。" +
-                                           "例: {\"score\": 7, \"sentiment\": \"positive\", \"explanation\": \"理由の説明\"}"
-                            },
-                            {"role": "user", "content": text}
-                        ]
-                    )
+                    analysis = self.run(dict(options, text=text))
                     
-                    analysis_text = response.choices[0].message.content
-                    # ここでは簡易的な実装のため、本来であればJSON解析をしっかり行う
-                    import json
-                    try:
-                        analysis = json.loads(analysis_text)
-                        
-                        # 結果表示
-                        sentiment = analysis.get("sentiment", "neutral")
-                        score = analysis.get("score", 5)
-                        explanation = analysis.get("explanation", "分析結果がありません")
-                        
-                        # 感情スコアの視覚化
-                        if sentiment.lower() == "positive":
-                            color = "green"
-                            emoji = "😊"
-                        elif sentiment.lower() == "negative":
-                            color = "red"
-                            emoji = "😔"
-                        else:
-                            color = "gray"
-                            emoji = "😐"
-                        
-                        st.markdown(f"### 分析結果 {emoji}")
-                        st.markdown(f"**感情傾向:** {sentiment}")
-                        st.markdown(f"**スコア:** {score}/10")
-                        
-                        # プログレスバーで表示
-                        st.progress(score/10)
-                        
-                        st.markdown(f"**分析の説明:**")
-                        st.markdown(explanation)
-                        
-                    except json.JSONDecodeError:
-                        # JSONとして解析できない場合は生のテキストを表示
-                        st.markdown("### 分析結果")
-                        st.markdown(analysis_text)
-                        
+                    # 結果表示
+                    sentiment = analysis["sentiment"]
+                    score = analysis["score"]
+                    explanation = analysis["explanation"]
+                    
+                    # 感情スコアの視覚化
+                    if sentiment.lower() == "positive":
+                        color = "green"
+                        emoji = "😊"
+                    elif sentiment.lower() == "negative":
+                        color = "red"
+                        emoji = "😔"
+                    else:
+                        color = "gray"
+                        emoji = "😐"
+                    
+                    st.markdown(f"### 分析結果 {emoji}")
+                    st.markdown(f"**感情傾向:** {sentiment}")
+                    st.markdown(f"**スコア:** {score}/10")
+                    
+                    # プログレスバーで表示
+                    st.progress(score/10)
+                    
+                    st.markdown(f"**分析の説明:**")
+                    st.markdown(explanation)
+                    
+                    # どの経路で判定したかを表示
+                    caption = f"判定方法: {self.SOURCE_LABELS[analysis['source']]}"
+                    if analysis["source"] == "local":
+                        caption += f" / 信頼度: {analysis['confidence']:.2f}"
+                    elif analysis["source"] == "cache":
+                        caption += f" / 類似度: {analysis['similarity']:.2f}（{analysis['model']}）"
+                    else:
+                        caption += f"（{analysis['model']}）"
+                    st.caption(caption)
+                
+                except StructuredOutputError as e:
+                    st.error(f"分析結果を読み取れませんでした: {str(e)}")
+                    with st.expander("モデルの応答"):
+                        st.text(e.raw)
                 except Exception as e:
                     st.error(f"エラーが発生しました: {str(e)}")
+    
+    def _render_bulk(self, options: Dict[str, Any]):
+        """CSV/JSONLファイルの指定列を並列に分析し、結果をダウンロードできるようにする"""
+        uploaded_file = st.file_uploader("CSV または JSONL ファイルをアップロードしてください", type=["csv", "jsonl"])
+        if uploaded_file is None:
+            return
+        
+        pd = lazy_import("pandas")
+        is_jsonl = uploaded_file.name.lower().endswith(".jsonl")
+        try:
+            if is_jsonl:
+                df = pd.read_json(uploaded_file, lines=True)
+            else:
+                df = pd.read_csv(uploaded_file)
+        except Exception as e:
+            st.error(f"ファイルを読み込めませんでした: {str(e)}")
+            return
+        df = df.reset_index(drop=True)
+        
+        column = st.selectbox("分析する列", list(df.columns))
+        col1, col2 = st.columns(2)
+        with col1:
+            max_workers = st.slider("同時実行数", 1, 16, 4)
+        with col2:
+            requests_per_minute = st.number_input("1分あたりの最大リクエスト数", min_value=1, max_value=10000, value=60)
+        st.caption(f"{len(df)} 件のデータが読み込まれました")
+        
+        if not st.button("一括分析を開始"):
+            return
+        
+        results = df.copy()
+        for key in ("score", "sentiment", "explanation", "source", "error"):
+            results[key] = None
+        
+        progress = st.progress(0.0, text=f"0 / {len(df)} 件")
+        table = st.empty()
+        last_update = 0.0
+        
+        # LLM を呼ぶ行だけがレート制限の対象になる
+        limiter = RateLimiter(requests_per_minute)
+        
+        analyze_options = self._analyze_options(options)
+        
+        def analyze_row(value):
+            if pd.isna(value) or not str(value).strip():
+                raise ValueError("テキストが空です")
+            return self.analyze(str(value), rate_limiter=limiter, **analyze_options)
+        
+        texts = df[column].tolist()
+        for completed, (index, analysis, error) in enumerate(
+            run_bounded(analyze_row, texts, max_workers=max_workers),
+            start=1
+        ):
+            if error is not None:
+                results.at[index, "error"] = str(error)
+            else:
+                results.at[index, "score"] = analysis["score"]
+                results.at[index, "sentiment"] = analysis["sentiment"]
+                results.at[index, "explanation"] = analysis["explanation"]
+                results.at[index, "source"] = analysis["source"]
+            
+            progress.progress(completed / len(texts), text=f"{completed} / {len(texts)} 件")
+            # 表の再描画は重いため、一定間隔ごとにまとめて更新する
+            now = time.perf_counter()
+            if now - last_update > 0.5 or completed == len(texts):
+                table.dataframe(results)
+                last_update = now
+        
+        local_count = int((results["source"] == "local").sum())
+        llm_count = int((results["source"] == "llm").sum())
+        cache_count = int((results["source"] == "cache").sum())
+        st.caption(
+            f"ローカル辞書で判定: {local_count} 件 / LLM で判定: {llm_count} 件 / "
+            f"類似テキストのキャッシュ: {cache_count} 件"
+        )
+        
+        failed = int(results["error"].notna().sum())
+        if failed:
+            st.warning(f"{failed} 件の分析に失敗しました。error 列を確認してください。")
+        else:
+            st.success("すべての分析が完了しました！")
+        
+        # 入力と同じ形式でダウンロード
+        if is_jsonl:
+            data = results.to_json(orient="records", lines=True, force_ascii=False)
+            file_name, mime = "sentiment_results.jsonl", "application/json"
+        else:
+            data = results.to_csv(index=False).encode("utf-8-sig")
+            file_name, mime = "sentiment_results.csv", "text/csv"
+        st.download_button(
+            label="分析結果をダウンロード",
+            data=data,
+            file_name=file_name,
+            mime=mime
+        )
+
+# 登録済みサービスの情報（インスタンスは初回利用時に生成する）
+class ServiceEntry:
+    def __init__(
+        self,
+        name: str,
+        icon: str,
+        description: str,
+        factory: Callable[[], AIService],
+        instance: Optional[AIService] = None,
+    ):
+        self.name = name
+        self.icon = icon
+        self.description = description
+        self.factory = factory
+        self.enabled = True
+        # 生成済みのインスタンスを渡された場合は factory を呼ばずにそれを使う
+        self._instance = instance
+        self._lock = threading.Lock()
+    
+    @property
+    def instance(self) -> AIService:
+        """サービスのインスタンスを返す（未生成なら生成する）"""
+        if self._instance is None:
+            with self._lock:
+                if self._instance is None:
+                    self._instance = self.factory()
+        return self._instance
 
 # サービス管理クラス
 class ServiceManager:
     def __init__(self):
-        self.services: List[AIService] = []
+        # 名前 -> エントリ（登録順を保持）
+        self._entries: Dict[str, ServiceEntry] = {}
     
     def register_service(self, service: AIService):
         """新しいサービスを登録"""
-        self.services.append(service)
+        self._entries[service.name] = ServiceEntry(
+            service.name, service.icon, service.description, lambda: service, instance=service
+        )
+    
+    def register_factory(self, service_class: Type[AIService], factory: Optional[Callable[[], AIService]] = None):
+        """新しいサービスを登録（名前・アイコン・説明はクラス属性から読み、インスタンスは初回利用時に factory で生成）"""
+        self._entries[service_class.name] = ServiceEntry(
+            service_class.name, service_class.icon, service_class.description, factory or service_class
+        )
+    
+    def get_entries(self, include_disabled: bool = False) -> List[ServiceEntry]:
+        """登録されているサービスのエントリを取得（インスタンスは生成しない）"""
+        return [entry for entry in self._entries.values() if include_disabled or entry.enabled]
     
     def get_services(self) -> List[AIService]:
-        """登録されているすべてのサービスを取得"""
-        return self.services
+        """有効なすべてのサービスを取得"""
+        return [entry.instance for entry in self.get_entries()]
     
     def get_service_by_name(self, name: str) -> Optional[AIService]:
-        """名前でサービスを検索"""
-        for service in self.services:
-            if service.name == name:
-                return service
+        """名前でサービスを検索（無効化されている場合は None）"""
+        entry = self._entries.get(name)
+        if entry is None or not entry.enabled:
+            return None
+        return entry.instance
+    
+    def set_enabled(self, name: str, enabled: bool):
+        """サービスの有効/無効を切り替える（全セッションに反映される）"""
+        if name in self._entries:
+            self._entries[name].enabled = enabled
+
+def admin_password() -> Optional[str]:
+    """サービス設定を開くための管理者パスワード（ADMIN_PASSWORD が未設定なら None で、設定は表示しない）"""
+    try:
+        return get_secret("ADMIN_PASSWORD") or None
+    except (KeyError, FileNotFoundError):
         return None
 
+# プロセス内で1度だけ構築し、全セッション・全再実行で共有するサービス一覧
+@st.cache_resource
+def get_service_manager() -> ServiceManager:
+    manager = ServiceManager()
+    
+    # サービスの登録
+    manager.register_factory(TextGenerationService)
+    manager.register_factory(ImageCaptioningService)
+    manager.register_factory(SentimentAnalysisService)
+    return manager
+
 # アプリケーションメインクラス
 class AIServicesApp:
     def __init__(self):
-        self.service_manager = ServiceManager()
-        
-        # サービスの登録
-        self.service_manager.register_service(TextGenerationService())
-        self.service_manager.register_service(ImageCaptioningService())
-        self.service_manager.register_service(SentimentAnalysisService())
+        self.service_manager = get_service_manager()
         
         # セッション状態の初期化
         if 'current_service' not in st.session_state:
@@ -275,6 +1300,10 @@ class AIServicesApp:
     
     def run(self):
         """アプリケーションを実行"""
+        # 前回の実行（再実行・ページ移動で中断されたもの）の外部呼び出しが残っていれば中止する
+        session_id = current_session_id()
+        get_outbound().cancel_session(session_id)
+        
         # サイドバーの設定
         self._setup_sidebar()
         
@@ -282,7 +1311,10 @@ class AIServicesApp:
         if st.session_state.current_service:
             service = self.service_manager.get_service_by_name(st.session_state.current_service)
             if service:
-                service.render()
+                # レンダリングの回数と所要時間を記録（中の LLM 呼び出しは子スパンになる）
+                # LLM の順番待ちはセッション単位で公平に割り当て、外部呼び出しは共有スレッドで実行する
+                with bind_session(session_id), bind_outbound_session(session_id), span(service.name, "render"):
+                    service.render()
         else:
             self._render_home()
     
@@ -300,10 +1332,34 @@ class AIServicesApp:
             st.markdown("## サービス一覧")
             
             # サービス一覧の表示
-            for service in self.service_manager.get_services():
-                if st.button(f"{service.icon} {service.name}"):
-                    st.session_state.current_service = service.name
+            for entry in self.service_manager.get_entries():
+                if st.button(f"{entry.icon} {entry.name}"):
+                    st.session_state.current_service = entry.name
                     st.rerun()
+            
+            # サービスの有効/無効の切り替え（再起動せずに全セッションへ反映するため、管理者だけに表示する）
+            password = admin_password()
+            if password is not None:
+                with st.expander("サービス設定"):
+                    self._render_service_settings(password)
+    
+    def _render_service_settings(self, password: str):
+        """管理者のパスワードを確認し、サービスの有効/無効を切り替えるチェックボックスを表示する"""
+        if not st.session_state.get("is_admin"):
+            entered = st.text_input("管理者パスワード", type="password")
+            if entered and hmac.compare_digest(entered.encode("utf-8"), password.encode("utf-8")):
+                st.session_state.is_admin = True
+                st.rerun()
+            elif entered:
+                st.error("パスワードが違います")
+            return
+        
+        # key を付けず、毎回の実行で現在の状態（他のセッションでの変更を含む）を表示する
+        for entry in self.service_manager.get_entries(include_disabled=True):
+            enabled = st.checkbox(entry.name, value=entry.enabled)
+            if enabled != entry.enabled:
+                self.service_manager.set_enabled(entry.name, enabled)
+                st.rerun()
     
     def _render_home(self):
         """ホーム画面のレンダリング"""
@@ -313,8 +1369,8 @@ class AIServicesApp:
         サイドバーから利用したいサービスを選択してください。
         """)
         
-        # サービスカードの表示
-        services = self.service_manager.get_services()
+        # サービスカードの表示（インスタンスを生成せずに登録情報だけを使う）
+        services = self.service_manager.get_entries()
         
         # 2列のレイアウト
         cols = st.columns(2)
@@ -334,20 +1390,167 @@ class AIServicesApp:
                 </div>
                 """, unsafe_allow_html=True)
         
-        # 利用統計（デモ用）
+        # 利用統計
         st.markdown("## 📊 利用統計")
+        self._render_usage_stats(services)
         
-        # デモ用のデータ
+        # 起動時間のプロファイル
+        self._render_startup_profile()
+        
+        # 直近のスパンと Prometheus 形式の集計
+        self._render_traces()
+        
+        # 全セッション共通のレート制限の状況
+        self._render_rate_limit_stats()
+    
+    def _render_usage_stats(self, services: List[ServiceEntry]):
+        """記録されたメトリクスからサービス別の利用回数とレイテンシを表示"""
+        pd = lazy_import("pandas")
+        px = lazy_import("plotly.express")
+        
+        windows = {"直近1時間": 60 * 60, "直近24時間": 24 * 60 * 60, "直近7日間": 7 * 24 * 60 * 60}
+        window = st.selectbox("集計期間", list(windows.keys()), index=1)
+        rows = get_metrics().query(windows[window])
+        
+        # サービス別の利用回数（利用のないサービスも0件として表示）
+        counts = {row["name"]: row["count"] for row in rows if row["kind"] == "render"}
         data = {
-            'サービス': ['AI文章生成', '画像説明生成', 'テキスト感情分析'],
-            '利用回数': [154, 89, 112]
+            'サービス': [service.name for service in services],
+            '利用回数': [counts.get(service.name, 0) for service in services]
         }
         df = pd.DataFrame(data)
         
         # グラフの表示
         fig = px.bar(df, x='サービス', y='利用回数', color='サービス',
-                    title='サービス別利用回数')
+                    title=f'サービス別利用回数（{window}）')
         st.plotly_chart(fig, use_container_width=True)
+        
+        if not rows:
+            st.info("この期間の利用データはまだありません。")
+            return
+        
+        # 処理種別ごとのレイテンシ
+        kind_labels = {"render": "画面表示", "openai": "OpenAI API", "webhook": "Webhook"}
+        latency_df = pd.DataFrame([
+            {
+                "対象": row["name"],
+                "種別": kind_labels.get(row["kind"], row["kind"]),
+                "回数": row["count"],
+                "エラー": row["errors"],
+                "p50 (秒)": round(row["p50"], 3),
+                "p95 (秒)": round(row["p95"], 3),
+            }
+            for row in rows
+        ])
+        st.markdown("### レイテンシ")
+        st.dataframe(latency_df, use_container_width=True)
+    
+    def _render_startup_profile(self):
+        """遅延インポートの読み込み時間と、python -X importtime の結果を表示"""
+        with st.expander("⏱️ 起動時間プロファイル"):
+            timings = import_timings()
+            if timings:
+                st.markdown("**初回利用時に読み込んだモジュール**")
+                st.dataframe(
+                    [{"モジュール": name, "読み込み時間 (ms)": round(seconds * 1000, 1)} for name, seconds in timings.items()],
+                    use_container_width=True
+                )
+            
+            # 別プロセスで main.py の import にかかる時間を計測する
+            if st.button("import time を計測"):
+                with st.spinner("計測中..."):
+                    rows = profile_imports("main")
+                st.dataframe(
+                    [
+                        {
+                            "モジュール": row["module"],
+                            "累積 (ms)": round(row["cumulative_us"] / 1000, 1),
+                            "自身 (ms)": round(row["self_us"] / 1000, 1),
+                        }
+                        for row in rows
+                    ],
+                    use_container_width=True
+                )
+    
+    def _render_traces(self):
+        """記録されたスパンのうち遅いものと、Prometheus 形式の集計を表示"""
+        with st.expander("🔍 トレース（管理者向け）"):
+            tracer = get_tracer()
+            min_duration = st.number_input("表示する最小の所要時間（秒）", min_value=0.0, value=0.5, step=0.5)
+            spans = sorted(tracer.recent(limit=500, min_duration=min_duration), key=lambda s: s["duration"], reverse=True)
+            if spans:
+                st.dataframe(
+                    [
+                        {
+                            "種別": record["kind"],
+                            "対象": record["name"],
+                            "所要時間 (秒)": round(record["duration"], 3),
+                            "状態": record["status"],
+                            "送信 (B)": record["bytes_out"],
+                            "受信 (B)": record["bytes_in"],
+                            "トークン": record["prompt_tokens"] + record["completion_tokens"],
+                            "エラー": record["error"] or "",
+                        }
+                        for record in spans[:50]
+                    ],
+                    use_container_width=True
+                )
+            else:
+                st.info("該当するスパンはまだありません。")
+            
+            # SYNAPSE_METRICS_PORT を設定すると http://<host>:<port>/metrics からも取得できる
+            metrics_text = tracer.prometheus_text()
+            st.download_button("Prometheus 形式でダウンロード", metrics_text, file_name="metrics.prom", mime="text/plain")
+            st.code(metrics_text, language="text")
+    
+    def _render_rate_limit_stats(self):
+        """OpenAI API の共有レートリミッタの発行数・待ち時間・429 の回数と、相乗りで節約した呼び出し数を表示"""
+        with st.expander("🚦 API 呼び出しの制御（全セッション共通）"):
+            limiter = get_rate_limiter()
+            stats = limiter.stats()
+            col1, col2, col3, col4 = st.columns(4)
+            col1.metric("発行数", stats["granted"])
+            col2.metric("順番待ちが発生", stats["waited"])
+            col3.metric("平均待ち時間", f"{stats['avg_wait_seconds']:.1f}秒")
+            col4.metric("429 による一時停止", stats["throttled"])
+            st.caption(
+                f"待機中: {stats['queued']} 件（{stats['sessions_waiting']} セッション） / "
+                f"上限: {limiter.request_rate * 60:.0f} リクエスト/分・{limiter.token_rate * 60:.0f} トークン/分"
+            )
+            
+            # 同時に来た同じリクエストを1回の呼び出しにまとめた回数
+            flights = get_single_flight().stats()
+            col1, col2, col3 = st.columns(3)
+            col1.metric("API 呼び出し", flights["upstream_calls"])
+            col2.metric("相乗りで節約した呼び出し", flights["coalesced"])
+            col3.metric("実行中", flights["in_flight"])
+            
+            # 画面のセッションからの外部呼び出し（共有スレッドで実行し、見捨てられたものは中止する）
+            outbound = get_outbound()
+            calls = outbound.stats()
+            st.caption(
+                f"外部呼び出しのスレッド: 実行中 {calls['running']} 件（{calls['sessions']} セッション）・"
+                f"枠の空き待ち {calls['waiting']} 件 / 中止 {calls['abandoned']} 件 / "
+                f"上限: 全体 {outbound.max_workers}・セッションごと {outbound.max_in_flight_per_session}"
+            )
+            
+            # 「自動」のモデル選択に使うモデルごとのレイテンシ（統計が少ないうちは事前値）
+            st.dataframe(
+                [
+                    {
+                        "モデル": row["model"],
+                        "呼び出し": row["calls"],
+                        "エラー": row["errors"],
+                        "最初のトークン p50": f"{row['first_token_p50']:.2f}秒",
+                        "最初のトークン p95": f"{row['first_token_p95']:.2f}秒",
+                        "トークンあたり": f"{row['seconds_per_token'] * 1000:.0f}ms",
+                        "ヘッジ": row["hedges"],
+                        "ヘッジ側が先着": row["hedge_wins"],
+                    }
+                    for row in get_router().stats()
+                ],
+                hide_index=True
+            )
 
 # アプリ実行
 if __name__ == "__main__":
@@ -386,5 +1589,6 @@ if __name__ == "__main__":
     """, unsafe_allow_html=True)
     
     # アプリ実行
+    start_api_server()
     app = AIServicesApp()
     app.run()
\ No newline at end of file
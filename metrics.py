@@ -0,0 +1,203 @@
+import atexit
+import math
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional, Tuple
+
+from response_cache import CACHE_DIR
+
+DEFAULT_DB_PATH = os.path.join(CACHE_DIR, "metrics.sqlite3")
+
+
+def percentile(values: List[float], ratio: float) -> float:
+    """ソート済みでない値のリストから百分位数を返す（最近傍法）"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(ratio * (len(ordered) - 1))))
+    return ordered[index]
+
+
+# レイテンシのヒストグラムの区間（下限 MIN_DURATION 秒から BUCKET_GROWTH 倍ずつ。代表値の誤差は約6%以内）
+MIN_DURATION = 0.001
+BUCKET_GROWTH = 10 ** (1 / 20)
+
+
+def duration_bucket(duration: float) -> int:
+    """所要時間が入るヒストグラムの区間の番号（MIN_DURATION 未満は 0）"""
+    if duration <= MIN_DURATION:
+        return 0
+    return int(math.log(duration / MIN_DURATION, BUCKET_GROWTH)) + 1
+
+
+def bucket_value(bucket: int) -> float:
+    """区間の代表値（区間の上下限の幾何平均）"""
+    if bucket == 0:
+        return MIN_DURATION
+    return MIN_DURATION * BUCKET_GROWTH ** (bucket - 0.5)
+
+
+def histogram_percentile(buckets: List[Tuple[int, int]], total: int, ratio: float) -> float:
+    """(区間の番号, 回数) の昇順のリストから百分位数を返す（percentile() と同じ最近傍法）"""
+    if total == 0:
+        return 0.0
+    rank = min(total - 1, int(round(ratio * (total - 1))))
+    seen = 0
+    for bucket, count in buckets:
+        seen += count
+        if seen > rank:
+            return bucket_value(bucket)
+    return bucket_value(buckets[-1][0])
+
+
+# 利用回数とレイテンシの記録
+# （1分ごと・ヒストグラムの区間ごとの回数にまとめてメモリに貯め、定期的にSQLiteへ書き出す。
+#   集計は分単位の行から行うため、期間が長くても読み込む行数は対象の数 × 区間の数程度に収まる）
+class MetricsRecorder:
+    def __init__(
+        self,
+        db_path: str = DEFAULT_DB_PATH,
+        flush_interval: float = 10.0,
+        retention_days: float = 30,
+    ):
+        self.flush_interval = flush_interval
+        self.retention_seconds = retention_days * 24 * 60 * 60
+        
+        # (分, name, kind, 区間) -> [回数, エラー数]（まだ書き出していない分）
+        self._pending: Dict[tuple, List[int]] = {}
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self._worker: Optional[threading.Thread] = None
+        
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS rollups (
+                minute INTEGER NOT NULL,
+                name TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                bucket INTEGER NOT NULL,
+                count INTEGER NOT NULL,
+                errors INTEGER NOT NULL,
+                PRIMARY KEY (minute, name, kind, bucket)
+            )
+            """
+        )
+        self._conn.commit()
+    
+    def record(self, name: str, kind: str, duration: float, ok: bool = True):
+        """1回分の呼び出しを記録（メモリ上の回数を増やすだけなので呼び出し側の負荷は小さい）"""
+        key = (int(time.time() // 60), name, kind, duration_bucket(duration))
+        with self._lock:
+            counts = self._pending.get(key)
+            if counts is None:
+                counts = self._pending[key] = [0, 0]
+            counts[0] += 1
+            if not ok:
+                counts[1] += 1
+    
+    @contextmanager
+    def track(self, name: str, kind: str):
+        """with ブロックの所要時間を記録する（例外で抜けた場合は失敗として記録）"""
+        started_at = time.perf_counter()
+        ok = True
+        try:
+            yield
+        except Exception:
+            ok = False
+            raise
+        finally:
+            self.record(name, kind, time.perf_counter() - started_at, ok)
+    
+    def flush(self):
+        """貯めた回数をSQLiteに加算し、保存期間を過ぎたデータを削除"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        with self._db_lock:
+            if pending:
+                self._conn.executemany(
+                    """
+                    INSERT INTO rollups (minute, name, kind, bucket, count, errors) VALUES (?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (minute, name, kind, bucket)
+                    DO UPDATE SET count = count + excluded.count, errors = errors + excluded.errors
+                    """,
+                    [key + tuple(counts) for key, counts in pending.items()]
+                )
+            self._conn.execute("DELETE FROM rollups WHERE minute < ?", (int((time.time() - self.retention_seconds) // 60),))
+            self._conn.commit()
+    
+    def start(self):
+        """定期書き出しのスレッドを起動（起動済みなら何もしない）"""
+        with self._lock:
+            if self._worker is not None and self._worker.is_alive():
+                return
+            self._worker = threading.Thread(target=self._run, name="metrics-flusher", daemon=True)
+            self._worker.start()
+    
+    def query(self, window_seconds: float, kind: Optional[str] = None) -> List[Dict[str, Any]]:
+        """直近 window_seconds 秒（分単位に切り下げ）の (name, kind) ごとの回数・エラー数・p50/p95 を返す
+        
+        書き出し済みの分は SQLite で区間ごとに合計し、まだ書き出していない分はメモリ上の回数を足す。
+        """
+        since = int((time.time() - window_seconds) // 60)
+        sql = "SELECT name, kind, bucket, SUM(count), SUM(errors) FROM rollups WHERE minute >= ?"
+        params: List[Any] = [since]
+        if kind is not None:
+            sql += " AND kind = ?"
+            params.append(kind)
+        sql += " GROUP BY name, kind, bucket"
+        with self._db_lock:
+            rows = self._conn.execute(sql, params).fetchall()
+        with self._lock:
+            rows.extend(
+                (name, row_kind, bucket, count, errors)
+                for (minute, name, row_kind, bucket), (count, errors) in self._pending.items()
+                if minute >= since and (kind is None or row_kind == kind)
+            )
+        
+        groups: Dict[tuple, Dict[str, Any]] = {}
+        for name, row_kind, bucket, count, errors in rows:
+            group = groups.setdefault((name, row_kind), {"buckets": {}, "count": 0, "errors": 0})
+            group["buckets"][bucket] = group["buckets"].get(bucket, 0) + count
+            group["count"] += count
+            group["errors"] += errors
+        results = []
+        for (name, row_kind), group in sorted(groups.items()):
+            buckets = sorted(group["buckets"].items())
+            results.append({
+                "name": name,
+                "kind": row_kind,
+                "count": group["count"],
+                "errors": group["errors"],
+                "p50": histogram_percentile(buckets, group["count"], 0.5),
+                "p95": histogram_percentile(buckets, group["count"], 0.95),
+            })
+        return results
+    
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except sqlite3.Error:
+                pass
+
+
+_recorder: Optional[MetricsRecorder] = None
+_recorder_lock = threading.Lock()
+
+
+def get_metrics() -> MetricsRecorder:
+    """プロセス内で共有するメトリクス記録を返す（初回に定期書き出しを開始）"""
+    global _recorder
+    with _recorder_lock:
+        if _recorder is None:
+            _recorder = MetricsRecorder()
+            _recorder.start()
+            # 終了時に未書き出しの記録を失わないようにする
+            atexit.register(_recorder.flush)
+        return _recorder
@@ -0,0 +1,154 @@
+import threading
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional
+
+from metrics import percentile
+
+# モデル選択で「自動」を表す名前
+AUTO_MODEL = "auto"
+
+# 統計が少ないうちは事前値を使う（この件数未満）
+MIN_SAMPLES = 5
+
+# ヘッジ（予備モデルの同時呼び出し）を始めるまでの最短の待ち時間（秒）
+MIN_HEDGE_DELAY = 0.5
+
+
+# モデルの性質と、統計がないときに使うレイテンシの事前値
+class ModelProfile:
+    def __init__(
+        self,
+        name: str,
+        context_window: int,
+        supports_json: bool,
+        first_token_seconds: float,
+        seconds_per_token: float,
+    ):
+        self.name = name
+        self.context_window = context_window
+        self.supports_json = supports_json
+        self.first_token_seconds = first_token_seconds
+        self.seconds_per_token = seconds_per_token
+
+
+DEFAULT_PROFILES = (
+    ModelProfile("gpt-3.5-turbo", 16385, True, 0.4, 0.012),
+    ModelProfile("gpt-4o-mini", 128000, True, 0.5, 0.015),
+    ModelProfile("gpt-4", 8192, False, 0.8, 0.05),
+)
+
+
+# モデルごとのレイテンシの観測値
+class _ModelStats:
+    def __init__(self, max_samples: int):
+        self.first_token: Deque[float] = deque(maxlen=max_samples)
+        self.per_token: Deque[float] = deque(maxlen=max_samples)
+        self.calls = 0
+        self.errors = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+
+# プロンプトの長さ・max_tokens・実測レイテンシからモデルを選び、ヘッジの発火時刻を決める
+class ModelRouter:
+    def __init__(self, profiles=DEFAULT_PROFILES, max_samples: int = 200):
+        self.profiles: Dict[str, ModelProfile] = {profile.name: profile for profile in profiles}
+        self._stats: Dict[str, _ModelStats] = {name: _ModelStats(max_samples) for name in self.profiles}
+        self._lock = threading.Lock()
+    
+    def observe(
+        self,
+        model: str,
+        duration: float,
+        completion_tokens: int,
+        first_token_seconds: Optional[float] = None,
+        ok: bool = True,
+    ):
+        """1回の呼び出しの結果を記録する（ストリーミングでなければ最初のトークンまでの時間は推定する）"""
+        with self._lock:
+            stats = self._stats.get(model)
+            if stats is None:
+                return
+            stats.calls += 1
+            if not ok:
+                stats.errors += 1
+                return
+            if first_token_seconds is None:
+                # ストリーミングでない場合は待ち時間の増減をトークンあたりの時間に含める
+                first_token_seconds = min(duration, self._first_token(model, 0.5))
+            else:
+                stats.first_token.append(first_token_seconds)
+            if completion_tokens > 0:
+                stats.per_token.append(max(0.0, duration - first_token_seconds) / completion_tokens)
+    
+    def record_hedge(self, model: str, won: bool):
+        """ヘッジで予備モデルを呼び出したこと（と、そちらが先に返ったか）を記録する"""
+        with self._lock:
+            stats = self._stats.get(model)
+            if stats is not None:
+                stats.hedges += 1
+                stats.hedge_wins += int(won)
+    
+    def predict(self, model: str, max_tokens: int, ratio: float = 0.5) -> float:
+        """max_tokens 分を生成し終えるまでの予測秒数（ratio は使う百分位数）"""
+        with self._lock:
+            return self._first_token(model, ratio) + self._per_token(model, ratio) * max_tokens
+    
+    def rank(self, prompt_tokens: int, max_tokens: int, require_json: bool = False) -> List[str]:
+        """コンテキストに収まるモデルを、予測レイテンシの短い順に返す"""
+        candidates = [
+            profile.name for profile in self.profiles.values()
+            if profile.context_window >= prompt_tokens + max_tokens and (profile.supports_json or not require_json)
+        ]
+        return sorted(candidates, key=lambda name: self.predict(name, max_tokens))
+    
+    def hedge_delay(self, model: str, max_tokens: int, stream: bool) -> float:
+        """この時間までに最初のトークン（ストリーミングでなければ応答）が返らなければ予備モデルを呼ぶ"""
+        with self._lock:
+            delay = self._first_token(model, 0.95)
+            if not stream:
+                delay += self._per_token(model, 0.95) * max_tokens
+        return max(MIN_HEDGE_DELAY, delay)
+    
+    def stats(self) -> List[Dict[str, Any]]:
+        """モデルごとの呼び出し数・エラー数・最初のトークンまでの p50/p95・ヘッジの回数を返す"""
+        with self._lock:
+            return [
+                {
+                    "model": name,
+                    "calls": stats.calls,
+                    "errors": stats.errors,
+                    "first_token_p50": self._first_token(name, 0.5),
+                    "first_token_p95": self._first_token(name, 0.95),
+                    "seconds_per_token": self._per_token(name, 0.5),
+                    "hedges": stats.hedges,
+                    "hedge_wins": stats.hedge_wins,
+                }
+                for name, stats in self._stats.items()
+            ]
+    
+    def _first_token(self, model: str, ratio: float) -> float:
+        stats, profile = self._stats[model], self.profiles[model]
+        if len(stats.first_token) < MIN_SAMPLES:
+            # 統計が少ないうちは事前値（p95 相当は2倍）を使う
+            return profile.first_token_seconds * (2 if ratio > 0.5 else 1)
+        return percentile(list(stats.first_token), ratio)
+    
+    def _per_token(self, model: str, ratio: float) -> float:
+        stats, profile = self._stats[model], self.profiles[model]
+        if len(stats.per_token) < MIN_SAMPLES:
+            return profile.seconds_per_token * (2 if ratio > 0.5 else 1)
+        return percentile(list(stats.per_token), ratio)
+
+
+_router: Optional[ModelRouter] = None
+_router_lock = threading.Lock()
+
+
+def get_router() -> ModelRouter:
+    """プロセス内の全セッションで共有するモデルルーターを返す"""
+    global _router
+    with _router_lock:
+        if _router is None:
+            _router = ModelRouter()
+        return _router
@@ -0,0 +1,216 @@
+import contextvars
+import os
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, Deque, Dict, Optional, Set
+
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+# 全セッションで共有する外部呼び出し用のスレッド数
+MAX_WORKERS = int(os.environ.get("SYNAPSE_OUTBOUND_WORKERS", 32))
+
+# 1セッションが同時に実行できる外部呼び出しの数（超えた分はそのセッションの中で順番を待つ）
+MAX_IN_FLIGHT_PER_SESSION = int(os.environ.get("SYNAPSE_OUTBOUND_PER_SESSION", 8))
+
+# 画面のセッション（外部呼び出しを共有スレッドで実行する対象。ワーカースレッドへはコンテキストごと引き継ぐ）
+_session_id: ContextVar[Optional[str]] = ContextVar("outbound_session", default=None)
+
+# 実行中の呼び出しが見捨てられたことを知らせるイベント
+_abandoned: ContextVar[Optional[threading.Event]] = ContextVar("outbound_abandoned", default=None)
+
+
+class CallAbandoned(Exception):
+    """呼び出し元が結果を待たなくなったため、外部呼び出しを中止した"""
+
+
+@contextmanager
+def bind_outbound_session(session_id: str):
+    """with ブロック内の外部呼び出しを、指定したセッションの分として共有スレッドで実行させる"""
+    token = _session_id.set(session_id)
+    try:
+        yield
+    finally:
+        _session_id.reset(token)
+
+
+def outbound_session() -> Optional[str]:
+    """bind_outbound_session() で指定されたセッション ID（API やバッチからの呼び出しでは None）"""
+    return _session_id.get()
+
+
+def raise_if_abandoned():
+    """実行中の外部呼び出しが見捨てられていれば CallAbandoned を送出する（順番待ちや再試行の前に確認する）"""
+    event = _abandoned.get()
+    if event is not None and event.is_set():
+        raise CallAbandoned("呼び出し元が結果を待たなくなったため中止しました")
+
+
+# OutboundExecutor.submit() の戻り値
+class OutboundFuture(Future):
+    def __init__(self, session_id: str, call: Callable[[], Any]):
+        super().__init__()
+        self.session_id = session_id
+        self.abandoned = threading.Event()
+        self._call = call
+    
+    def abandon(self) -> bool:
+        """結果を待たなくなったことを伝える（開始前なら取り消し、実行中なら raise_if_abandoned() で打ち切られる）"""
+        self.abandoned.set()
+        return self.cancel()
+
+
+# 外部呼び出しを全セッションで共有するスレッドで実行するエグゼキュータ
+# （セッションごとに同時実行数を制限し、一部のセッションがスレッドを使い切らないようにする。
+#   ストリーミング（stream_chat_completion）の受信スレッドとヘッジの予備の呼び出しは対象外）
+class OutboundExecutor:
+    def __init__(self, max_workers: int = MAX_WORKERS, max_in_flight_per_session: int = MAX_IN_FLIGHT_PER_SESSION):
+        self.max_workers = max_workers
+        self.max_in_flight_per_session = max_in_flight_per_session
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="outbound")
+        self._lock = threading.Lock()
+        # セッション ID -> 実行中の呼び出し / 同時実行数の空きを待っている呼び出し
+        self._running: Dict[str, Set[OutboundFuture]] = {}
+        self._waiting: Dict[str, Deque[OutboundFuture]] = {}
+        self._stats = {"submitted": 0, "completed": 0, "failed": 0, "abandoned": 0}
+    
+    def submit(self, session_id: str, func: Callable[..., Any], *args, **kwargs) -> OutboundFuture:
+        """func を共有スレッドで実行する（セッションやトレースの情報も引き継ぐ）"""
+        context = contextvars.copy_context()
+        
+        def call():
+            _abandoned.set(future.abandoned)
+            # 共有スレッドの中からの呼び出しはそのまま実行する（枠の空きを待ち合って止まらないように）
+            _session_id.set(None)
+            return func(*args, **kwargs)
+        
+        future = OutboundFuture(session_id, lambda: context.run(call))
+        with self._lock:
+            self._stats["submitted"] += 1
+            running = self._running.setdefault(session_id, set())
+            if len(running) < self.max_in_flight_per_session:
+                self._start(running, future)
+            else:
+                self._waiting.setdefault(session_id, deque()).append(future)
+        return future
+    
+    def cancel_session(self, session_id: str) -> int:
+        """セッションの未完了の呼び出しをすべて見捨て、その件数を返す"""
+        with self._lock:
+            waiting = list(self._waiting.pop(session_id, ()))
+            running = list(self._running.get(session_id, ()))
+            # 開始前のものはここで数え、実行中のものは終わったときに数える
+            self._stats["abandoned"] += sum(1 for future in waiting if not future.abandoned.is_set())
+        abandoned = 0
+        for future in waiting + running:
+            if not future.done() and not future.abandoned.is_set():
+                future.abandon()
+                abandoned += 1
+        return abandoned
+    
+    def stats(self) -> Dict[str, Any]:
+        """実行中・待機中の呼び出し数と、受け付け・完了・失敗・見捨てられた（完了したものを含む）件数を返す"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["running"] = sum(len(futures) for futures in self._running.values())
+            stats["waiting"] = sum(len(futures) for futures in self._waiting.values())
+            stats["sessions"] = len(self._running)
+        return stats
+    
+    def _start(self, running: Set[OutboundFuture], future: OutboundFuture):
+        running.add(future)
+        self._executor.submit(self._execute, future)
+    
+    def _execute(self, future: OutboundFuture):
+        try:
+            if not future.set_running_or_notify_cancel():
+                return
+            try:
+                result = future._call()
+            except BaseException as e:
+                future.set_exception(e)
+                failed = True
+            else:
+                future.set_result(result)
+                failed = False
+            with self._lock:
+                self._stats["failed" if failed else "completed"] += 1
+        finally:
+            self._release(future)
+    
+    def _release(self, future: OutboundFuture):
+        # 空いた枠で、同じセッションの待っている呼び出しを開始する（取り消されたものは飛ばす）
+        session_id = future.session_id
+        with self._lock:
+            running = self._running.get(session_id, set())
+            running.discard(future)
+            if future.abandoned.is_set():
+                self._stats["abandoned"] += 1
+            waiting = self._waiting.get(session_id)
+            while waiting and len(running) < self.max_in_flight_per_session:
+                queued = waiting.popleft()
+                if queued.abandoned.is_set():
+                    self._stats["abandoned"] += 1
+                else:
+                    self._start(running, queued)
+            if not waiting:
+                self._waiting.pop(session_id, None)
+            if not running:
+                self._running.pop(session_id, None)
+
+
+def wait_for(future: OutboundFuture, on_poll: Callable[[], None], interval: float = 0.25) -> Any:
+    """future の結果を返す。待つ間は interval 秒ごとに on_poll() を呼ぶ
+    
+    on_poll() が例外を送出した場合（画面の再実行で中断された場合など）は、呼び出しを見捨てて例外をそのまま伝える。
+    """
+    try:
+        while True:
+            done, _ = wait([future], timeout=interval)
+            if done:
+                return future.result()
+            on_poll()
+    finally:
+        if not future.done():
+            future.abandon()
+
+
+def current_session_id() -> str:
+    """実行中の Streamlit セッションの ID（スクリプトの外から呼ばれた場合は "default"）"""
+    ctx = get_script_run_ctx(suppress_warning=True)
+    return ctx.session_id if ctx is not None else "default"
+
+
+def call_outbound(func: Callable[[Optional[Callable[[float], None]]], Any], notice: Optional[Callable[[float], None]] = None) -> Any:
+    """func(on_wait) を呼び出して結果を返す
+    
+    bind_outbound_session() の中からの呼び出しは共有スレッドで実行する（セッションごとに同時実行数を制限）。
+    スクリプトのスレッドからは notice を渡す。待つ間は notice(順番待ちの推定秒数) で画面を更新し、
+    再実行やページ移動で中断されたら呼び出しを見捨てる。
+    """
+    session_id = outbound_session()
+    if session_id is None:
+        # API・バッチからの呼び出しは呼び出し元のスレッドで実行する
+        return func(None)
+    if notice is None:
+        # 一括処理のワーカースレッドからは、セッションの同時実行数の枠内で実行して結果を待つ
+        return get_outbound().submit(session_id, func, None).result()
+    # 順番待ちの推定時間はワーカースレッドで受け取り、表示はスクリプトのスレッドで行う
+    waiting = {"seconds": 0.0}
+    future = get_outbound().submit(session_id, func, lambda seconds: waiting.update(seconds=seconds))
+    return wait_for(future, on_poll=lambda: notice(waiting["seconds"]))
+
+
+_outbound: Optional[OutboundExecutor] = None
+_outbound_lock = threading.Lock()
+
+
+def get_outbound() -> OutboundExecutor:
+    """プロセス内の全セッションで共有する外部呼び出し用のエグゼキュータを返す"""
+    global _outbound
+    with _outbound_lock:
+        if _outbound is None:
+            _outbound = OutboundExecutor()
+        return _outbound
@@ -0,0 +1,287 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+import requests
+import streamlit as st
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+from response_cache import CACHE_DIR
+from webhook_client import RETRY_STATUSES, WebhookClient, endpoint_label, get_webhook_client
+
+DEFAULT_DB_PATH = os.path.join(CACHE_DIR, "outbox.sqlite3")
+
+# 保存する応答本文の最大文字数
+MAX_RESPONSE_CHARS = 4000
+
+
+# Webhook送信のアウトボックス（SQLiteに積み、バックグラウンドのワーカーが送信する）
+class Outbox:
+    def __init__(
+        self,
+        db_path: str = DEFAULT_DB_PATH,
+        client: Optional[WebhookClient] = None,
+        batch_size: int = 10,
+        max_workers: int = 4,
+        max_attempts: int = 5,
+        poll_interval: float = 2.0,
+    ):
+        self.client = client or get_webhook_client()
+        self.batch_size = batch_size
+        self.max_workers = max_workers
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._worker: Optional[threading.Thread] = None
+        
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                idempotency_key TEXT NOT NULL,
+                url TEXT NOT NULL,
+                endpoint TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL,
+                last_error TEXT,
+                response_status INTEGER,
+                response_text TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+            """
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox (status, next_attempt_at)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_outbox_key ON outbox (idempotency_key)")
+        # 前回のプロセスが送信中に終了した項目は未送信に戻す
+        self._conn.execute("UPDATE outbox SET status = 'pending' WHERE status = 'sending'")
+        self._conn.commit()
+    
+    @staticmethod
+    def make_idempotency_key(url: str, payload: Any, scope: str) -> str:
+        """送信元（セッションなど）・送信先・ペイロードから冪等キーを生成"""
+        raw = scope + "\n" + url + "\n" + json.dumps(payload, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+    
+    def enqueue(self, url: str, payload: Any, idempotency_key: Optional[str] = None, scope: Optional[str] = None) -> int:
+        """送信をキューに追加してIDを返す
+        
+        同じ冪等キーの項目が未送信のまま残っている場合は、新たに積まずにそのIDを返す。
+        idempotency_key を省略した場合は scope（省略時は実行中の Streamlit セッション）ごとのキーにし、
+        同じ利用者の二重送信だけをまとめる（別の利用者が同じ内容を送った場合はそれぞれ送信する）。
+        """
+        key = idempotency_key or self.make_idempotency_key(url, payload, scope or _submission_scope())
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT id FROM outbox WHERE idempotency_key = ? AND status IN ('pending', 'sending')",
+                (key,)
+            ).fetchone()
+            if row is not None:
+                return row["id"]
+            cursor = self._conn.execute(
+                "INSERT INTO outbox (idempotency_key, url, endpoint, payload, status, next_attempt_at, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, 'pending', ?, ?, ?)",
+                (key, url, endpoint_label(url), json.dumps(payload, ensure_ascii=False), now, now, now)
+            )
+            self._conn.commit()
+            item_id = cursor.lastrowid
+        self._wakeup.set()
+        return item_id
+    
+    def get(self, item_id: int) -> Optional[Dict[str, Any]]:
+        """IDで項目を取得"""
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM outbox WHERE id = ?", (item_id,)).fetchone()
+        return dict(row) if row else None
+    
+    def status_counts(self) -> Dict[str, int]:
+        """状態ごとの件数を返す"""
+        counts = {"pending": 0, "sending": 0, "sent": 0, "failed": 0}
+        with self._lock:
+            for row in self._conn.execute("SELECT status, COUNT(*) AS n FROM outbox GROUP BY status"):
+                counts[row["status"]] = row["n"]
+        return counts
+    
+    def recent(self, limit: int = 20) -> List[Dict[str, Any]]:
+        """新しい順に項目を返す"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, endpoint, status, attempts, last_error, response_status, created_at, updated_at "
+                "FROM outbox ORDER BY id DESC LIMIT ?",
+                (limit,)
+            ).fetchall()
+        return [dict(row) for row in rows]
+    
+    def retry_failed(self) -> int:
+        """失敗した項目を再送対象に戻し、その件数を返す"""
+        with self._lock:
+            cursor = self._conn.execute(
+                "UPDATE outbox SET status = 'pending', attempts = 0, next_attempt_at = ?, updated_at = ? "
+                "WHERE status = 'failed'",
+                (time.time(), time.time())
+            )
+            self._conn.commit()
+        self._wakeup.set()
+        return cursor.rowcount
+    
+    def start(self):
+        """バックグラウンドの送信ワーカーを起動（起動済みなら何もしない）"""
+        with self._lock:
+            if self._worker is not None and self._worker.is_alive():
+                return
+            self._worker = threading.Thread(target=self._run, name="outbox-worker", daemon=True)
+            self._worker.start()
+    
+    def drain_once(self) -> int:
+        """送信時刻を迎えた項目を1バッチ分送信し、処理した件数を返す"""
+        batch = self._claim_batch()
+        if not batch:
+            return 0
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            list(executor.map(self._deliver, batch))
+        return len(batch)
+    
+    def _run(self):
+        while True:
+            try:
+                processed = self.drain_once()
+            except Exception:
+                processed = 0
+            if processed < self.batch_size:
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+    
+    def _claim_batch(self) -> List[Dict[str, Any]]:
+        now = time.time()
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, idempotency_key, url, payload, attempts FROM outbox "
+                "WHERE status = 'pending' AND next_attempt_at <= ? ORDER BY id LIMIT ?",
+                (now, self.batch_size)
+            ).fetchall()
+            if rows:
+                self._conn.executemany(
+                    "UPDATE outbox SET status = 'sending', updated_at = ? WHERE id = ?",
+                    [(now, row["id"]) for row in rows]
+                )
+                self._conn.commit()
+        return [dict(row) for row in rows]
+    
+    def _deliver(self, item: Dict[str, Any]):
+        attempts = item["attempts"] + 1
+        headers = {"Idempotency-Key": item["idempotency_key"]}
+        try:
+            # 再送の間隔と回数は送信箱が管理するため、クライアント側では再送しない
+            response = self.client.post_json(item["url"], json.loads(item["payload"]), headers=headers, max_retries=0)
+        except requests.exceptions.RequestException as e:
+            self._finish(item["id"], attempts, retryable=True, error=str(e))
+            return
+        
+        text = response.text[:MAX_RESPONSE_CHARS]
+        if response.status_code < 400:
+            self._finish(item["id"], attempts, status_code=response.status_code, text=text)
+        else:
+            # 429/5xx は時間を置いて再送し、それ以外の 4xx は再送しても結果が変わらないため失敗とする
+            self._finish(
+                item["id"], attempts,
+                retryable=response.status_code in RETRY_STATUSES,
+                error=f"ステータスコード: {response.status_code}",
+                status_code=response.status_code,
+                text=text
+            )
+    
+    def _finish(
+        self,
+        item_id: int,
+        attempts: int,
+        retryable: bool = False,
+        error: Optional[str] = None,
+        status_code: Optional[int] = None,
+        text: Optional[str] = None,
+    ):
+        now = time.time()
+        if error is None:
+            status, next_attempt_at = "sent", now
+        elif retryable and attempts < self.max_attempts:
+            status, next_attempt_at = "pending", now + min(300.0, 5.0 * (2 ** (attempts - 1)))
+        else:
+            status, next_attempt_at = "failed", now
+        with self._lock:
+            self._conn.execute(
+                "UPDATE outbox SET status = ?, attempts = ?, next_attempt_at = ?, last_error = ?, "
+                "response_status = ?, response_text = ?, updated_at = ? WHERE id = ?",
+                (status, attempts, next_attempt_at, error, status_code, text, now, item_id)
+            )
+            self._conn.commit()
+
+
+def _submission_scope() -> str:
+    # Streamlit の外（バッチなど）から積まれた場合は、呼び出しごとに別のキーにしてまとめない
+    ctx = get_script_run_ctx(suppress_warning=True)
+    return ctx.session_id if ctx is not None else uuid.uuid4().hex
+
+
+_outbox: Optional[Outbox] = None
+_outbox_lock = threading.Lock()
+
+
+def get_outbox() -> Outbox:
+    """プロセス内で共有するアウトボックスを返す（初回に送信ワーカーを起動）"""
+    global _outbox
+    with _outbox_lock:
+        if _outbox is None:
+            _outbox = Outbox()
+            _outbox.start()
+        return _outbox
+
+
+def render_outbox_status(outbox: Outbox):
+    """送信キューの状態（未送信・送信済み・失敗）を表示するパネル"""
+    with st.expander("送信キューの状態"):
+        counts = outbox.status_counts()
+        col1, col2, col3 = st.columns(3)
+        col1.metric("未送信", counts["pending"] + counts["sending"])
+        col2.metric("送信済み", counts["sent"])
+        col3.metric("失敗", counts["failed"])
+        
+        items = outbox.recent()
+        if items:
+            for item in items:
+                item["created_at"] = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(item["created_at"]))
+                item["updated_at"] = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(item["updated_at"]))
+            st.dataframe(items, use_container_width=True)
+        
+        if counts["failed"] and st.button("失敗した送信を再試行"):
+            st.info(f"{outbox.retry_failed()} 件を再送します")
+        
+        stats = outbox.client.stats()
+        if stats:
+            st.markdown("**エンドポイント別の通信状況**")
+            st.dataframe(
+                [
+                    {
+                        "エンドポイント": label,
+                        "リクエスト数": stat["requests"],
+                        "エラー数": stat["errors"],
+                        "リトライ数": stat["retries"],
+                        "p50 (秒)": round(stat["p50"], 3),
+                        "p95 (秒)": round(stat["p95"], 3),
+                    }
+                    for label, stat in stats.items()
+                ],
+                use_container_width=True
+            )
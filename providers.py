@@ -0,0 +1,80 @@
+import importlib
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+from types import ModuleType
+from typing import Any, Dict, List, Optional
+
+import streamlit as st
+
+_lock = threading.Lock()
+_openai_client: Optional[Any] = None
+
+# 遅延インポートしたモジュール名 -> 読み込みにかかった秒数
+_import_timings: Dict[str, float] = {}
+
+_IMPORTTIME_PATTERN = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|\s+(\S+)")
+
+
+def lazy_import(module_name: str) -> ModuleType:
+    """モジュールを初回利用時に読み込む（読み込み時間を記録する）"""
+    # sys.modules には別スレッドが読み込み中のモジュールも入っているため、
+    # 読み込み済みでも import_module を通して初期化の完了を待つ
+    loaded = module_name in sys.modules
+    started_at = time.perf_counter()
+    module = importlib.import_module(module_name)
+    if not loaded:
+        with _lock:
+            _import_timings.setdefault(module_name, time.perf_counter() - started_at)
+    return module
+
+
+def get_secret(name: str) -> str:
+    """シークレットを利用時に読み込む（環境変数に設定されていればそちらを優先する）"""
+    return os.environ.get(name) or st.secrets[name]
+
+
+def get_openai_client():
+    """プロセス内で共有する OpenAI クライアントを返す（初回利用時に生成）"""
+    global _openai_client
+    if _openai_client is None:
+        openai = lazy_import("openai")
+        with _lock:
+            if _openai_client is None:
+                # SDK 内部の再試行はレートリミッタを通らないため無効にし、再試行は llm_gateway の待機に任せる
+                _openai_client = openai.OpenAI(api_key=get_secret("OPENAI_API_KEY"), max_retries=0)
+    return _openai_client
+
+
+def import_timings() -> Dict[str, float]:
+    """遅延インポートしたモジュールと読み込みにかかった秒数を返す"""
+    with _lock:
+        return dict(_import_timings)
+
+
+def profile_imports(module_name: str = "main", limit: int = 30) -> List[Dict[str, Any]]:
+    """別プロセスで python -X importtime を実行し、読み込みに時間のかかるモジュールを返す
+    
+    返り値は累積時間の長い順で、self / cumulative はマイクロ秒。
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module_name}"],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        capture_output=True,
+        text=True,
+        timeout=120,
+    )
+    rows = []
+    for line in result.stderr.splitlines():
+        match = _IMPORTTIME_PATTERN.match(line)
+        if match:
+            rows.append({
+                "module": match.group(3),
+                "self_us": int(match.group(1)),
+                "cumulative_us": int(match.group(2)),
+            })
+    rows.sort(key=lambda row: row["cumulative_us"], reverse=True)
+    return rows[:limit]
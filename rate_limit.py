@@ -0,0 +1,253 @@
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, Deque, Dict, Iterable, Optional
+
+from outbound import raise_if_abandoned
+
+# アカウントの上限（環境変数で上書きできる）
+DEFAULT_REQUESTS_PER_MINUTE = float(os.environ.get("OPENAI_REQUESTS_PER_MINUTE", 500))
+DEFAULT_TOKENS_PER_MINUTE = float(os.environ.get("OPENAI_TOKENS_PER_MINUTE", 200000))
+
+# 現在の処理がどのセッションのものか（ワーカースレッドへはコンテキストごと引き継ぐ）
+_session_id: ContextVar[str] = ContextVar("rate_limit_session", default="default")
+
+
+@contextmanager
+def bind_session(session_id: str):
+    """with ブロック内の LLM 呼び出しを指定したセッションの順番待ちに並べる"""
+    token = _session_id.set(session_id)
+    try:
+        yield
+    finally:
+        _session_id.reset(token)
+
+
+def estimate_text_tokens(text: str) -> int:
+    """テキストのトークン数を見積もる（英数字は約4文字、日本語などは約1文字で1トークン）"""
+    ascii_chars = sum(1 for c in text if ord(c) < 128)
+    return ascii_chars // 4 + (len(text) - ascii_chars)
+
+
+def estimate_prompt_tokens(messages: Iterable[Dict[str, Any]]) -> int:
+    """送信するメッセージ（プロンプト）だけのトークン数を見積もる"""
+    total = 0
+    for message in messages:
+        content = message.get("content")
+        parts = [content] if isinstance(content, str) else [
+            part.get("text", "") for part in content or [] if isinstance(part, dict)
+        ]
+        for text in parts:
+            total += estimate_text_tokens(text)
+        # メッセージごとの区切りの分
+        total += 4
+    return total
+
+
+def estimate_tokens(messages: Iterable[Dict[str, Any]], max_tokens: Optional[int] = None) -> int:
+    """送信前にメッセージ全体のトークン数を見積もる
+    
+    API のトークン数の上限には max_tokens も含めて計上されるため、その分も加える。
+    """
+    return estimate_prompt_tokens(messages) + (max_tokens or 256)
+
+
+# 順番待ちの1件
+class _Ticket:
+    __slots__ = ("tokens",)
+    
+    def __init__(self, tokens: int):
+        self.tokens = tokens
+
+
+# リクエスト数とトークン数の2つのバケットで流量を制御するレートリミッタ
+# （待ちが発生した場合はセッションごとのキューから順番に発行し、特定のセッションが独占しないようにする）
+class TokenBucketLimiter:
+    def __init__(
+        self,
+        requests_per_minute: float = DEFAULT_REQUESTS_PER_MINUTE,
+        tokens_per_minute: float = DEFAULT_TOKENS_PER_MINUTE,
+        burst_seconds: float = 10.0,
+    ):
+        self.request_rate = requests_per_minute / 60.0
+        self.token_rate = tokens_per_minute / 60.0
+        # 一度に使える量は burst_seconds 秒分まで（1分ぶんを一気に使うと API 側で 429 になりやすい）
+        self.request_capacity = max(1.0, self.request_rate * burst_seconds)
+        self.token_capacity = max(1.0, self.token_rate * burst_seconds)
+        
+        self._requests = self.request_capacity
+        self._tokens = self.token_capacity
+        self._updated_at = time.monotonic()
+        self._paused_until = 0.0
+        
+        self._cond = threading.Condition()
+        self._queues: Dict[str, Deque[_Ticket]] = {}
+        self._order: Deque[str] = deque()
+        
+        self._granted = 0
+        self._waited = 0
+        self._wait_seconds = 0.0
+        self._throttled = 0
+    
+    def acquire(
+        self,
+        tokens: int,
+        session_id: Optional[str] = None,
+        on_wait: Optional[Callable[[float], None]] = None,
+        timeout: Optional[float] = None,
+    ) -> float:
+        """発行できるまで待機し、待った秒数を返す
+        
+        待ちが発生した場合は on_wait に推定待ち時間（秒）を渡して定期的に呼ぶ。
+        timeout を過ぎても順番が来なければ TimeoutError を、外部呼び出しが見捨てられた場合は CallAbandoned を送出する。
+        """
+        session_id = session_id or _session_id.get()
+        ticket = _Ticket(min(tokens, int(self.token_capacity)))
+        started_at = time.monotonic()
+        notified_at = 0.0
+        
+        with self._cond:
+            queue = self._queues.get(session_id)
+            if queue is None:
+                queue = self._queues[session_id] = deque()
+                self._order.append(session_id)
+            queue.append(ticket)
+        
+        try:
+            while True:
+                with self._cond:
+                    now = time.monotonic()
+                    self._refill(now)
+                    if self._is_next(session_id, ticket) and self._has_capacity(ticket, now):
+                        self._grant(session_id, ticket)
+                        waited = now - started_at
+                        self._granted += 1
+                        if waited > 0.01:
+                            self._waited += 1
+                            self._wait_seconds += waited
+                        self._cond.notify_all()
+                        return waited
+                    
+                    estimate = self._estimate_wait(session_id, ticket, now)
+                    if timeout is not None and now - started_at + estimate > timeout:
+                        raise TimeoutError(f"レート制限の待ち時間が長すぎます（推定 {estimate:.0f} 秒）")
+                
+                # UI の更新はロックの外で行う
+                if on_wait is not None and now - notified_at >= 1.0:
+                    on_wait(estimate)
+                    notified_at = now
+                # 呼び出し元が結果を待たなくなっていれば、順番が来る前にやめる
+                raise_if_abandoned()
+                
+                with self._cond:
+                    self._cond.wait(timeout=min(max(estimate, 0.05), 1.0))
+        finally:
+            with self._cond:
+                self._discard(session_id, ticket)
+                self._cond.notify_all()
+    
+    def settle(self, estimated_tokens: int, actual_tokens: Optional[int]):
+        """実際の使用トークン数が分かったら、見積もりとの差をバケットに戻す（または差し引く）"""
+        if actual_tokens is None:
+            return
+        with self._cond:
+            self._refill(time.monotonic())
+            self._tokens = min(self.token_capacity, self._tokens + estimated_tokens - actual_tokens)
+            self._cond.notify_all()
+    
+    def pause(self, seconds: float):
+        """API から 429 が返された場合に、全セッションの発行を一時停止する"""
+        with self._cond:
+            self._throttled += 1
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._requests = 0.0
+    
+    def estimate_wait(self, tokens: int) -> float:
+        """今から tokens 分のリクエストを並べた場合の推定待ち時間（秒）"""
+        with self._cond:
+            now = time.monotonic()
+            self._refill(now)
+            queued = [ticket for queue in self._queues.values() for ticket in queue]
+            return self._deficit_wait(len(queued) + 1, sum(t.tokens for t in queued) + tokens, now)
+    
+    def stats(self) -> Dict[str, Any]:
+        """発行数・待ちが発生した回数・平均待ち時間・待機中の件数などを返す"""
+        with self._cond:
+            self._refill(time.monotonic())
+            return {
+                "granted": self._granted,
+                "waited": self._waited,
+                "avg_wait_seconds": self._wait_seconds / self._waited if self._waited else 0.0,
+                "throttled": self._throttled,
+                "queued": sum(len(queue) for queue in self._queues.values()),
+                "sessions_waiting": len(self._order),
+                "available_requests": self._requests,
+                "available_tokens": self._tokens,
+            }
+    
+    def _refill(self, now: float):
+        elapsed = now - self._updated_at
+        self._updated_at = now
+        if now < self._paused_until:
+            return
+        self._requests = min(self.request_capacity, self._requests + elapsed * self.request_rate)
+        self._tokens = min(self.token_capacity, self._tokens + elapsed * self.token_rate)
+    
+    def _is_next(self, session_id: str, ticket: _Ticket) -> bool:
+        # 先頭のセッションの、先頭の1件だけが発行できる
+        return bool(self._order) and self._order[0] == session_id and self._queues[session_id][0] is ticket
+    
+    def _has_capacity(self, ticket: _Ticket, now: float) -> bool:
+        return now >= self._paused_until and self._requests >= 1 and self._tokens >= ticket.tokens
+    
+    def _grant(self, session_id: str, ticket: _Ticket):
+        self._requests -= 1
+        self._tokens -= ticket.tokens
+        # 発行したセッションは列の最後に回す（ラウンドロビン）
+        self._discard(session_id, ticket)
+        if session_id in self._queues:
+            self._order.remove(session_id)
+            self._order.append(session_id)
+    
+    def _discard(self, session_id: str, ticket: _Ticket):
+        queue = self._queues.get(session_id)
+        if queue is None or ticket not in queue:
+            return
+        queue.remove(ticket)
+        if not queue:
+            del self._queues[session_id]
+            self._order.remove(session_id)
+    
+    def _estimate_wait(self, session_id: str, ticket: _Ticket, now: float) -> float:
+        # ラウンドロビンで自分より先に発行される件数とトークン数を数える
+        queue = self._queues[session_id]
+        position = list(queue).index(ticket)
+        own_index = self._order.index(session_id)
+        requests, tokens = 0, 0
+        for index, other in enumerate(self._order):
+            ahead = list(self._queues[other])[:position + (1 if index < own_index else 0)]
+            requests += len(ahead)
+            tokens += sum(t.tokens for t in ahead)
+        return self._deficit_wait(requests + 1, tokens + ticket.tokens, now)
+    
+    def _deficit_wait(self, requests: float, tokens: float, now: float) -> float:
+        paused = max(0.0, self._paused_until - now)
+        request_wait = max(0.0, requests - self._requests) / self.request_rate if self.request_rate else 0.0
+        token_wait = max(0.0, tokens - self._tokens) / self.token_rate if self.token_rate else 0.0
+        return paused + max(request_wait, token_wait)
+
+
+_limiter: Optional[TokenBucketLimiter] = None
+_limiter_lock = threading.Lock()
+
+
+def get_rate_limiter() -> TokenBucketLimiter:
+    """プロセス内の全セッションで共有する OpenAI 用のレートリミッタを返す"""
+    global _limiter
+    with _limiter_lock:
+        if _limiter is None:
+            _limiter = TokenBucketLimiter()
+        return _limiter
@@ -0,0 +1,147 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+# キャッシュファイルの既定の保存先（SYNAPSE_CACHE_DIR で変更できる）
+CACHE_DIR = os.environ.get("SYNAPSE_CACHE_DIR") or os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache")
+DEFAULT_DB_PATH = os.path.join(CACHE_DIR, "responses.sqlite3")
+
+
+# OpenAIの応答キャッシュ（メモリ上のLRU + SQLite の2層構成）
+class ResponseCache:
+    def __init__(
+        self,
+        db_path: str = DEFAULT_DB_PATH,
+        memory_max_entries: int = 256,
+        disk_max_entries: int = 5000,
+        ttl_seconds: float = 7 * 24 * 60 * 60,
+    ):
+        self.db_path = db_path
+        self.memory_max_entries = memory_max_entries
+        self.disk_max_entries = disk_max_entries
+        self.ttl_seconds = ttl_seconds
+        
+        # key -> (value, created_at, latency, tokens)
+        self._memory: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {
+            "memory_hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "saved_seconds": 0.0,
+            "saved_tokens": 0,
+        }
+        
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        # Streamlitの複数セッション（スレッド）から共有するため、ロックで保護した1接続を使う
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                last_access REAL NOT NULL,
+                latency REAL NOT NULL DEFAULT 0,
+                tokens INTEGER NOT NULL DEFAULT 0
+            )
+            """
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_last_access ON responses (last_access)")
+        self._conn.commit()
+    
+    @staticmethod
+    def make_key(**parts: Any) -> str:
+        """リクエストの構成要素からキャッシュキーを生成"""
+        raw = json.dumps(parts, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+    
+    def get(self, key: str) -> Optional[str]:
+        """キャッシュされた応答を取得（期限切れ・未登録の場合はNone）"""
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                value, created_at, latency, tokens = entry
+                if now - created_at <= self.ttl_seconds:
+                    self._memory.move_to_end(key)
+                    self._record_hit("memory_hits", latency, tokens)
+                    return value
+                del self._memory[key]
+            
+            row = self._conn.execute(
+                "SELECT value, created_at, latency, tokens FROM responses WHERE key = ?",
+                (key,)
+            ).fetchone()
+            if row is None or now - row[1] > self.ttl_seconds:
+                if row is not None:
+                    self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                    self._conn.commit()
+                self._stats["misses"] += 1
+                return None
+            
+            value, created_at, latency, tokens = row
+            self._conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            self._put_memory(key, (value, created_at, latency, tokens))
+            self._record_hit("disk_hits", latency, tokens)
+            return value
+    
+    def set(self, key: str, value: str, latency: float = 0.0, tokens: int = 0):
+        """応答をキャッシュに保存（latency/tokensはヒット時の節約量の集計に使う）"""
+        now = time.time()
+        with self._lock:
+            self._put_memory(key, (value, now, latency, tokens))
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, value, created_at, last_access, latency, tokens) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (key, value, now, now, latency, tokens)
+            )
+            self._evict_disk(now)
+            self._conn.commit()
+    
+    def clear(self):
+        """キャッシュをすべて削除"""
+        with self._lock:
+            self._memory.clear()
+            self._conn.execute("DELETE FROM responses")
+            self._conn.commit()
+    
+    def stats(self) -> Dict[str, Any]:
+        """ヒット/ミスの回数と節約できた時間・トークン数を返す"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["memory_entries"] = len(self._memory)
+            stats["disk_entries"] = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        hits = stats["memory_hits"] + stats["disk_hits"]
+        total = hits + stats["misses"]
+        stats["hit_rate"] = hits / total if total else 0.0
+        return stats
+    
+    def _record_hit(self, tier: str, latency: float, tokens: int):
+        self._stats[tier] += 1
+        self._stats["saved_seconds"] += latency
+        self._stats["saved_tokens"] += tokens
+    
+    def _put_memory(self, key: str, entry: tuple):
+        self._memory[key] = entry
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_max_entries:
+            self._memory.popitem(last=False)
+    
+    def _evict_disk(self, now: float):
+        # 期限切れの削除と、件数上限を超えた分を最終アクセスが古い順に削除
+        self._conn.execute("DELETE FROM responses WHERE created_at < ?", (now - self.ttl_seconds,))
+        count = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        overflow = count - self.disk_max_entries
+        if overflow > 0:
+            self._conn.execute(
+                "DELETE FROM responses WHERE key IN "
+                "(SELECT key FROM responses ORDER BY last_access ASC LIMIT ?)",
+                (overflow,)
+            )
@@ -0,0 +1,157 @@
+import math
+import re
+from typing import Any, Dict, List, Tuple
+
+# 感情語辞書（値が大きいほどポジティブ、負の値はネガティブ）
+ENGLISH_LEXICON: Dict[str, float] = {
+    "good": 1.0, "great": 1.5, "excellent": 2.0, "amazing": 2.0, "awesome": 2.0,
+    "wonderful": 2.0, "fantastic": 2.0, "perfect": 2.0, "love": 1.5, "loved": 1.5,
+    "nice": 1.0, "happy": 1.5, "glad": 1.0,
+    "best": 2.0, "recommend": 1.0, "recommended": 1.0, "helpful": 1.0, "easy": 0.5,
+    "fast": 0.5, "beautiful": 1.5, "thanks": 1.0, "thank": 1.0, "satisfied": 1.0,
+    "enjoy": 1.0, "enjoyed": 1.0, "delicious": 1.5, "fun": 1.0, "works": 0.5,
+    "bad": -1.0, "terrible": -2.0, "awful": -2.0, "horrible": -2.0, "worst": -2.0,
+    "hate": -1.5, "hated": -1.5, "poor": -1.0, "disappointed": -1.5, "disappointing": -1.5,
+    "broken": -1.5, "slow": -0.5, "useless": -1.5, "angry": -1.5, "sad": -1.0,
+    "annoying": -1.0, "boring": -1.0, "difficult": -0.5, "problem": -0.5, "bug": -0.5,
+    "refund": -1.0, "waste": -1.5, "expensive": -0.5, "unhappy": -1.5, "fail": -1.0,
+    "failed": -1.0, "rude": -1.5, "dirty": -1.0,
+}
+JAPANESE_LEXICON: Dict[str, float] = {
+    "良い": 1.0, "よい": 1.0, "いい": 1.0, "最高": 2.0, "素晴らしい": 2.0,
+    "すばらしい": 2.0, "嬉しい": 1.5, "うれしい": 1.5, "楽しい": 1.5, "好き": 1.5,
+    "大好き": 2.0, "満足": 1.5, "おいしい": 1.5, "美味しい": 1.5, "ありがとう": 1.0,
+    "感謝": 1.0, "便利": 1.0, "快適": 1.0, "素敵": 1.5, "かわいい": 1.0,
+    "可愛い": 1.0, "助かる": 1.0, "助かり": 1.0, "安心": 1.0, "おすすめ": 1.0,
+    "オススメ": 1.0, "感動": 1.5, "綺麗": 1.0, "きれい": 1.0, "優しい": 1.0,
+    "丁寧": 1.0, "使いやすい": 1.0, "わかりやすい": 1.0, "分かりやすい": 1.0,
+    "悪い": -1.0, "最悪": -2.0, "最低": -2.0, "嫌い": -1.5, "大嫌い": -2.0,
+    "悲しい": -1.5, "残念": -1.5, "不満": -1.5, "つまらない": -1.5, "まずい": -1.5,
+    "遅い": -0.5, "壊れ": -1.5, "不便": -1.0, "ひどい": -2.0, "酷い": -2.0,
+    "がっかり": -1.5, "失望": -1.5, "腹立": -1.5, "使いにくい": -1.0, "分かりにくい": -1.0,
+    "わかりにくい": -1.0, "高すぎ": -1.0, "不快": -1.5, "怖い": -1.0, "辛い": -1.0,
+    "つらい": -1.0, "困る": -1.0, "困っ": -1.0, "迷惑": -1.5, "返品": -1.0,
+}
+
+ENGLISH_NEGATORS = {"not", "no", "never", "hardly", "barely", "without", "nothing", "nor"}
+ENGLISH_INTENSIFIERS = {
+    "very": 1.5, "really": 1.5, "so": 1.3, "extremely": 2.0, "super": 1.5,
+    "absolutely": 1.8, "totally": 1.5, "incredibly": 1.8, "too": 1.3, "quite": 1.2,
+}
+ENGLISH_CONTRASTS = {"but", "however", "although", "though", "yet"}
+
+# 日本語の否定は語の直後に付く（例: 好きではない、良くない、満足しなかった）
+JAPANESE_NEGATION_SUFFIXES = (
+    "じゃない", "ではない", "でない", "じゃなかった", "ではなかった", "ではありません",
+    "じゃありません", "しない", "しなかった", "しません", "できない", "ない", "なかった", "ません",
+)
+JAPANESE_INTENSIFIERS = {
+    "とても": 1.5, "すごく": 1.5, "凄く": 1.5, "非常に": 1.8, "めちゃくちゃ": 1.8,
+    "めっちゃ": 1.8, "本当に": 1.5, "ほんとに": 1.5, "超": 1.5, "大変": 1.5,
+    "かなり": 1.3, "すごい": 1.3, "極めて": 2.0, "一番": 1.5,
+}
+JAPANESE_CONTRASTS = ("しかし", "けど", "けれど", "ただ、", "一方", "でも")
+
+# 長い文章ほど辞書で拾えない文脈が増えるため、この文字数を超えると信頼度を下げる
+SHORT_TEXT_LENGTH = 140
+
+
+# 辞書とルールによるオフラインの感情スコアラー
+class LexiconSentimentScorer:
+    def analyze(self, text: str) -> Tuple[Dict[str, Any], float]:
+        """テキストを採点し、({score, sentiment, explanation}, 信頼度 0〜1) を返す"""
+        hits = self._score_english(text) + self._score_japanese(text)
+        positive = sum(value for _, value in hits if value > 0)
+        negative = -sum(value for _, value in hits if value < 0)
+        total = positive - negative
+        
+        # 0〜10のスケールに変換（LLMの出力と同じ形式）
+        score = int(round(5 + 5 * math.tanh(total / 2)))
+        if score >= 6:
+            sentiment = "positive"
+        elif score <= 4:
+            sentiment = "negative"
+        else:
+            sentiment = "neutral"
+        
+        confidence = self._confidence(text, positive, negative)
+        if hits:
+            words = "、".join(f"「{word}」" for word, _ in hits[:5])
+            explanation = f"ローカル辞書による判定です。感情語 {words} を検出しました。"
+        else:
+            explanation = "ローカル辞書による判定です。感情語は検出されませんでした。"
+        return {"score": score, "sentiment": sentiment, "explanation": explanation}, confidence
+    
+    def _confidence(self, text: str, positive: float, negative: float) -> float:
+        evidence = positive + negative
+        if evidence == 0:
+            return 0.0
+        # 極性が一方に偏っているほど、また根拠となる語が多いほど信頼度を高くする
+        agreement = abs(positive - negative) / evidence
+        strength = 1 - math.exp(-evidence / 1.5)
+        length_factor = min(1.0, SHORT_TEXT_LENGTH / max(len(text), 1))
+        confidence = agreement * strength * length_factor
+        
+        lowered = text.lower()
+        if any(word in ENGLISH_CONTRASTS for word in re.findall(r"[a-z']+", lowered)) or \
+                any(word in text for word in JAPANESE_CONTRASTS):
+            confidence *= 0.6
+        return min(confidence, 0.99)
+    
+    def _score_english(self, text: str) -> List[Tuple[str, float]]:
+        tokens = re.findall(r"[a-z']+", text.lower())
+        hits = []
+        for i, token in enumerate(tokens):
+            value = ENGLISH_LEXICON.get(token)
+            if not value:
+                continue
+            
+            window = tokens[max(0, i - 3):i]
+            label = token
+            if any(word in ENGLISH_NEGATORS or word.endswith("n't") for word in window):
+                value = -value * 0.8
+                label = f"{token}（否定）"
+            if i > 0 and tokens[i - 1] in ENGLISH_INTENSIFIERS:
+                value *= ENGLISH_INTENSIFIERS[tokens[i - 1]]
+            hits.append((label, value))
+        return hits
+    
+    def _score_japanese(self, text: str) -> List[Tuple[str, float]]:
+        hits = []
+        covered = [False] * len(text)
+        # 長い語から照合し、「大好き」と「好き」のような重複を数えないようにする
+        for word in sorted(JAPANESE_LEXICON, key=len, reverse=True):
+            for surface, negated in self._japanese_forms(word):
+                for match in re.finditer(re.escape(surface), text):
+                    start, end = match.span()
+                    if any(covered[start:end]):
+                        continue
+                    
+                    value = JAPANESE_LEXICON[word]
+                    label = surface
+                    following = text[end:end + 8]
+                    if negated or following.startswith(JAPANESE_NEGATION_SUFFIXES):
+                        value = -value * 0.8
+                        if not negated:
+                            label = f"{surface}（否定）"
+                    preceding = text[max(0, start - 6):start]
+                    for intensifier, factor in JAPANESE_INTENSIFIERS.items():
+                        if preceding.endswith(intensifier):
+                            value *= factor
+                            break
+                    
+                    for i in range(start, end):
+                        covered[i] = True
+                    hits.append((label, value))
+        return hits
+    
+    @staticmethod
+    def _japanese_forms(word: str) -> List[Tuple[str, bool]]:
+        """照合する表記と、その表記自体が否定形かどうかの組を返す"""
+        forms = []
+        if word.endswith("い") and len(word) > 1:
+            # 形容詞の否定形（良い → 良くない / 良くなかった / 良くありません）
+            stem = word[:-1] + "く"
+            forms += [(stem + suffix, True) for suffix in ("なかった", "ない", "ありません")]
+        forms.append((word, False))
+        return forms
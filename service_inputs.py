@@ -0,0 +1,28 @@
+from typing import Any, Dict
+
+
+class InvalidInputError(ValueError):
+    """サービスへの入力の誤り（HTTP API では 400 として返す）"""
+
+
+def prepare_inputs(defaults: Dict[str, Any], inputs: Dict[str, Any]) -> Dict[str, Any]:
+    """省略された入力に既定値を補い、数値と文字列を既定値と同じ型にそろえる
+    
+    変換できない値があれば InvalidInputError を送出する。
+    """
+    if not isinstance(inputs, dict):
+        raise InvalidInputError("入力は JSON オブジェクトで指定してください")
+    prepared = dict(defaults, **inputs)
+    for key, default in defaults.items():
+        value = prepared[key]
+        # bool は int の派生型のため、数値より先に判定して変換しない
+        if isinstance(default, bool):
+            continue
+        if isinstance(default, (int, float)):
+            try:
+                prepared[key] = type(default)(value)
+            except (TypeError, ValueError):
+                raise InvalidInputError(f"{key} は数値で指定してください: {value!r}") from None
+        elif isinstance(default, str) and not isinstance(value, str):
+            raise InvalidInputError(f"{key} は文字列で指定してください: {value!r}")
+    return prepared
@@ -0,0 +1,173 @@
+import hashlib
+import json
+import threading
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from outbound import CallAbandoned
+
+
+# 呼び出し元が中断（Streamlit の再実行など）したため結果が得られなかったことを表す
+class FlightCancelled(Exception):
+    pass
+
+
+def request_key(kwargs: Dict[str, Any]) -> str:
+    """モデル・メッセージ・パラメータを正規化してリクエストのキーを作る（空白の違いは無視する）"""
+    def normalize(value):
+        if isinstance(value, str):
+            return " ".join(value.split())
+        if isinstance(value, dict):
+            return {key: normalize(item) for key, item in value.items()}
+        if isinstance(value, (list, tuple)):
+            return [normalize(item) for item in value]
+        return value
+    raw = json.dumps(normalize(kwargs), ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+# 実行中の1回の上流呼び出し（ストリーミングの場合は受信済みのテキストも保持する）
+class Flight:
+    def __init__(self, key: str):
+        self.key = key
+        self.chunks: List[str] = []
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+        self.done = False
+        self.subscribers = 0
+        self._cond = threading.Condition()
+    
+    def publish(self, chunk: str):
+        """受信したテキストを待っている全員に配る"""
+        with self._cond:
+            self.chunks.append(chunk)
+            self._cond.notify_all()
+    
+    def wait(self) -> Any:
+        """上流の呼び出しが終わるまで待ち、結果を返す（失敗した場合は同じ例外を送出）"""
+        with self._cond:
+            while not self.done:
+                self._cond.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+    
+    def iter_chunks(self) -> Iterator[str]:
+        """受信済みのテキストを先頭から返し、以降は届いた順に返す"""
+        index = 0
+        while True:
+            with self._cond:
+                while index >= len(self.chunks) and not self.done:
+                    self._cond.wait()
+                chunks = self.chunks[index:]
+                done = self.done
+            index += len(chunks)
+            yield from chunks
+            if done and index >= len(self.chunks):
+                break
+        if self.error is not None:
+            raise self.error
+    
+    def _finish(self, result: Any, error: Optional[BaseException]):
+        with self._cond:
+            self.result = result
+            self.error = error
+            self.done = True
+            self._cond.notify_all()
+
+
+# 同じリクエストが同時に来た場合に、上流への呼び出しを1回にまとめる
+class SingleFlight:
+    def __init__(self):
+        self._flights: Dict[str, Flight] = {}
+        self._lock = threading.Lock()
+        self._leaders = 0
+        self._followers = 0
+    
+    def join(self, key: str) -> Tuple[Flight, bool]:
+        """実行中の呼び出しに相乗りする（なければ新しく作る）。(呼び出し, 自分が実行するか) を返す"""
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = Flight(key)
+                self._leaders += 1
+            else:
+                self._followers += 1
+            flight.subscribers += 1
+            return flight, leader
+    
+    def leave(self, flight: Flight) -> int:
+        """結果を待つのをやめる。残っている待ち手の数を返す"""
+        with self._lock:
+            flight.subscribers -= 1
+            return flight.subscribers
+    
+    def finish(self, flight: Flight, result: Any = None, error: Optional[BaseException] = None):
+        """呼び出しの結果を待ち手全員に渡し、以降のリクエストは新しく実行されるようにする"""
+        with self._lock:
+            if self._flights.get(flight.key) is flight:
+                del self._flights[flight.key]
+        flight._finish(result, error)
+    
+    def abandon_if_unused(self, flight: Flight) -> bool:
+        """待ち手が誰もいなければ呼び出しを取り下げる（取り下げた場合は True）"""
+        with self._lock:
+            if flight.subscribers > 0:
+                return False
+            if self._flights.get(flight.key) is flight:
+                del self._flights[flight.key]
+        flight._finish(None, FlightCancelled())
+        return True
+    
+    def do(self, key: str, func: Callable[[], Any]) -> Tuple[Any, bool]:
+        """同じキーの呼び出しが実行中ならその結果を待ち、なければ func を実行する
+        
+        (結果, 他のリクエストの結果を共有したか) を返す。実行していた側が中断した場合は
+        待っていた側が改めて実行する。
+        """
+        while True:
+            flight, leader = self.join(key)
+            try:
+                if leader:
+                    try:
+                        result = func()
+                    except CallAbandoned:
+                        # 見捨てられたのは実行していた側だけなので、待っていた側は改めて実行する
+                        self.finish(flight, error=FlightCancelled())
+                        raise
+                    except Exception as e:
+                        self.finish(flight, error=e)
+                        raise
+                    except BaseException:
+                        self.finish(flight, error=FlightCancelled())
+                        raise
+                    self.finish(flight, result=result)
+                    return result, False
+                try:
+                    return flight.wait(), True
+                except FlightCancelled:
+                    continue
+            finally:
+                self.leave(flight)
+    
+    def stats(self) -> Dict[str, int]:
+        """上流を呼び出した回数・相乗りで節約した回数・実行中の件数を返す"""
+        with self._lock:
+            return {
+                "upstream_calls": self._leaders,
+                "coalesced": self._followers,
+                "in_flight": len(self._flights),
+            }
+
+
+_single_flight: Optional[SingleFlight] = None
+_single_flight_lock = threading.Lock()
+
+
+def get_single_flight() -> SingleFlight:
+    """プロセス内の全セッションで共有する SingleFlight を返す"""
+    global _single_flight
+    with _single_flight_lock:
+        if _single_flight is None:
+            _single_flight = SingleFlight()
+        return _single_flight
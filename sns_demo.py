@@ -1,6 +1,6 @@
 import streamlit as st
-import requests
-import json
+
+from outbox import get_outbox, render_outbox_status
 
 def main():
     # アプリケーションのタイトル設定
@@ -24,23 +24,16 @@ def main():
             webhook_url = "https://hook.us2.make.com/bygwi3rthep6sv5tla5jqgqu7xuoyqhe"
             
             try:
-                # POSTリクエスト送信
-                response = requests.post(
-                    webhook_url,
-                    data=json.dumps(data),
-                    headers={"Content-Type": "application/json"}
-                )
-                
-                # レスポンスのチェック
-                if response.status_code == 200:
-                    st.success("データが正常に送信されました")
-                    st.json(data)  # 送信されたデータを表示
-                else:
-                    st.error(f"エラーが発生しました: ステータスコード {response.status_code}")
-                    st.text(response.text)  # エラーメッセージを表示
+                # 送信キューに積んですぐに戻る（送信はバックグラウンドで行う）
+                item_id = get_outbox().enqueue(webhook_url, data)
+                st.success(f"送信を受け付けました（受付番号: {item_id}）。バックグラウンドで送信します")
+                st.json(data)  # 送信するデータを表示
             
-            except requests.exceptions.RequestException as e:
-                st.error(f"リクエスト中にエラーが発生しました: {e}")
+            except Exception as e:
+                st.error(f"送信の受付中にエラーが発生しました: {e}")
+    
+    # 送信キューの状態
+    render_outbox_status(get_outbox())
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,100 @@
+import json
+import re
+from typing import Any, Dict
+
+# 感情分析の出力スキーマ
+SENTIMENT_SCHEMA: Dict[str, Any] = {
+    "type": "object",
+    "properties": {
+        "score": {"type": "integer", "minimum": 0, "maximum": 10},
+        "sentiment": {"type": "string", "enum": ["positive", "negative", "neutral"]},
+        "explanation": {"type": "string"},
+    },
+    "required": ["score", "sentiment", "explanation"],
+    "additionalProperties": False,
+}
+
+# Structured Outputs（json_schema + strict）に対応しているモデルの接頭辞
+JSON_SCHEMA_MODEL_PREFIXES = ("gpt-4o", "gpt-4.1", "o1", "o3", "o4")
+
+_FENCE_PATTERN = re.compile(r"```(?:json)?\s*(.*?)```", re.DOTALL | re.IGNORECASE)
+
+
+# 応答がスキーマに合わない場合の例外（raw に応答テキストを保持する）
+class StructuredOutputError(ValueError):
+    def __init__(self, message: str, raw: str = ""):
+        super().__init__(message)
+        self.raw = raw
+
+
+def response_format_for(model: str, name: str, schema: Dict[str, Any]) -> Dict[str, Any]:
+    """モデルに応じた response_format を返す
+    
+    Structured Outputs 対応モデルではスキーマを厳密に強制し、
+    それ以外（gpt-3.5-turbo など）では JSON モードを使う。
+    """
+    if model.startswith(JSON_SCHEMA_MODEL_PREFIXES):
+        return strict_response_format(name, schema)
+    return {"type": "json_object"}
+
+
+def strict_response_format(name: str, schema: Dict[str, Any]) -> Dict[str, Any]:
+    """スキーマを厳密に強制する response_format（呼び出し先のモデルが決まっていない場合に使う）"""
+    return {
+        "type": "json_schema",
+        "json_schema": {"name": name, "strict": True, "schema": schema},
+    }
+
+
+def adapt_response_format(response_format: Dict[str, Any], model: str) -> Dict[str, Any]:
+    """Structured Outputs に対応していないモデルでは JSON モードに切り替える"""
+    if response_format.get("type") == "json_schema" and not model.startswith(JSON_SCHEMA_MODEL_PREFIXES):
+        return {"type": "json_object"}
+    return response_format
+
+
+def extract_json_object(text: str) -> Dict[str, Any]:
+    """応答テキストからJSONオブジェクトを取り出す
+    
+    ```json のコードブロックや、前後に説明文が付いた応答にも対応する。
+    """
+    if not text:
+        raise StructuredOutputError("応答が空です", text or "")
+    
+    candidates = [match.group(1) for match in _FENCE_PATTERN.finditer(text)] + [text]
+    decoder = json.JSONDecoder()
+    for candidate in candidates:
+        for match in re.finditer(r"\{", candidate):
+            try:
+                value, _ = decoder.raw_decode(candidate, match.start())
+            except json.JSONDecodeError:
+                continue
+            if isinstance(value, dict):
+                return value
+    raise StructuredOutputError("応答からJSONオブジェクトを取り出せませんでした", text)
+
+
+def validate_sentiment(value: Dict[str, Any], raw: str = "") -> Dict[str, Any]:
+    """感情分析の結果をスキーマに沿って検証・正規化する"""
+    missing = [key for key in SENTIMENT_SCHEMA["required"] if key not in value]
+    if missing:
+        raise StructuredOutputError(f"必須項目がありません: {', '.join(missing)}", raw)
+    
+    score = value["score"]
+    if isinstance(score, str) and score.strip().lstrip("-").replace(".", "", 1).isdigit():
+        score = float(score)
+    if isinstance(score, bool) or not isinstance(score, (int, float)):
+        raise StructuredOutputError("score は 0〜10 の整数である必要があります", raw)
+    score = int(round(score))
+    if not 0 <= score <= 10:
+        raise StructuredOutputError("score は 0〜10 の整数である必要があります", raw)
+    
+    sentiment = str(value["sentiment"]).strip().lower()
+    if sentiment not in SENTIMENT_SCHEMA["properties"]["sentiment"]["enum"]:
+        raise StructuredOutputError("sentiment は positive / negative / neutral のいずれかである必要があります", raw)
+    
+    explanation = value["explanation"]
+    if not isinstance(explanation, str):
+        raise StructuredOutputError("explanation は文字列である必要があります", raw)
+    
+    return {"score": score, "sentiment": sentiment, "explanation": explanation}
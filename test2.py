@@ -1,19 +1,21 @@
 import streamlit as st
-from openai import OpenAI
 import os
+import time
 from abc import ABC, abstractmethod
 from typing import List, Dict, Any, Optional
-import pandas as pd
-import plotly.express as px
-import requests
 import datetime
-import json
 from datetime import timedelta
 
+import json
+
+from outbox import get_outbox, render_outbox_status
+from outbound import bind_outbound_session, call_outbound, current_session_id, get_outbound
+from llm_gateway import chat_completion
+from providers import get_secret
+from tracing import span
+
 #test
-# OpenAI クライアントの初期化
-client = OpenAI(api_key=st.secrets["OPENAI_API_KEY"])
-webhookURL = st.secrets["WEBHOOK_URL"]
+# OpenAI クライアントとシークレットは providers 経由で初回利用時に読み込む
 
 # サービスの基本クラス（抽象クラス）
 class AIService(ABC):
@@ -79,14 +81,23 @@ class TextGenerationService(AIService):
             with st.spinner("文章を生成中..."):
                 try:
                     # 新しいOpenAI APIの形式
-                    response = client.chat.completions.create(
-                        model=model,
-                        messages=[
+                    request = {
+                        "model": model,
+                        "messages": [
                             {"role": "system", "content": "あなたは役立つアシスタントです。"},
                             {"role": "user", "content": prompt}
                         ],
-                        max_tokens=max_tokens
+                        "max_tokens": max_tokens,
+                    }
+                    # 全セッション共通のレートリミッタを通し、外部呼び出し用の共有スレッドで実行する
+                    # （待つ間も画面を更新するため、再実行・ページ移動で中断されたら呼び出しを見捨てる）
+                    status = st.empty()
+                    started_at = time.monotonic()
+                    response = call_outbound(
+                        lambda on_wait: chat_completion(on_wait=on_wait, **request),
+                        notice=lambda seconds: status.caption(f"応答を待っています（{time.monotonic() - started_at:.0f}秒）")
                     )
+                    status.empty()
                     generated_text = response.choices[0].message.content
                     
                     # 結果表示
@@ -159,7 +170,7 @@ class ImageCaptioningService(AIService):
                         st.success("説明文が生成されました！")
                         st.markdown("### 生成された説明文")
                         st.markdown(caption)
-                        
+                    
                     except Exception as e:
                         st.error(f"エラーが発生しました: {str(e)}")
 
@@ -219,44 +230,56 @@ class ZoomSchedulerService(AIService):
             
             # Webhookエンドポイント
             #webhook_url = "https://hook.us2.make.com/bygwi3rthep6sv5tla5jqgqu7xuoyqhe"
-            webhook_url = webhookURL
+            webhook_url = get_secret("WEBHOOK_URL")
             
             try:
-                # POSTリクエストの送信
-                with st.spinner("会議をスケジュール中..."):
-                    response = requests.post(
-                        webhook_url, 
-                        data=json.dumps(webhook_data),
-                        headers={"Content-Type": "application/json"}
-                    )
-                
-                # レスポンスの処理
-                if response.status_code == 200:
-                    st.success("会議のスケジュールが完了しました！")
-                    
-                    # レスポンスのJSONデータを表示（Webhookからの返信がある場合）
-                    try:
-                        response_data = response.json()
-                        st.write("## 会議情報")
-                        st.json(response_data)
-                        
-                        # 会議URLがレスポンスに含まれている場合、表示する
-                        if "join_url" in response_data:
-                            st.write("## 会議URL")
-                            st.markdown(f"[会議に参加する]({response_data['join_url']})")
-                    except:
-                        st.write("会議は正常にスケジュールされましたが、詳細情報は返されませんでした。")
-                else:
-                    st.error(f"エラーが発生しました。ステータスコード: {response.status_code}")
-                    st.write("レスポンス内容:")
-                    st.write(response.text)
+                # 送信キューに積んですぐに戻る（Webhookへの送信はバックグラウンドで行う）
+                st.session_state.zoom_outbox_id = get_outbox().enqueue(webhook_url, webhook_data)
+                st.success("会議のスケジュールを受け付けました。送信が完了すると会議情報が表示されます。")
             
             except Exception as e:
                 st.error(f"エラーが発生しました: {str(e)}")
         
+        # 直前に受け付けた会議の送信結果
+        if st.session_state.get("zoom_outbox_id"):
+            self._render_outbox_result(st.session_state.zoom_outbox_id)
+        
+        render_outbox_status(get_outbox())
+        
         # フッター
         st.markdown("---")
         st.caption("© 2025 ZOOM会議スケジューラー")
+    
+    def _render_outbox_result(self, item_id: int):
+        """送信キューに積んだ会議登録の結果を表示"""
+        item = get_outbox().get(item_id)
+        if item is None:
+            return
+        
+        if item["status"] in ("pending", "sending"):
+            st.info("会議のスケジュールを送信中です。しばらくしてから画面を更新してください。")
+            if st.button("送信状況を更新"):
+                st.rerun()
+        elif item["status"] == "failed":
+            st.error(f"エラーが発生しました: {item['last_error']}")
+            if item["response_text"]:
+                st.write("レスポンス内容:")
+                st.write(item["response_text"])
+        else:
+            st.success("会議のスケジュールが完了しました！")
+            
+            # レスポンスのJSONデータを表示（Webhookからの返信がある場合）
+            try:
+                response_data = json.loads(item["response_text"])
+                st.write("## 会議情報")
+                st.json(response_data)
+                
+                # 会議URLがレスポンスに含まれている場合、表示する
+                if "join_url" in response_data:
+                    st.write("## 会議URL")
+                    st.markdown(f"[会議に参加する]({response_data['join_url']})")
+            except (TypeError, ValueError):
+                st.write("会議は正常にスケジュールされましたが、詳細情報は返されませんでした。")
 
 # サービス管理クラス
 class ServiceManager:
@@ -294,6 +317,10 @@ class AIServicesApp:
     
     def run(self):
         """アプリケーションを実行"""
+        # 前回の実行（再実行・ページ移動で中断されたもの）の外部呼び出しが残っていれば中止する
+        session_id = current_session_id()
+        get_outbound().cancel_session(session_id)
+        
         # サイドバーの設定
         self._setup_sidebar()
         
@@ -301,7 +328,9 @@ class AIServicesApp:
         if st.session_state.current_service:
             service = self.service_manager.get_service_by_name(st.session_state.current_service)
             if service:
-                service.render()
+                # 外部呼び出しはセッションごとに同時実行数を制限して共有スレッドで実行する
+                with bind_outbound_session(session_id), span(service.name, "render"):
+                    service.render()
         else:
             self._render_home()
     
@@ -314,7 +343,7 @@ class AIServicesApp:
             # ホームボタン
             if st.button("🏠 ホーム"):
                 st.session_state.current_service = None
-                st.experimental_rerun()
+                st.rerun()
             
             st.markdown("## サービス一覧")
             
@@ -322,7 +351,7 @@ class AIServicesApp:
             for service in self.service_manager.get_services():
                 if st.button(f"{service.icon} {service.name}"):
                     st.session_state.current_service = service.name
-                    st.experimental_rerun()
+                    st.rerun()
     
     def _render_home(self):
         """ホーム画面のレンダリング"""
@@ -0,0 +1,43 @@
+import io
+import zipfile
+from contextlib import ExitStack
+
+from main import ImageCaptioningService
+
+
+class _Upload(io.BytesIO):
+    """st.file_uploader が返すファイルの代わり"""
+    
+    def __init__(self, name, data):
+        super().__init__(data)
+        self.name = name
+
+
+def _zip_with_corrupt_member():
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_STORED) as archive:
+        archive.writestr("good.png", b"good-image-bytes")
+        archive.writestr("bad.png", b"bad-image-bytes")
+    # 無圧縮で格納したメンバーの中身を書き換え、CRC の検査で失敗させる
+    data = buffer.getvalue().replace(b"bad-image-bytes", b"BAD-image-bytes")
+    return _Upload("images.zip", data)
+
+
+def test_corrupt_zip_member_fails_only_that_item(tmp_path):
+    service = ImageCaptioningService()
+    service.caption_cached = lambda image_data, **options: (image_data.decode(), None, 0)
+    uploads = [_zip_with_corrupt_member(), _Upload("single.png", b"single-image-bytes")]
+    
+    with ExitStack() as archives:
+        names, readers = service._iter_batch_images(uploads, str(tmp_path), archives)
+        outcomes = {
+            names[index]: (result, error)
+            for index, result, error in service._caption_batch(readers, {}, max_workers=2)
+        }
+    
+    assert set(outcomes) == {"images.zip/good.png", "images.zip/bad.png", "single.png"}
+    assert outcomes["images.zip/good.png"] == (("good-image-bytes", None, 0), None)
+    assert outcomes["single.png"] == (("single-image-bytes", None, 0), None)
+    result, error = outcomes["images.zip/bad.png"]
+    assert result is None
+    assert isinstance(error, zipfile.BadZipFile)
@@ -0,0 +1,27 @@
+import pytest
+
+import llm_gateway
+from model_router import AUTO_MODEL, ModelProfile, ModelRouter
+
+
+@pytest.fixture
+def small_router(monkeypatch):
+    router = ModelRouter(profiles=(ModelProfile("small", 1000, True, 0.4, 0.01),))
+    monkeypatch.setattr(llm_gateway, "get_router", lambda: router)
+    return router
+
+
+def _request(prompt_tokens: int):
+    # 英数字は約4文字で1トークン、メッセージごとの区切りで4トークンと見積もられる
+    return {"model": AUTO_MODEL, "max_tokens": 90, "messages": [{"role": "user", "content": "abcd" * prompt_tokens}]}
+
+
+def test_route_counts_only_prompt_and_max_tokens(small_router):
+    # 900 + 4 + 90 = 994 トークンで、コンテキスト長 1000 に収まる
+    routed = llm_gateway.route(_request(900))
+    assert [candidate["model"] for candidate in routed] == ["small"]
+
+
+def test_route_rejects_prompt_longer_than_context(small_router):
+    with pytest.raises(ValueError):
+        llm_gateway.route(_request(910))
@@ -0,0 +1,25 @@
+from text_similarity_cache import NearDuplicateCache, normalize_text
+
+
+def test_normalize_keeps_symbols_and_collapses_whitespace():
+    assert normalize_text("ＡＢＣ  +\n１２") == "abc + 12"
+    assert normalize_text("a+b") != normalize_text("a-b")
+
+
+def test_operators_do_not_match():
+    cache = NearDuplicateCache()
+    cache.store("scope", "次の計算の答えを数字だけで答えてください: a+b", "a+b の答え")
+    assert cache.lookup("scope", "次の計算の答えを数字だけで答えてください: a-b", threshold=0.5) is None
+    
+    cache.store("scope", "12+3 はいくつですか", "15")
+    assert cache.lookup("scope", "12-3 はいくつですか", threshold=0.5) is None
+    
+    cache.store("scope", "x > y のとき、次の式を簡単にしてください", "答え")
+    assert cache.lookup("scope", "x < y のとき、次の式を簡単にしてください", threshold=0.5) is None
+
+
+def test_whitespace_and_width_differences_still_hit():
+    cache = NearDuplicateCache()
+    cache.store("scope", "AI について 説明してください", "説明")
+    assert cache.lookup("scope", "ａｉ  について\u3000説明してください") == ("説明", 1.0)
+    assert cache.lookup("scope", "AI について詳しく説明してください", threshold=0.7) is not None
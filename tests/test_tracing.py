@@ -0,0 +1,37 @@
+import pytest
+
+import tracing
+from outbound import CallAbandoned
+
+
+class _Recorder:
+    def __init__(self):
+        self.calls = []
+    
+    def record(self, name, kind, duration, ok=True):
+        self.calls.append((name, ok))
+
+
+@pytest.fixture
+def recorder(monkeypatch):
+    recorder = _Recorder()
+    monkeypatch.setattr(tracing, "get_metrics", lambda: recorder)
+    return recorder
+
+
+def _finish(tracer, exception):
+    with pytest.raises(type(exception)):
+        with tracer.span("call", "llm"):
+            raise exception
+
+
+def test_cancelled_spans_are_not_counted_as_errors(tmp_path, recorder):
+    tracer = tracing.Tracer(log_path=str(tmp_path / "traces.jsonl"))
+    _finish(tracer, CallAbandoned())
+    _finish(tracer, KeyboardInterrupt())
+    _finish(tracer, RuntimeError("boom"))
+    with tracer.span("call", "llm"):
+        pass
+    
+    assert recorder.calls == [("call", False), ("call", True)]
+    assert [span["status"] for span in tracer.recent()] == ["ok", "error", "cancelled", "cancelled"]
@@ -0,0 +1,87 @@
+import re
+from typing import List, Tuple
+
+from rate_limit import estimate_text_tokens
+
+# 段落の区切り（空行）
+_PARAGRAPH_BREAK = re.compile(r"\n\s*\n")
+
+# 文の終わり（句点・感嘆符・疑問符と直後の閉じ括弧・空白。英文のピリオドは後ろに空白があるものだけ）
+_SENTENCE_END = re.compile(r"[。．！？!?][」』）)\"']*\s*|\.(?:\s+|$)")
+
+
+def split_paragraphs(text: str) -> List[str]:
+    """空行で段落に分ける（前後の空白は取り除く）"""
+    return [paragraph.strip() for paragraph in _PARAGRAPH_BREAK.split(text) if paragraph.strip()]
+
+
+def split_sentences(text: str) -> List[str]:
+    """文の終わりで分ける（各文は直後の空白を含むため、つなげると元のテキストに戻る）"""
+    sentences = []
+    start = 0
+    for match in _SENTENCE_END.finditer(text):
+        sentences.append(text[start:match.end()])
+        start = match.end()
+    if start < len(text):
+        sentences.append(text[start:])
+    return sentences
+
+
+def _split_by_length(text: str, max_tokens: int) -> List[str]:
+    # 1文でも上限を超える場合は、トークン数の見積もりに比例した文字数で切る
+    tokens = estimate_text_tokens(text)
+    if tokens <= max_tokens:
+        return [text]
+    step = max(1, len(text) * max_tokens // tokens)
+    return [text[i:i + step] for i in range(0, len(text), step)]
+
+
+def _char_counts(text: str) -> Tuple[int, int]:
+    # (英数字の文字数, それ以外の文字数)。estimate_text_tokens と同じ見積もりを、つなげた後の長さで行うために使う
+    ascii_chars = sum(1 for c in text if ord(c) < 128)
+    return ascii_chars, len(text) - ascii_chars
+
+
+def pack(segments: List[str], max_tokens: int, separator: str = "\n\n") -> List[str]:
+    """前から順に、max_tokens に収まるだけ segments をつなげたまとまりのリストを返す
+    
+    1つで max_tokens を超える segment はそのまま1つのまとまりにする。
+    """
+    chunks: List[str] = []
+    current: List[str] = []
+    ascii_total = other_total = 0
+    separator_ascii, separator_other = _char_counts(separator)
+    for segment in segments:
+        segment_ascii, segment_other = _char_counts(segment)
+        if current:
+            next_ascii = ascii_total + separator_ascii + segment_ascii
+            next_other = other_total + separator_other + segment_other
+            if next_ascii // 4 + next_other > max_tokens:
+                chunks.append(separator.join(current))
+                current, ascii_total, other_total = [], 0, 0
+        if current:
+            ascii_total += separator_ascii
+            other_total += separator_other
+        current.append(segment)
+        ascii_total += segment_ascii
+        other_total += segment_other
+    if current:
+        chunks.append(separator.join(current))
+    return chunks
+
+
+def chunk_text(text: str, max_tokens: int) -> List[str]:
+    """段落・文の区切りを優先して、テキストを max_tokens 以内のまとまりに分ける
+    
+    段落が上限に収まらない場合だけ文の区切りで、文も収まらない場合だけ文字数で分ける。
+    """
+    if max_tokens <= 0:
+        raise ValueError("max_tokens は正の値で指定してください")
+    segments: List[str] = []
+    for paragraph in split_paragraphs(text):
+        if estimate_text_tokens(paragraph) <= max_tokens:
+            segments.append(paragraph)
+            continue
+        pieces = [piece for sentence in split_sentences(paragraph) for piece in _split_by_length(sentence, max_tokens)]
+        segments.extend(chunk.strip() for chunk in pack(pieces, max_tokens, separator=""))
+    return pack(segments, max_tokens)
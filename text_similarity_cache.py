@@ -0,0 +1,205 @@
+import hashlib
+import random
+import re
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+# MinHash の計算に使う素数（2^61 - 1）
+_PRIME = (1 << 61) - 1
+
+# 連続する空白（正規化で1つの空白にまとめる）
+_WHITESPACE = re.compile(r"\s+")
+
+# 数値と演算子・比較記号（1文字違うだけで答えが変わるため、類似プロンプトとして扱うには完全に一致している必要がある）
+_EXACT_TOKENS = re.compile(r"\d+(?:\.\d+)?|[+\-*/=<>^%×÷≠≤≥≦≧]")
+
+
+def normalize_text(text: str) -> str:
+    """全角・半角や大文字・小文字をそろえ、連続する空白を1つにまとめる（記号・数字はそのまま残す）"""
+    text = unicodedata.normalize("NFKC", text).casefold()
+    return _WHITESPACE.sub(" ", text).strip()
+
+
+def exact_tokens(normalized: str) -> Tuple[str, ...]:
+    """正規化したテキストに含まれる数値と演算子を、出現順に返す"""
+    return tuple(_EXACT_TOKENS.findall(normalized))
+
+
+def shingles(text: str, size: int = 3) -> Set[str]:
+    """正規化したテキストの文字 n-gram の集合を返す（日本語のように単語の区切りがない文章にも使える）"""
+    if len(text) <= size:
+        return {text}
+    return {text[i:i + size] for i in range(len(text) - size + 1)}
+
+
+# 文字 n-gram の集合の MinHash 署名（一致する要素の割合が Jaccard 係数の推定値になる）
+class MinHasher:
+    def __init__(self, num_perm: int = 64, shingle_size: int = 3, seed: int = 1):
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        rng = random.Random(seed)
+        self._params = [(rng.randrange(1, _PRIME), rng.randrange(0, _PRIME)) for _ in range(num_perm)]
+    
+    def signature(self, normalized: str) -> Tuple[int, ...]:
+        """正規化済みのテキストの署名を返す"""
+        hashes = [
+            int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest(), "big")
+            for shingle in shingles(normalized, self.shingle_size)
+        ]
+        return tuple(min((a * h + b) % _PRIME for h in hashes) for a, b in self._params)
+
+
+def similarity(a: Tuple[int, ...], b: Tuple[int, ...]) -> float:
+    """2つの署名から推定した Jaccard 係数（0〜1）"""
+    return sum(1 for x, y in zip(a, b) if x == y) / len(a)
+
+
+# 保存した1件（scope はモデルや max_tokens など、結果を使い回せる条件）
+class _Entry:
+    __slots__ = ("scope", "signature", "exact_tokens", "value", "latency", "tokens", "buckets")
+    
+    def __init__(
+        self,
+        scope: str,
+        signature: Tuple[int, ...],
+        exact_tokens: Tuple[str, ...],
+        value: Any,
+        latency: float,
+        tokens: int,
+    ):
+        self.scope = scope
+        self.signature = signature
+        self.exact_tokens = exact_tokens
+        self.value = value
+        self.latency = latency
+        self.tokens = tokens
+        self.buckets: List[Tuple[str, int, Tuple[int, ...]]] = []
+
+
+# 空白・表記・言い回しの小さな違いしかないプロンプトにもヒットする応答キャッシュ
+# （MinHash の署名を帯に分けた LSH で候補を絞り、全件の比較はしない）
+class NearDuplicateCache:
+    def __init__(
+        self,
+        max_entries: int = 1024,
+        threshold: float = 0.9,
+        num_perm: int = 64,
+        bands: int = 16,
+        shingle_size: int = 3,
+    ):
+        if num_perm % bands:
+            raise ValueError("num_perm は bands で割り切れる必要があります")
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.hasher = MinHasher(num_perm, shingle_size)
+        # 正規化したテキストのキー -> _Entry（最も使われていないものが先頭）
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        # (scope, 帯の番号, 帯の値) -> その帯が一致するキー
+        self._buckets: Dict[Tuple[str, int, Tuple[int, ...]], Set[str]] = {}
+        self._lock = threading.Lock()
+        self._stats = {
+            "exact_hits": 0,
+            "near_hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "saved_seconds": 0.0,
+            "saved_tokens": 0,
+        }
+    
+    def lookup(self, scope: str, text: str, threshold: Optional[float] = None) -> Optional[Tuple[Any, float]]:
+        """同じ scope で類似度が threshold 以上のテキストがあれば (保存した値, 類似度) を返す
+        
+        正規化すると同じになるテキスト（空白・全角半角・大文字小文字の違いのみ）は類似度 1.0 として扱う。
+        類似のテキストは、数値と演算子がすべて同じ順に一致しているものだけを対象にする。
+        """
+        if threshold is None:
+            threshold = self.threshold
+        normalized = normalize_text(text)
+        key = self._key(scope, normalized)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                return self._hit(key, entry, 1.0, "exact_hits")
+        
+        # 署名の計算はロックの外で行う
+        signature = self.hasher.signature(normalized)
+        tokens = exact_tokens(normalized)
+        with self._lock:
+            best = None
+            for candidate in self._candidates(scope, signature):
+                if self._entries[candidate].exact_tokens != tokens:
+                    continue
+                score = similarity(signature, self._entries[candidate].signature)
+                if score >= threshold and (best is None or score > best[1]):
+                    best = (candidate, score)
+            if best is None:
+                self._stats["misses"] += 1
+                return None
+            return self._hit(best[0], self._entries[best[0]], best[1], "near_hits")
+    
+    def store(self, scope: str, text: str, value: Any, latency: float = 0.0, tokens: int = 0):
+        """値を保存（上限を超えたら最も使われていないものから削除）"""
+        normalized = normalize_text(text)
+        key = self._key(scope, normalized)
+        entry = _Entry(scope, self.hasher.signature(normalized), exact_tokens(normalized), value, latency, tokens)
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = entry
+            for band in range(self.bands):
+                bucket = (scope, band, entry.signature[band * self.rows:(band + 1) * self.rows])
+                self._buckets.setdefault(bucket, set()).add(key)
+                entry.buckets.append(bucket)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+                self._stats["evictions"] += 1
+    
+    def clear(self):
+        """キャッシュをすべて削除"""
+        with self._lock:
+            self._entries.clear()
+            self._buckets.clear()
+    
+    def stats(self) -> Dict[str, Any]:
+        """ヒット数（正規化後の一致・類似）・ミス数・ヒット率・保存件数・節約量を返す"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._entries)
+        hits = stats["exact_hits"] + stats["near_hits"]
+        total = hits + stats["misses"]
+        stats["hit_rate"] = hits / total if total else 0.0
+        return stats
+    
+    @staticmethod
+    def _key(scope: str, normalized: str) -> str:
+        return hashlib.sha256(f"{scope}\n{normalized}".encode("utf-8")).hexdigest()
+    
+    def _candidates(self, scope: str, signature: Tuple[int, ...]) -> Set[str]:
+        # いずれかの帯が完全に一致するものだけを候補にする
+        candidates: Set[str] = set()
+        for band in range(self.bands):
+            bucket = self._buckets.get((scope, band, signature[band * self.rows:(band + 1) * self.rows]))
+            if bucket:
+                candidates |= bucket
+        return candidates
+    
+    def _hit(self, key: str, entry: _Entry, score: float, tier: str) -> Tuple[Any, float]:
+        self._entries.move_to_end(key)
+        self._stats[tier] += 1
+        self._stats["saved_seconds"] += entry.latency
+        self._stats["saved_tokens"] += entry.tokens
+        return entry.value, score
+    
+    def _remove(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        for bucket in entry.buckets:
+            keys = self._buckets.get(bucket)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._buckets[bucket]
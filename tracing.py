@@ -0,0 +1,280 @@
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from logging.handlers import RotatingFileHandler
+from typing import Any, Dict, List, Optional
+
+from metrics import get_metrics
+from outbound import CallAbandoned
+from response_cache import CACHE_DIR
+from single_flight import FlightCancelled
+
+DEFAULT_LOG_PATH = os.path.join(CACHE_DIR, "traces.jsonl")
+
+# Prometheus のヒストグラムのバケット（秒）
+DURATION_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# 管理画面で表示するために保持する直近のスパン数
+RECENT_SPANS = 500
+
+# 実行中のスパン（ネストしたスパンの親子関係の記録に使う）
+_current_span: ContextVar[Optional["Span"]] = ContextVar("current_span", default=None)
+
+
+# 1回の処理（LLM呼び出し・Webhook送信・画面表示など）の記録
+class Span:
+    def __init__(self, name: str, kind: str, **attributes):
+        parent = _current_span.get()
+        self.name = name
+        self.kind = kind
+        self.span_id = uuid.uuid4().hex[:16]
+        self.trace_id = parent.trace_id if parent else uuid.uuid4().hex
+        self.parent_id = parent.span_id if parent else None
+        self.status = "ok"
+        self.error: Optional[str] = None
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.attributes: Dict[str, Any] = {}
+        self.started_at = time.time()
+        self.duration = 0.0
+        self.set(**attributes)
+    
+    def set(self, **attributes):
+        """任意の属性を追加する（bytes_in などの既知の項目はそのまま上書き）"""
+        for key, value in attributes.items():
+            if key in ("status", "error", "bytes_in", "bytes_out", "prompt_tokens", "completion_tokens"):
+                setattr(self, key, value)
+            else:
+                self.attributes[key] = value
+    
+    def record_usage(self, usage: Any):
+        """OpenAI の response.usage からトークン数を記録する"""
+        if usage is None:
+            return
+        self.prompt_tokens += getattr(usage, "prompt_tokens", 0) or 0
+        self.completion_tokens += getattr(usage, "completion_tokens", 0) or 0
+    
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "ts": self.started_at,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "kind": self.kind,
+            "name": self.name,
+            "duration": round(self.duration, 6),
+            "status": self.status,
+            "error": self.error,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "attributes": self.attributes,
+        }
+
+
+# スパンの収集（JSONLへの書き出しと Prometheus 形式の集計）
+class Tracer:
+    def __init__(self, log_path: str = DEFAULT_LOG_PATH, max_bytes: int = 10 * 1024 * 1024, backup_count: int = 5):
+        # サイズで自動的にローテーションする（traces.jsonl.1, .2, ...）
+        os.makedirs(os.path.dirname(log_path) or ".", exist_ok=True)
+        self._logger = logging.getLogger(f"synapse.tracing.{log_path}")
+        self._logger.setLevel(logging.INFO)
+        self._logger.propagate = False
+        if not self._logger.handlers:
+            handler = RotatingFileHandler(log_path, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8")
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            self._logger.addHandler(handler)
+        
+        self._lock = threading.Lock()
+        self._series: Dict[tuple, Dict[str, Any]] = {}
+        self._recent: deque = deque(maxlen=RECENT_SPANS)
+    
+    @contextmanager
+    def span(self, name: str, kind: str, **attributes):
+        """with ブロックをスパンとして記録する（例外で抜けた場合は status=error、中断された場合は status=cancelled）"""
+        span = Span(name, kind, **attributes)
+        token = _current_span.set(span)
+        started_at = time.perf_counter()
+        try:
+            yield span
+        except (CallAbandoned, FlightCancelled) as e:
+            # 呼び出し元が結果を待たなくなったことによる打ち切りもエラーと区別する
+            span.status = "cancelled"
+            span.error = type(e).__name__
+            raise
+        except Exception as e:
+            span.status = "error"
+            span.error = f"{type(e).__name__}: {e}"
+            raise
+        except BaseException as e:
+            # Streamlit の再実行（中止ボタン・画面遷移）による中断はエラーと区別する
+            span.status = "cancelled"
+            span.error = type(e).__name__
+            raise
+        finally:
+            span.duration = time.perf_counter() - started_at
+            _current_span.reset(token)
+            self._finish(span)
+    
+    def traced(self, name: str, kind: str):
+        """関数呼び出しをスパンとして記録するデコレータ"""
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.span(name, kind):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+    
+    def recent(self, limit: int = 100, min_duration: float = 0.0) -> List[Dict[str, Any]]:
+        """直近のスパンを新しい順に返す"""
+        with self._lock:
+            spans = list(self._recent)
+        return [span for span in reversed(spans) if span["duration"] >= min_duration][:limit]
+    
+    def prometheus_text(self) -> str:
+        """集計結果を Prometheus のテキスト形式で返す"""
+        with self._lock:
+            series = {key: dict(value, buckets=list(value["buckets"])) for key, value in self._series.items()}
+        
+        lines = [
+            "# HELP synapse_span_duration_seconds Duration of traced operations.",
+            "# TYPE synapse_span_duration_seconds histogram",
+        ]
+        for (kind, name, status), value in sorted(series.items()):
+            labels = _labels(kind=kind, name=name, status=status)
+            for bound, count in zip(DURATION_BUCKETS, value["buckets"]):
+                lines.append(f'synapse_span_duration_seconds_bucket{{{labels},le="{bound}"}} {count}')
+            lines.append(f'synapse_span_duration_seconds_bucket{{{labels},le="+Inf"}} {value["count"]}')
+            lines.append(f"synapse_span_duration_seconds_sum{{{labels}}} {value['sum']:.6f}")
+            lines.append(f"synapse_span_duration_seconds_count{{{labels}}} {value['count']}")
+        
+        for metric, field, help_text in (
+            ("synapse_span_bytes_in_total", "bytes_in", "Bytes received by traced operations."),
+            ("synapse_span_bytes_out_total", "bytes_out", "Bytes sent by traced operations."),
+            ("synapse_span_prompt_tokens_total", "prompt_tokens", "Prompt tokens reported by the API."),
+            ("synapse_span_completion_tokens_total", "completion_tokens", "Completion tokens reported by the API."),
+        ):
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} counter")
+            for (kind, name, status), value in sorted(series.items()):
+                lines.append(f"{metric}{{{_labels(kind=kind, name=name, status=status)}}} {value[field]}")
+        return "\n".join(lines) + "\n"
+    
+    def _finish(self, span: Span):
+        record = span.to_dict()
+        with self._lock:
+            value = self._series.setdefault((span.kind, span.name, span.status), {
+                "count": 0,
+                "sum": 0.0,
+                "buckets": [0] * len(DURATION_BUCKETS),
+                "bytes_in": 0,
+                "bytes_out": 0,
+                "prompt_tokens": 0,
+                "completion_tokens": 0,
+            })
+            value["count"] += 1
+            value["sum"] += span.duration
+            for i, bound in enumerate(DURATION_BUCKETS):
+                if span.duration <= bound:
+                    value["buckets"][i] += 1
+            for field in ("bytes_in", "bytes_out", "prompt_tokens", "completion_tokens"):
+                value[field] += record[field]
+            self._recent.append(record)
+        
+        # 利用統計（ホーム画面）にも同じ処理を記録する。中断された処理は失敗ではなく、
+        # 所要時間も処理の速さを表さないため含めない（件数は上の status="cancelled" の系列に残る）
+        if span.status != "cancelled":
+            get_metrics().record(span.name, span.kind, span.duration, ok=span.status == "ok")
+        try:
+            self._logger.info(json.dumps(record, ensure_ascii=False, default=str))
+        except (OSError, ValueError):
+            # ログの書き出しに失敗しても本来の処理は止めない
+            pass
+
+
+def request_bytes(payload: Any) -> int:
+    """送信するリクエストボディのおおよそのバイト数"""
+    try:
+        return len(json.dumps(payload, ensure_ascii=False, default=str).encode("utf-8"))
+    except (TypeError, ValueError):
+        return 0
+
+
+def response_bytes(response: Any) -> int:
+    """Chat Completions のレスポンスに含まれる本文のバイト数"""
+    total = 0
+    for choice in getattr(response, "choices", None) or []:
+        content = getattr(choice.message, "content", None)
+        if content:
+            total += len(content.encode("utf-8"))
+    return total
+
+
+def _labels(**labels: str) -> str:
+    escaped = (
+        (key, str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n"))
+        for key, value in labels.items()
+    )
+    return ",".join(f'{key}="{value}"' for key, value in escaped)
+
+
+# GET /metrics で Prometheus 形式の集計を返すハンドラ
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.rstrip("/") != "/metrics":
+            self.send_error(404)
+            return
+        body = get_tracer().prometheus_text().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port: int) -> ThreadingHTTPServer:
+    """Prometheus からスクレイプするための /metrics エンドポイントをバックグラウンドで起動する"""
+    server = ThreadingHTTPServer(("0.0.0.0", port), _MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    return server
+
+
+_tracer: Optional[Tracer] = None
+_tracer_lock = threading.Lock()
+
+
+def get_tracer() -> Tracer:
+    """プロセス内で共有するトレーサーを返す（SYNAPSE_METRICS_PORT があれば /metrics も公開）"""
+    global _tracer
+    with _tracer_lock:
+        if _tracer is None:
+            _tracer = Tracer()
+            port = os.environ.get("SYNAPSE_METRICS_PORT")
+            if port:
+                try:
+                    start_metrics_server(int(port))
+                except (OSError, ValueError):
+                    # 別のプロセスがポートを使用中の場合は管理画面からの参照のみとする
+                    pass
+        return _tracer
+
+
+def span(name: str, kind: str, **attributes):
+    """get_tracer().span の短縮形"""
+    return get_tracer().span(name, kind, **attributes)
@@ -0,0 +1,158 @@
+import json
+import random
+import threading
+import time
+from collections import deque
+from typing import Any, Dict, Optional, Tuple, Union
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import percentile
+from tracing import span
+
+# リトライ対象のステータスコード
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# エンドポイントごとに保持するレイテンシのサンプル数
+LATENCY_SAMPLES = 500
+
+
+def endpoint_label(url: str) -> str:
+    """統計表示用のエンドポイント名（Webhookのトークン部分は先頭だけ残して伏せる）"""
+    parsed = urlparse(url)
+    segments = parsed.path.rstrip("/").split("/")
+    if segments and len(segments[-1]) > 8:
+        segments[-1] = segments[-1][:6] + "…"
+    return parsed.netloc + "/".join(segments)
+
+
+# Webhook送信用の共有HTTPクライアント（接続の再利用・タイムアウト・リトライ・統計）
+class WebhookClient:
+    def __init__(
+        self,
+        connect_timeout: float = 3.05,
+        read_timeout: float = 30.0,
+        max_retries: int = 3,
+        backoff_base: float = 0.5,
+        backoff_max: float = 8.0,
+        pool_maxsize: int = 20,
+    ):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        
+        # Keep-Alive で同じホストへの接続を使い回し、毎回のTLSハンドシェイクを避ける
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_maxsize, max_retries=0)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        
+        self._lock = threading.Lock()
+        self._stats: Dict[str, Dict[str, Any]] = {}
+    
+    def post_json(
+        self,
+        url: str,
+        data: Any,
+        headers: Optional[Dict[str, str]] = None,
+        timeout: Optional[Union[float, Tuple[float, float]]] = None,
+        max_retries: Optional[int] = None,
+    ) -> requests.Response:
+        """JSONをPOSTし、429/5xx・接続エラーの場合は指数バックオフでリトライする
+        
+        読み取りタイムアウトは処理が相手側で進んでいる可能性があるため再送しない。
+        max_retries を指定すると、この送信だけリトライの回数を変える（0 なら再送しない）。
+        """
+        if max_retries is None:
+            max_retries = self.max_retries
+        body = json.dumps(data)
+        request_headers = {"Content-Type": "application/json"}
+        if headers:
+            request_headers.update(headers)
+        if timeout is None:
+            timeout = (self.connect_timeout, self.read_timeout)
+        
+        label = endpoint_label(url)
+        for attempt in range(max_retries + 1):
+            # 再送を含め、1回の送信ごとにスパンを記録する
+            with span(label, "webhook", bytes_out=len(body), attempt=attempt) as current:
+                started_at = time.perf_counter()
+                try:
+                    response = self.session.post(url, data=body, headers=request_headers, timeout=timeout)
+                except requests.exceptions.ConnectionError as e:
+                    # ConnectTimeout を含む接続エラーのみ再送する
+                    self._record(label, time.perf_counter() - started_at, None)
+                    if attempt == max_retries:
+                        raise
+                    current.set(status="error", error=f"{type(e).__name__}: {e}")
+                    retry_after = None
+                except requests.exceptions.RequestException:
+                    self._record(label, time.perf_counter() - started_at, None)
+                    raise
+                else:
+                    self._record(label, time.perf_counter() - started_at, response.status_code)
+                    current.set(http_status=response.status_code, bytes_in=len(response.content))
+                    if response.status_code >= 400:
+                        current.set(status="error")
+                    if response.status_code not in RETRY_STATUSES or attempt == max_retries:
+                        return response
+                    retry_after = response.headers.get("Retry-After")
+            self._sleep_before_retry(label, attempt, retry_after)
+    
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """エンドポイントごとの送信回数・エラー数・リトライ数・レイテンシ(p50/p95)を返す"""
+        with self._lock:
+            snapshot = {label: dict(stat, latencies=list(stat["latencies"])) for label, stat in self._stats.items()}
+        result = {}
+        for label, stat in snapshot.items():
+            latencies = stat.pop("latencies")
+            stat["p50"] = percentile(latencies, 0.5)
+            stat["p95"] = percentile(latencies, 0.95)
+            result[label] = stat
+        return result
+    
+    def _record(self, label: str, latency: float, status: Optional[int]):
+        with self._lock:
+            stat = self._stats.setdefault(label, {
+                "requests": 0,
+                "errors": 0,
+                "retries": 0,
+                "last_status": None,
+                "latencies": deque(maxlen=LATENCY_SAMPLES),
+            })
+            stat["requests"] += 1
+            stat["last_status"] = status
+            stat["latencies"].append(latency)
+            if status is None or status >= 400:
+                stat["errors"] += 1
+    
+    def _sleep_before_retry(self, label: str, attempt: int, retry_after: Optional[str] = None):
+        with self._lock:
+            self._stats[label]["retries"] += 1
+        delay = None
+        if retry_after:
+            try:
+                delay = min(float(retry_after), self.backoff_max)
+            except ValueError:
+                delay = None
+        if delay is None:
+            # Full Jitter: 0〜(base * 2^attempt) の範囲でランダムに待つ
+            delay = random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+        time.sleep(delay)
+
+
+_client: Optional[WebhookClient] = None
+_client_lock = threading.Lock()
+
+
+def get_webhook_client() -> WebhookClient:
+    """プロセス内の全セッションで共有するWebhookクライアントを返す"""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = WebhookClient()
+        return _client
@@ -0,0 +1,67 @@
+import contextvars
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Callable, Iterable, Iterator, Optional, Tuple
+
+
+# 一定の間隔を空けてリクエストを発行するための簡易レートリミッタ
+class RateLimiter:
+    def __init__(self, requests_per_minute: float):
+        self.interval = 60.0 / requests_per_minute if requests_per_minute > 0 else 0.0
+        self._next_time = 0.0
+        self._lock = threading.Lock()
+    
+    def wait(self):
+        """次のリクエストを発行してよい時刻まで待機する"""
+        with self._lock:
+            now = time.monotonic()
+            scheduled = max(now, self._next_time)
+            self._next_time = scheduled + self.interval
+        delay = scheduled - now
+        if delay > 0:
+            time.sleep(delay)
+
+
+def run_bounded(
+    func: Callable[[Any], Any],
+    items: Iterable[Any],
+    max_workers: int = 4,
+    rate_limiter: Optional[RateLimiter] = None,
+) -> Iterator[Tuple[int, Any, Optional[Exception]]]:
+    """items の各要素に func をスレッドプールで適用し、完了順に (index, 結果, 例外) を返す
+    
+    同時に保持するタスクは max_workers の2倍までに抑えるため、
+    items にジェネレータを渡せば入力全体をメモリに載せずに処理できる。
+    """
+    def call(item):
+        if rate_limiter is not None:
+            rate_limiter.wait()
+        return func(item)
+    
+    iterator = enumerate(items)
+    max_pending = max_workers * 2
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    pending = {}
+    try:
+        exhausted = False
+        while pending or not exhausted:
+            while not exhausted and len(pending) < max_pending:
+                try:
+                    index, item = next(iterator)
+                except StopIteration:
+                    exhausted = True
+                    break
+                # セッションやトレースの情報をワーカースレッドへ引き継ぐ
+                pending[executor.submit(contextvars.copy_context().run, call, item)] = index
+            if not pending:
+                break
+            
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                index = pending.pop(future)
+                error = future.exception()
+                yield index, (None if error else future.result()), error
+    finally:
+        # 呼び出し元が途中でやめた場合（画面の再実行など）は、未開始のタスクを取り消して実行中のタスクを待たずに戻る
+        executor.shutdown(wait=not pending, cancel_futures=True)
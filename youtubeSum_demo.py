@@ -1,29 +1,37 @@
 import streamlit as st
 import requests
 import re
-import json
+import time
 from bs4 import BeautifulSoup
 
+from webhook_client import get_webhook_client
+from youtube_jobs import get_summary_jobs
+
 # アプリケーションのタイトルを設定
 st.title("Youtube動画自動要約DEMO by Synapse Works")
 
-# YouTubeのURLを検証する関数
-def is_valid_youtube_url(url):
+# YouTubeのURLから11文字の動画IDを取り出す関数
+def extract_youtube_video_id(url):
     youtube_regex = (
         r'(https?://)?(www\.)?'
         r'(youtube\.com/watch\?v=|youtu\.be/)'
         r'([A-Za-z0-9_-]{11})'
     )
     match = re.match(youtube_regex, url)
-    return bool(match)
+    return match.group(4) if match else None
+
+# YouTubeのURLを検証する関数
+def is_valid_youtube_url(url):
+    return extract_youtube_video_id(url) is not None
 
 # Webhookにデータを送信する関数
 def send_to_webhook(data):
     webhook_url = "https://hook.us2.make.com/9seno4a0u2isb6ftq794m3wa0jt5ndsw"
-    headers = {"Content-Type": "application/json"}
     
     try:
-        response = requests.post(webhook_url, data=json.dumps(data), headers=headers)
+        # 長い動画の要約は数分かかるため、読み取りタイムアウトを長めに取る
+        # 5xx やタイムアウトで再送すると要約が二重に走るため再送せず、失敗はジョブのエラーとして表示する
+        response = get_webhook_client().post_json(webhook_url, data, timeout=(3.05, 600), max_retries=0)
         response.raise_for_status()  # エラーがあれば例外を発生させる
         
         # レスポンスの内容を取得
@@ -42,6 +50,64 @@ def send_to_webhook(data):
     except requests.exceptions.RequestException as e:
         return False, f"エラーが発生しました: {str(e)}", None
 
+# 要約結果（サーバーからの返信）を表示する関数
+def render_summary(response_data):
+    # サーバーからの返信を表示
+    if response_data:
+        st.subheader("要約内容:")
+        
+        # JSON形式の場合
+        if isinstance(response_data, dict):
+            # 'response_text'キーがあり、HTML形式の場合
+            if 'response_text' in response_data and ('content_type' in response_data and 'text/html' in response_data['content_type'] or '<html' in response_data['response_text'].lower() or '<!doctype html' in response_data['response_text'].lower()):
+                html_content = response_data['response_text']
+                
+                # HTMLの表示と生コードの切り替えタブ
+                tab1, tab2 = st.tabs(["レンダリングされたHTML", "HTMLソースコード"])
+                
+                with tab1:
+                    # HTMLをレンダリング
+                    st.components.v1.html(html_content, height=600, scrolling=True)
+                
+                with tab2:
+                    # HTMLのソースコードを表示
+                    st.code(html_content, language="html")
+                    
+                    # フォームの外にダウンロードボタンを配置
+            
+            else:
+                # 通常のJSONを表示
+                for key, value in response_data.items():
+                    if isinstance(value, str) and ('<html' in value.lower() or '<!doctype html' in value.lower()):
+                        # HTMLの表示と生コードの切り替えタブ
+                        tab1, tab2 = st.tabs(["レンダリングされたHTML", "HTMLソースコード"])
+                        
+                        with tab1:
+                            st.components.v1.html(value, height=600, scrolling=True)
+                        
+                        with tab2:
+                            st.code(value, language="html")
+                            
+                            # フォームの外にダウンロードボタンを配置
+                    
+                    else:
+                        st.write(f"**{key}**: {value}")
+        # テキスト形式でHTMLの場合
+        elif isinstance(response_data, str) and ('<html' in response_data.lower() or '<!doctype html' in response_data.lower()):
+            # HTMLの表示と生コードの切り替えタブ
+            tab1, tab2 = st.tabs(["レンダリングされたHTML", "HTMLソースコード"])
+            
+            with tab1:
+                st.components.v1.html(response_data, height=600, scrolling=True)
+            
+            with tab2:
+                st.code(response_data, language="html")
+                
+                # フォームの外にダウンロードボタンを配置
+        
+        else:
+            st.write(response_data)
+
 # フォームの作成
 with st.form("youtube_form"):
     st.write("YouTubeのURLを入力してください")
@@ -61,69 +127,58 @@ with st.form("youtube_form"):
                 "youtubeURL": youtube_url
             }
             
-            # Webhookにデータを送信
-            success, message, response_data = send_to_webhook(data)
-            
-            if success:
-                st.success(message)
-                
-                # サーバーからの返信を表示
-                if response_data:
-                    st.subheader("要約内容:")
-                    
-                    # JSON形式の場合
-                    if isinstance(response_data, dict):
-                        # 'response_text'キーがあり、HTML形式の場合
-                        if 'response_text' in response_data and ('content_type' in response_data and 'text/html' in response_data['content_type'] or '<html' in response_data['response_text'].lower() or '<!doctype html' in response_data['response_text'].lower()):
-                            html_content = response_data['response_text']
-                            
-                            # HTMLの表示と生コードの切り替えタブ
-                            tab1, tab2 = st.tabs(["レンダリングされたHTML", "HTMLソースコード"])
-                            
-                            with tab1:
-                                # HTMLをレンダリング
-                                st.components.v1.html(html_content, height=600, scrolling=True)
-                            
-                            with tab2:
-                                # HTMLのソースコードを表示
-                                st.code(html_content, language="html")
-                                
-                                # フォームの外にダウンロードボタンを配置
+            # 要約はジョブとして登録し、結果はフォームの外でポーリングして表示する
+            video_id = extract_youtube_video_id(youtube_url)
+            st.session_state.youtube_job_id = get_summary_jobs().submit(
+                video_id, lambda: send_to_webhook(data)
+            )
+            st.session_state.pop("youtube_job_status", None)
 
-                        else:
-                            # 通常のJSONを表示
-                            for key, value in response_data.items():
-                                if isinstance(value, str) and ('<html' in value.lower() or '<!doctype html' in value.lower()):
-                                    # HTMLの表示と生コードの切り替えタブ
-                                    tab1, tab2 = st.tabs(["レンダリングされたHTML", "HTMLソースコード"])
-                                    
-                                    with tab1:
-                                        st.components.v1.html(value, height=600, scrolling=True)
-                                    
-                                    with tab2:
-                                        st.code(value, language="html")
-                                        
-                                        # フォームの外にダウンロードボタンを配置
+# 要約ジョブの状態を確認する間隔（秒）。最初は短く、同じ状態が続くほど倍にしていく
+POLL_INTERVAL_MIN = 1.0
+POLL_INTERVAL_MAX = 10.0
 
-                                else:
-                                    st.write(f"**{key}**: {value}")
-                    # テキスト形式でHTMLの場合
-                    elif isinstance(response_data, str) and ('<html' in response_data.lower() or '<!doctype html' in response_data.lower()):
-                        # HTMLの表示と生コードの切り替えタブ
-                        tab1, tab2 = st.tabs(["レンダリングされたHTML", "HTMLソースコード"])
-                        
-                        with tab1:
-                            st.components.v1.html(response_data, height=600, scrolling=True)
-                        
-                        with tab2:
-                            st.code(response_data, language="html")
-                            
-                            # フォームの外にダウンロードボタンを配置
+# 状態が変わってからの経過時間に応じて、次に状態を確認するまでの秒数を決める関数
+def poll_interval(status):
+    now = time.monotonic()
+    if st.session_state.get("youtube_job_status") != status:
+        # 状態が変わったら最短の間隔に戻す
+        st.session_state.youtube_job_status = status
+        st.session_state.youtube_status_since = now
+    elapsed = now - st.session_state.youtube_status_since
+    interval = POLL_INTERVAL_MIN
+    while interval * 2 <= elapsed and interval < POLL_INTERVAL_MAX:
+        interval *= 2
+    return min(interval, POLL_INTERVAL_MAX)
 
-                    else:
-                        st.write(response_data)
-            else:
-                st.error(message)
+# 要約ジョブの状態を表示する関数（作成中は st.fragment の run_every でこの部分だけ再実行する）
+def render_job_status(job_id, interval):
+    job = get_summary_jobs().get(job_id)
+    if job is not None and job["status"] in ("queued", "running"):
+        elapsed = time.time() - job["submitted_at"]
+        st.info(f"要約を作成中です...（経過時間: {int(elapsed)}秒）")
+        # run_every はページ全体の実行ごとに決まるため、間隔を変えるときはページ全体を再実行する
+        if interval is not None and poll_interval(job["status"]) != interval:
+            st.rerun()
+        return
+    if interval is not None:
+        # 作成が終わったらページ全体を再実行し、定期的な再実行を止める
+        st.rerun()
+    if job is None:
+        st.session_state.youtube_job_id = None
+    elif job["status"] == "done":
+        st.success(job["message"])
+        render_summary(job["result"])
+    else:
+        st.error(job["message"])
+
+# 登録した要約ジョブの状態を確認して表示
+job_id = st.session_state.get("youtube_job_id")
+if job_id:
+    job = get_summary_jobs().get(job_id)
+    polling = job is not None and job["status"] in ("queued", "running")
+    interval = poll_interval(job["status"]) if polling else None
+    st.fragment(render_job_status, run_every=interval)(job_id, interval)
 
 # 使用方法についての簡単な説明
 st.markdown("""
@@ -139,4 +194,4 @@ st.markdown("""
 # pip install streamlit requests beautifulsoup4
 # streamlit run app.py
 # ```
-# """)
\ No newline at end of file
+# """)
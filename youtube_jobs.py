@@ -0,0 +1,112 @@
+import json
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from response_cache import CACHE_DIR, ResponseCache
+
+DEFAULT_DB_PATH = os.path.join(CACHE_DIR, "youtube_summaries.sqlite3")
+
+# 完了したジョブをメモリに残しておく秒数
+FINISHED_JOB_RETENTION = 60 * 60
+
+
+# YouTube要約の非同期ジョブ管理（結果は動画IDごとにキャッシュする）
+class SummaryJobManager:
+    def __init__(self, cache: Optional[ResponseCache] = None, max_workers: int = 4):
+        self.cache = cache or ResponseCache(db_path=DEFAULT_DB_PATH, ttl_seconds=30 * 24 * 60 * 60)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="youtube-summary")
+        self._lock = threading.Lock()
+        self._jobs: Dict[str, Dict[str, Any]] = {}
+        # 動画ID -> 実行中のジョブID（同じ動画の要約を重複して依頼しない）
+        self._running: Dict[str, str] = {}
+    
+    def submit(self, video_id: str, send: Callable[[], Tuple[bool, str, Any]]) -> str:
+        """要約ジョブを登録してジョブIDを返す
+        
+        send は (成功したか, メッセージ, 応答データ) を返す関数。
+        キャッシュ済みの動画は即座に完了したジョブになる。
+        """
+        cached = self.cache.get(video_id)
+        with self._lock:
+            self._prune()
+            if cached is None and video_id in self._running:
+                return self._running[video_id]
+            
+            job_id = uuid.uuid4().hex
+            job = {
+                "id": job_id,
+                "video_id": video_id,
+                "status": "queued",
+                "message": "",
+                "result": None,
+                "cached": False,
+                "submitted_at": time.time(),
+                "finished_at": None,
+            }
+            self._jobs[job_id] = job
+            if cached is not None:
+                job.update(
+                    status="done",
+                    message="キャッシュ済みの要約を表示します",
+                    result=json.loads(cached),
+                    cached=True,
+                    finished_at=time.time()
+                )
+                return job_id
+            self._running[video_id] = job_id
+        
+        self._executor.submit(self._run, job_id, video_id, send)
+        return job_id
+    
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """ジョブの状態（queued / running / done / failed）を返す"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+    
+    def _run(self, job_id: str, video_id: str, send: Callable[[], Tuple[bool, str, Any]]):
+        with self._lock:
+            self._jobs[job_id]["status"] = "running"
+        try:
+            success, message, response_data = send()
+        except Exception as e:
+            success, message, response_data = False, f"エラーが発生しました: {str(e)}", None
+        
+        if success:
+            self.cache.set(video_id, json.dumps(response_data, ensure_ascii=False),
+                           latency=time.time() - self._jobs[job_id]["submitted_at"])
+        with self._lock:
+            self._jobs[job_id].update(
+                status="done" if success else "failed",
+                message=message,
+                result=response_data,
+                finished_at=time.time()
+            )
+            self._running.pop(video_id, None)
+    
+    def _prune(self):
+        # 完了から一定時間が経ったジョブを破棄してメモリを抑える
+        threshold = time.time() - FINISHED_JOB_RETENTION
+        expired = [
+            job_id for job_id, job in self._jobs.items()
+            if job["finished_at"] is not None and job["finished_at"] < threshold
+        ]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+
+_manager: Optional[SummaryJobManager] = None
+_manager_lock = threading.Lock()
+
+
+def get_summary_jobs() -> SummaryJobManager:
+    """プロセス内で共有する要約ジョブ管理を返す"""
+    global _manager
+    with _manager_lock:
+        if _manager is None:
+            _manager = SummaryJobManager()
+        return _manager